@@ -1,27 +1,140 @@
 from pymongo import MongoClient
-from typing import Optional
+from pymongo.collection import Collection
+from typing import Any, Callable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import os
 
 class Database:
     _instance: Optional["Database"] = None
     
-    def __init__(self, host: str, port: int, db_name: str, username: Optional[str] = None, password: Optional[str] = None, auth_source: Optional[str] = None):
+    def __init__(self, host: str, port: int, db_name: str, username: Optional[str] = None, password: Optional[str] = None, auth_source: Optional[str] = None, max_pool_size: Optional[int] = None):
+        if max_pool_size is None:
+            # 连接池大小，未指定时从环境变量读取
+            max_pool_size = int(os.getenv("MONGODB_MAX_POOL_SIZE") or 100)
+        self.max_pool_size = max_pool_size
         if username and password:
             # 如果有用户名和密码，使用认证连接
             # TODO: 复杂情况直接支持URI吧
-            self.client = MongoClient(host, port, username=username, password=password, authSource=auth_source)
+            self.client = MongoClient(host, port, username=username, password=password, authSource=auth_source, maxPoolSize=max_pool_size)
         else:
             # 否则使用无认证连接
-            self.client = MongoClient(host, port)
+            self.client = MongoClient(host, port, maxPoolSize=max_pool_size)
         self.db = self.client[db_name]
         
     @classmethod
-    def initialize(cls, host: str, port: int, db_name: str, username: Optional[str] = None, password: Optional[str] = None, auth_source: Optional[str] = None) -> "Database":
+    def initialize(cls, host: str, port: int, db_name: str, username: Optional[str] = None, password: Optional[str] = None, auth_source: Optional[str] = None, max_pool_size: Optional[int] = None) -> "Database":
         if cls._instance is None:
-            cls._instance = cls(host, port, db_name, username, password, auth_source)
+            cls._instance = cls(host, port, db_name, username, password, auth_source, max_pool_size)
         return cls._instance
         
     @classmethod
     def get_instance(cls) -> "Database":
         if cls._instance is None:
             raise RuntimeError("Database not initialized")
-        return cls._instance
\ No newline at end of file
+        return cls._instance
+
+
+class AsyncCursor:
+    """异步游标，在线程池中执行查询，接口与 Motor 的游标保持一致"""
+    def __init__(self, executor: ThreadPoolExecutor, cursor_factory: Callable[[], Any]):
+        self._executor = executor
+        self._cursor_factory = cursor_factory
+        self._sort = None
+        self._limit = None
+
+    def sort(self, key_or_list, direction=None) -> "AsyncCursor":
+        self._sort = (key_or_list, direction)
+        return self
+
+    def limit(self, limit: int) -> "AsyncCursor":
+        self._limit = limit
+        return self
+
+    def _fetch(self, length: Optional[int]) -> List[dict]:
+        cursor = self._cursor_factory()
+        if self._sort is not None:
+            key_or_list, direction = self._sort
+            cursor = cursor.sort(key_or_list, direction) if direction is not None else cursor.sort(key_or_list)
+        if self._limit is not None:
+            cursor = cursor.limit(self._limit)
+        if length is None:
+            return list(cursor)
+        return [doc for _, doc in zip(range(length), cursor)]
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        """取出查询结果，length为None时取出全部"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._fetch, length)
+
+
+class AsyncCollection:
+    """异步集合，把 pymongo 的同步调用放到专用线程池中执行"""
+    def __init__(self, collection: Collection, executor: ThreadPoolExecutor):
+        self._collection = collection
+        self._executor = executor
+
+    def find(self, *args, **kwargs) -> AsyncCursor:
+        return AsyncCursor(self._executor, partial(self._collection.find, *args, **kwargs))
+
+    def aggregate(self, pipeline: List[dict], **kwargs) -> AsyncCursor:
+        return AsyncCursor(self._executor, partial(self._collection.aggregate, pipeline, **kwargs))
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._collection, name)
+        if isinstance(attr, Collection):
+            # 子集合，如 graph_data.nodes
+            return AsyncCollection(attr, self._executor)
+        if not callable(attr):
+            return attr
+
+        async def _call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(attr, *args, **kwargs))
+        return _call
+
+    def __getitem__(self, name: str) -> "AsyncCollection":
+        return AsyncCollection(self._collection[name], self._executor)
+
+
+class _AsyncDatabaseProxy:
+    """按属性或下标访问集合，返回 AsyncCollection"""
+    def __init__(self, db, executor: ThreadPoolExecutor):
+        self._db = db
+        self._executor = executor
+
+    def __getattr__(self, name: str) -> AsyncCollection:
+        return AsyncCollection(self._db[name], self._executor)
+
+    def __getitem__(self, name: str) -> AsyncCollection:
+        return AsyncCollection(self._db[name], self._executor)
+
+
+class AsyncDatabase:
+    """Database 的异步版本，复用同一个连接池，通过线程池执行数据库操作，不阻塞事件循环"""
+    _instance: Optional["AsyncDatabase"] = None
+
+    def __init__(self, database: Database, max_workers: Optional[int] = None):
+        self.sync = database
+        # 线程数不超过连接池大小，避免线程排队等待连接
+        self.max_workers = max_workers or database.max_pool_size
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mongo")
+        self.db = _AsyncDatabaseProxy(database.db, self.executor)
+
+    @classmethod
+    def initialize(cls, database: Optional[Database] = None, max_workers: Optional[int] = None) -> "AsyncDatabase":
+        if cls._instance is None:
+            cls._instance = cls(database or Database.get_instance(), max_workers)
+        return cls._instance
+
+    @classmethod
+    def get_instance(cls) -> "AsyncDatabase":
+        if cls._instance is None:
+            raise RuntimeError("AsyncDatabase not initialized")
+        return cls._instance
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """在数据库线程池中执行任意同步函数"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
@@ -0,0 +1,160 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from pymongo.errors import OperationFailure
+
+
+@dataclass
+class IndexSpec:
+    """声明式的索引定义"""
+    collection: str  # 集合名，子集合用点分隔，如 graph_data.nodes
+    keys: List[Tuple[str, int]]
+    unique: bool = False
+    expire_after_seconds: Optional[int] = None  # TTL索引的过期秒数
+    name: Optional[str] = None  # 不指定时使用 pymongo 默认命名，如 group_id_1_time_1
+    reason: str = ""  # 为什么需要这个索引
+
+    @property
+    def index_name(self) -> str:
+        return self.name or "_".join(f"{key}_{direction}" for key, direction in self.keys)
+
+    def options(self) -> Dict:
+        options = {"name": self.index_name}
+        if self.unique:
+            options["unique"] = True
+        if self.expire_after_seconds is not None:
+            options["expireAfterSeconds"] = self.expire_after_seconds
+        return options
+
+
+def get_index_registry(reasoning_log_ttl_days: int = 30) -> List[IndexSpec]:
+    """返回所有需要的索引
+
+    Args:
+        reasoning_log_ttl_days: 推理日志保留天数，0为永久保留
+    """
+    registry = [
+        IndexSpec("messages", [("group_id", 1), ("time", 1)], reason="按群取最近消息、按群和时间范围取聊天记录"),
+        IndexSpec("messages", [("time", 1)], reason="记忆构建时按时间戳查找最近的消息"),
+        IndexSpec("message_buckets", [("group_id", 1), ("bucket", 1)], unique=True, reason="写入消息时按群和时间桶累加消息数"),
+        IndexSpec("message_buckets", [("bucket", 1)], reason="记忆构建时取最近一天的时间桶"),
+        IndexSpec("image_descriptions", [("kind", 1), ("file_ids", 1)], reason="按QQ图片file id查找识图缓存"),
+        IndexSpec("image_descriptions", [("expire_at", 1)], expire_after_seconds=0, reason="识图失败的缓存到期自动删除"),
+        IndexSpec("images", [("hash", 1)], unique=True, reason="图片按哈希去重"),
+        IndexSpec("emoji", [("filename", 1)], unique=True, reason="扫描表情包时按文件名判断是否已注册"),
+        IndexSpec("emoji", [("tags", 1)], reason="按情感标签挑选表情包"),
+        IndexSpec("graph_data.nodes", [("concept", 1)], unique=True, reason="保存记忆图时按概念查找节点"),
+        IndexSpec("graph_data.edges", [("source", 1), ("target", 1)], unique=True, reason="保存记忆图时按端点查找边"),
+        IndexSpec("graph_data.nodes", [("updated_at", 1)], reason="加载记忆快照时重放之后更新的节点"),
+        IndexSpec("graph_data.edges", [("updated_at", 1)], reason="加载记忆快照时重放之后更新的连接"),
+        IndexSpec("graph_data.tombstones", [("deleted_at", 1)], reason="加载记忆快照时重放之后删除的节点和连接"),
+        IndexSpec("relationships", [("user_id", 1)], unique=True, reason="按用户更新关系"),
+        IndexSpec("schedule", [("date", 1)], unique=True, reason="按日期读取日程"),
+        IndexSpec("knowledges", [("content_hash", 1)], unique=True, reason="知识片段按内容哈希去重"),
+        IndexSpec("knowledges", [("updated_at", 1)], reason="刷新知识库索引时重新读取位置变化的片段"),
+        IndexSpec("knowledge_tombstones", [("deleted_at", 1)], reason="刷新知识库索引时跳过已删除的片段"),
+        IndexSpec("processed_files", [("file_path", 1)], unique=True, reason="判断知识文件是否已处理"),
+    ]
+    if reasoning_log_ttl_days > 0:
+        registry.append(IndexSpec(
+            "reasoning_logs", [("created_at", 1)],
+            expire_after_seconds=reasoning_log_ttl_days * 24 * 3600,
+            reason="推理日志过期自动删除",
+        ))
+    else:
+        # 永久保留时登记为普通索引，之前建过的TTL索引会被重建成普通索引
+        registry.append(IndexSpec(
+            "reasoning_logs", [("created_at", 1)],
+            reason="推理日志按时间查询（永久保留）",
+        ))
+    return registry
+
+
+def _get_collection(db, name: str):
+    collection = db
+    for part in name.split("."):
+        collection = collection[part]
+    return collection
+
+
+def ensure_indexes(db, registry: Optional[List[IndexSpec]] = None, report_unused: bool = True) -> Dict[str, List[str]]:
+    """创建缺失的索引，并报告未在登记表中或从未被使用的索引
+
+    Args:
+        db: pymongo 的 Database 对象（即 Database.get_instance().db）
+        registry: 索引登记表，默认为 get_index_registry()
+        report_unused: 是否通过 $indexStats 报告未使用的索引
+
+    Returns:
+        Dict[str, List[str]]: created/failed/unregistered/unused 四类索引名
+    """
+    if registry is None:
+        registry = get_index_registry()
+
+    report = {"created": [], "failed": [], "unregistered": [], "unused": []}
+    by_collection: Dict[str, List[IndexSpec]] = {}
+    for spec in registry:
+        by_collection.setdefault(spec.collection, []).append(spec)
+
+    for collection_name, specs in by_collection.items():
+        collection = _get_collection(db, collection_name)
+        existing = collection.index_information()
+        existing_keys = {tuple(info["key"]): name for name, info in existing.items()}
+
+        for spec in specs:
+            label = f"{collection_name}.{spec.index_name}"
+            if tuple(spec.keys) in existing_keys:
+                name = existing_keys[tuple(spec.keys)]
+                info = existing[name]
+                if spec.expire_after_seconds is None and "expireAfterSeconds" in info:
+                    # collMod不能去掉过期时间，只能删掉TTL索引重建
+                    try:
+                        collection.drop_index(name)
+                        collection.create_index(spec.keys, **spec.options())
+                        report["created"].append(label)
+                        print(f"\033[1;32m[索引]\033[0m 已将索引 {label} 改为不过期")
+                    except OperationFailure as e:
+                        report["failed"].append(label)
+                        print(f"\033[1;31m[索引]\033[0m 去掉索引 {label} 的过期时间失败: {e}")
+                    continue
+                if spec.expire_after_seconds is not None and info.get("expireAfterSeconds") != spec.expire_after_seconds:
+                    # TTL时长变化时直接修改已有索引
+                    try:
+                        db.command("collMod", collection.name, index={
+                            "keyPattern": dict(spec.keys),
+                            "expireAfterSeconds": spec.expire_after_seconds,
+                        })
+                        print(f"\033[1;32m[索引]\033[0m 已更新索引 {label} 的过期时间")
+                    except OperationFailure as e:
+                        # 常见原因：账号没有collMod权限
+                        report["failed"].append(label)
+                        print(f"\033[1;31m[索引]\033[0m 更新索引 {label} 的过期时间失败: {e}")
+                continue
+            try:
+                collection.create_index(spec.keys, **spec.options())
+                report["created"].append(label)
+                print(f"\033[1;32m[索引]\033[0m 已创建索引 {label}（{spec.reason}）")
+            except OperationFailure as e:
+                # 常见原因：已有重复数据导致唯一索引无法创建
+                report["failed"].append(label)
+                print(f"\033[1;31m[索引]\033[0m 创建索引 {label} 失败: {e}")
+
+        registered_keys = {tuple(spec.keys) for spec in specs}
+        for keys, name in existing_keys.items():
+            if name != "_id_" and keys not in registered_keys:
+                report["unregistered"].append(f"{collection_name}.{name}")
+
+        if report_unused:
+            try:
+                for stats in collection.aggregate([{"$indexStats": {}}]):
+                    if stats["name"] != "_id_" and stats.get("accesses", {}).get("ops", 0) == 0:
+                        report["unused"].append(f"{collection_name}.{stats['name']}")
+            except OperationFailure:
+                # 部分部署（如权限受限的账号）不支持 $indexStats
+                pass
+
+    if report["unregistered"]:
+        print(f"\033[1;33m[索引]\033[0m 以下索引未在登记表中: {', '.join(report['unregistered'])}")
+    if report["unused"]:
+        print(f"\033[1;33m[索引]\033[0m 以下索引自数据库启动以来未被使用: {', '.join(report['unused'])}")
+    print(f"\033[1;32m[索引]\033[0m 索引检查完成，新建 {len(report['created'])} 个，失败 {len(report['failed'])} 个")
+    return report
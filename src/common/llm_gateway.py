@@ -0,0 +1,405 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+
+
+class LLMRequestError(Exception):
+    """大模型请求最终失败（重试用尽、重试预算不足或不可重试的错误）"""
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class TokenBucket:
+    """令牌桶限流，按每分钟请求数补充令牌；收到429时整体暂停，线程安全"""
+    def __init__(self, requests_per_minute: int, burst: Optional[int] = None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst or max(1, requests_per_minute // 10))
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_acquire(self) -> float:
+        """尝试取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.rate <= 0:
+                # 不限速，但收到429后的暂停仍然生效
+                return 0.0
+            self.tokens = min(self.capacity, self.tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        while True:
+            wait_time = self._try_acquire()
+            if wait_time <= 0:
+                return
+            await asyncio.sleep(wait_time)
+
+    def pause(self, seconds: float) -> None:
+        """服务端限流时暂停发放令牌，避免其他请求继续撞上429"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class RetryBudget:
+    """重试预算：每个请求存入ratio个重试额度，每次重试消耗1个，防止服务端故障时重试放大流量"""
+    def __init__(self, ratio: float = 0.2, min_reserve: int = 10):
+        self.ratio = ratio
+        # 额度上限：保底额度加上最近约100个请求存入的额度
+        self.capacity = min_reserve + ratio * 100
+        self.balance = float(min_reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.balance = min(self.capacity, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+
+@dataclass
+class LLMProvider:
+    """一个OpenAI兼容的API服务商"""
+    name: str
+    base_url: str
+    api_key: str
+    bucket: TokenBucket
+    retry_budget: RetryBudget = field(default_factory=RetryBudget)
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.base_url.rstrip('/')}/chat/completions"
+
+    @property
+    def embeddings_url(self) -> str:
+        return f"{self.base_url.rstrip('/')}/embeddings"
+
+
+@dataclass
+class ModelStats:
+    """单个模型的调用统计"""
+    calls: int = 0
+    failures: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class LLMGateway:
+    """所有大模型请求的统一出口
+
+    - 复用同一个aiohttp会话，保持长连接
+    - 每个模型一个信号量限制并发
+    - 每个服务商一个令牌桶限流，收到429时按Retry-After暂停整个服务商
+    - 带抖动的指数退避重试，并受重试预算约束
+    - 记录每个模型的耗时和token用量
+    """
+    _instance: Optional["LLMGateway"] = None
+
+    def __init__(self, providers: Dict[str, LLMProvider], model_concurrency: Optional[Dict[str, int]] = None,
+                 default_concurrency: int = 8, max_retries: int = 3, timeout: float = 120,
+                 base_delay: float = 2.0, max_delay: float = 60.0, connection_limit: int = 100):
+        self.providers = providers
+        self.model_concurrency = model_concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connection_limit = connection_limit
+        self.stats: Dict[str, ModelStats] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def initialize(cls, requests_per_minute: Optional[Dict[str, int]] = None, **kwargs) -> "LLMGateway":
+        """从环境变量读取服务商信息并创建全局实例，重复调用返回已有实例
+
+        Args:
+            requests_per_minute: 每个服务商每分钟最多请求数，0为不限制
+            **kwargs: 传给LLMGateway构造函数的其他参数
+        """
+        if cls._instance is None:
+            requests_per_minute = requests_per_minute or {}
+            providers = {}
+            for name, key_env, url_env in (
+                ("siliconflow", "SILICONFLOW_KEY", "SILICONFLOW_BASE_URL"),
+                ("deepseek", "DEEP_SEEK_KEY", "DEEP_SEEK_BASE_URL"),
+            ):
+                if os.getenv(url_env):
+                    providers[name] = LLMProvider(
+                        name=name,
+                        base_url=os.getenv(url_env),
+                        api_key=os.getenv(key_env),
+                        bucket=TokenBucket(requests_per_minute.get(name, 0)),
+                    )
+            cls._instance = cls(providers, **kwargs)
+        return cls._instance
+
+    @classmethod
+    def get_instance(cls) -> "LLMGateway":
+        if cls._instance is None:
+            raise RuntimeError("LLMGateway not initialized")
+        return cls._instance
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    def _get_semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(self.model_concurrency.get(model, self.default_concurrency))
+        return self._semaphores[model]
+
+    def _get_provider(self, provider: str) -> LLMProvider:
+        if provider not in self.providers:
+            raise LLMRequestError(f"未配置的大模型服务商: {provider}")
+        return self.providers[provider]
+
+    def _backoff(self, attempt: int) -> float:
+        """带抖动的指数退避，避免多个请求同时重试"""
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    async def chat_completion(self, model: str, messages: List[Dict[str, Any]], provider: str = "siliconflow",
+                              **params) -> Tuple[str, str]:
+        """调用chat/completions接口
+
+        Returns:
+            Tuple[str, str]: (回复内容, 推理内容)
+
+        Raises:
+            LLMRequestError: 请求最终失败
+        """
+        result = await self.request(model, messages, provider, **params)
+        if not result.get("choices"):
+            raise LLMRequestError(f"请求返回的内容无效: {result}")
+        message = result["choices"][0]["message"]
+        content = message.get("content") or ""
+        reasoning_content = message.get("reasoning_content") or message.get("reasoning") or ""
+        return content, reasoning_content
+
+    async def generate(self, prompt: str, model: str, provider: str = "siliconflow", **params) -> Tuple[str, str]:
+        """单条用户消息的便捷调用"""
+        return await self.chat_completion(model, [{"role": "user", "content": prompt}], provider, **params)
+
+    async def _open(self, llm_provider: LLMProvider, model: str, stats: ModelStats, data: Dict[str, Any],
+                    timeout: Optional[aiohttp.ClientTimeout] = None, url: Optional[str] = None) -> aiohttp.ClientResponse:
+        """发送请求直到拿到200响应，负责限流和重试；调用方需要负责释放返回的响应
+
+        url默认为chat/completions接口
+        """
+        headers = {
+            "Authorization": f"Bearer {llm_provider.api_key}",
+            "Content-Type": "application/json",
+        }
+        post_kwargs = {"headers": headers, "json": data}
+        if timeout is not None:
+            post_kwargs["timeout"] = timeout
+
+        for attempt in range(self.max_retries + 1):
+            await llm_provider.bucket.acquire()
+            try:
+                response = await self._get_session().post(url or llm_provider.chat_url, **post_kwargs)
+                if response.status == 200:
+                    return response
+
+                async with response:
+                    error_text = await response.text()
+                if response.status == 429:
+                    stats.rate_limited += 1
+                    retry_after = response.headers.get("Retry-After")
+                    wait_time = float(retry_after) if retry_after and retry_after.isdigit() else self._backoff(attempt)
+                    llm_provider.bucket.pause(wait_time)
+                    print(f"\033[1;33m[大模型]\033[0m {model} 遇到请求限制(429)，{wait_time:.1f}秒后重试")
+                elif response.status < 500:
+                    # 参数错误、鉴权失败等，重试也没用
+                    raise LLMRequestError(f"{model} 请求失败({response.status}): {error_text}", response.status)
+                else:
+                    wait_time = self._backoff(attempt)
+                    print(f"\033[1;33m[大模型]\033[0m {model} 服务端错误({response.status})，{wait_time:.1f}秒后重试")
+                last_error = LLMRequestError(f"{model} 请求失败({response.status}): {error_text}", response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                wait_time = self._backoff(attempt)
+                print(f"\033[1;33m[大模型]\033[0m {model} 请求出错: {str(e) or type(e).__name__}，{wait_time:.1f}秒后重试")
+                last_error = LLMRequestError(f"{model} 请求失败: {str(e) or type(e).__name__}")
+
+            if attempt == self.max_retries:
+                break
+            if not llm_provider.retry_budget.withdraw():
+                print(f"\033[1;31m[大模型]\033[0m {llm_provider.name} 重试预算已用尽，放弃重试")
+                break
+            stats.retries += 1
+            # 429的等待由令牌桶负责，其他错误在这里退避
+            if not llm_provider.bucket.paused_until > time.monotonic():
+                await asyncio.sleep(wait_time)
+        raise last_error
+
+    @staticmethod
+    def _record_usage(stats: ModelStats, result: Dict[str, Any]) -> None:
+        usage = result.get("usage") or {}
+        stats.prompt_tokens += usage.get("prompt_tokens", 0)
+        stats.completion_tokens += usage.get("completion_tokens", 0)
+
+    async def embeddings(self, model: str, inputs: List[str], provider: str = "siliconflow",
+                         batch_size: int = 32) -> List[List[float]]:
+        """批量获取文本向量，一次请求最多batch_size条，返回顺序与inputs一致"""
+        llm_provider = self._get_provider(provider)
+        results: List[List[float]] = []
+        for i in range(0, len(inputs), batch_size):
+            batch = inputs[i:i + batch_size]
+            data = {"model": model, "input": batch, "encoding_format": "float"}
+            result = await self.request(model, data=data, provider=provider, url=llm_provider.embeddings_url)
+            items = sorted(result.get("data") or [], key=lambda item: item.get("index", 0))
+            if len(items) != len(batch):
+                raise LLMRequestError(f"{model} 返回的向量数量({len(items)})与输入数量({len(batch)})不一致")
+            results.extend(item["embedding"] for item in items)
+        return results
+
+    async def request(self, model: str, messages: Optional[List[Dict[str, Any]]] = None, provider: str = "siliconflow",
+                      data: Optional[Dict[str, Any]] = None, url: Optional[str] = None, **params) -> Dict[str, Any]:
+        """发送请求并返回原始的响应json
+
+        默认请求chat/completions接口；其他接口（如embeddings）通过data和url指定完整的请求体和地址
+        """
+        llm_provider = self._get_provider(provider)
+        stats = self.stats.setdefault(model, ModelStats())
+        if data is None:
+            data = {"model": model, "messages": messages, **params}
+
+        start_time = time.time()
+        stats.calls += 1
+        llm_provider.retry_budget.deposit()
+        try:
+            async with self._get_semaphore(model):
+                response = await self._open(llm_provider, model, stats, data, url=url)
+                async with response:
+                    try:
+                        result = await response.json(content_type=None)
+                    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                        raise LLMRequestError(f"{model} 读取响应失败: {str(e) or type(e).__name__}")
+                self._record_usage(stats, result)
+                return result
+        except LLMRequestError:
+            stats.failures += 1
+            raise
+        finally:
+            latency = time.time() - start_time
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+
+    async def stream_chat_completion(self, model: str, messages: List[Dict[str, Any]], provider: str = "siliconflow",
+                                     **params) -> AsyncIterator[Tuple[str, str]]:
+        """以流式方式调用chat/completions接口，逐块产出(回复内容增量, 推理内容增量)
+
+        只有在收到第一块数据之前的失败会重试，开始输出后中断则直接抛出LLMRequestError
+        """
+        llm_provider = self._get_provider(provider)
+        stats = self.stats.setdefault(model, ModelStats())
+        data = {"model": model, "messages": messages, **params, "stream": True}
+        # 流式输出的总时长不设上限，只限制两块数据之间的间隔
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.timeout)
+
+        start_time = time.time()
+        stats.calls += 1
+        llm_provider.retry_budget.deposit()
+        try:
+            async with self._get_semaphore(model):
+                response = await self._open(llm_provider, model, stats, data, timeout)
+                async with response:
+                    try:
+                        async for raw_line in response.content:
+                            line = raw_line.decode("utf-8").strip()
+                            if not line.startswith("data:"):
+                                continue
+                            payload = line[len("data:"):].strip()
+                            if payload == "[DONE]":
+                                break
+                            chunk = json.loads(payload)
+                            self._record_usage(stats, chunk)
+                            if not chunk.get("choices"):
+                                continue
+                            delta = chunk["choices"][0].get("delta") or {}
+                            content = delta.get("content") or ""
+                            reasoning_content = delta.get("reasoning_content") or delta.get("reasoning") or ""
+                            if content or reasoning_content:
+                                yield content, reasoning_content
+                    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                        raise LLMRequestError(f"{model} 流式输出中断: {str(e) or type(e).__name__}")
+        except LLMRequestError:
+            stats.failures += 1
+            raise
+        finally:
+            latency = time.time() - start_time
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+
+    def generate_sync(self, prompt: str, model: str, provider: str = "siliconflow", **params) -> Tuple[str, str]:
+        """同步调用，供启动阶段等没有事件循环的地方使用
+
+        使用临时的会话和信号量（它们都绑定在事件循环上），但与全局实例共享令牌桶、重试预算和统计
+        """
+        async def _run():
+            gateway = LLMGateway(
+                self.providers, self.model_concurrency, self.default_concurrency, self.max_retries,
+                self.timeout, self.base_delay, self.max_delay, connection_limit=1,
+            )
+            gateway.stats = self.stats
+            try:
+                return await gateway.generate(prompt, model, provider, **params)
+            finally:
+                await gateway.close()
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(_run())
+        # 当前线程已有事件循环在运行，放到新线程里执行
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, _run()).result()
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def print_stats(self) -> None:
+        """打印每个模型的调用统计"""
+        print("\033[1;36m[大模型统计]\033[0m")
+        for model, stats in self.stats.items():
+            avg_latency = stats.total_latency / stats.calls if stats.calls else 0.0
+            print(
+                f"  {model} 调用:{stats.calls} 失败:{stats.failures} 重试:{stats.retries} 限流:{stats.rate_limited} "
+                f"平均耗时:{avg_latency:.2f}秒 最长耗时:{stats.max_latency:.2f}秒 "
+                f"输入token:{stats.prompt_tokens} 输出token:{stats.completion_tokens}"
+            )
@@ -2,13 +2,14 @@ from loguru import logger
 from nonebot import on_message, on_command, require, get_driver
 from nonebot.adapters.onebot.v11 import Bot, GroupMessageEvent, Message, MessageSegment
 from nonebot.typing import T_State
-from ...common.database import Database
+from ...common.database import Database, AsyncDatabase
+from ...common.database_indexes import ensure_indexes, get_index_registry
+from ...common.llm_gateway import LLMGateway
 from .config import global_config
 import os
 import asyncio
 import random
 from .relationship_manager import relationship_manager
-from ..schedule.schedule_generator import bot_schedule
 from .willing_manager import willing_manager
 
 # 获取驱动器
@@ -22,15 +23,30 @@ Database.initialize(
         password= os.getenv("MONGODB_PASSWORD"),
         auth_source=os.getenv("MONGODB_AUTH_SOURCE")
 )
+# 异步数据库，聊天主流程中的数据库操作都通过它在线程池中执行
+AsyncDatabase.initialize()
 print("\033[1;32m[初始化数据库完成]\033[0m")
 
+# 所有大模型请求共用的网关，需要在日程模块导入（会生成日程）之前初始化
+LLMGateway.initialize(
+    requests_per_minute=global_config.llm_requests_per_minute,
+    default_concurrency=global_config.llm_model_concurrency,
+    max_retries=global_config.llm_max_retries,
+    timeout=global_config.llm_timeout,
+)
+
 
 # 导入其他模块
+from ..schedule.schedule_generator import bot_schedule
 from .bot import ChatBot
 from .emoji_manager import emoji_manager
 from .message_send_control import message_sender
+from .storage import message_storage
+from .image_service import image_service
+from .message_stream import message_stream_container
 from .relationship_manager import relationship_manager
 from ..memory_system.memory import memory_graph,hippocampus
+from ..knowledege.vector_index import knowledge_index
 
 # 初始化表情管理器
 emoji_manager.initialize()
@@ -51,6 +67,30 @@ async def start_background_tasks():
     # 只启动表情包管理任务
     asyncio.create_task(emoji_manager.start_periodic_check(interval_MINS=global_config.EMOJI_CHECK_INTERVAL))
     bot_schedule.print_schedule()
+    # 加载内存表情目录，发表情时不再查询数据库
+    await emoji_manager.load_catalog()
+    # 在后台加载记忆图，加载完成前不影响收发消息
+    asyncio.create_task(AsyncDatabase.get_instance().run(memory_graph.initialize, global_config.memory_snapshot_path))
+    # 检查并创建数据库索引
+    await AsyncDatabase.get_instance().run(
+        ensure_indexes,
+        Database.get_instance().db,
+        get_index_registry(global_config.reasoning_log_ttl_days),
+        global_config.report_unused_indexes
+    )
+    # 加载知识库向量索引；本地存储只由知识库脚本写入，机器人只读，还没导入时从数据库加载
+    count = await AsyncDatabase.get_instance().run(knowledge_index.refresh, Database.get_instance().db.knowledges)
+    print(f"\033[1;32m[知识库]\033[0m 已加载{count}个知识片段")
+    # 第一次启动时从已有的消息补建时间桶统计，之后由消息存储维护
+    bucket_count = await AsyncDatabase.get_instance().run(hippocampus.sampler.backfill)
+    if bucket_count:
+        print(f"\033[1;32m[记忆构建]\033[0m 已从历史消息补建{bucket_count}个时间桶统计")
+    # 启动消息批量存储，并补写上次未写入数据库的消息
+    await message_storage.start()
+    # 从数据库加载各群最近的聊天记录作为上下文
+    await message_stream_container.hydrate(global_config.talk_allowed_groups, global_config.MAX_CONTEXT_SIZE)
+    # 启动消息处理流水线
+    await chat_bot._ensure_started()
     
 @driver.on_startup
 async def init_relationships():
@@ -72,6 +112,21 @@ async def _(bot: Bot):
     print("\033[1;38;5;208m-----------开始偷表情包！-----------\033[0m")
     # 启动消息发送控制任务
     
+@driver.on_shutdown
+async def stop_message_pipeline():
+    """关闭时停止消息处理流水线"""
+    chat_bot.pipeline.print_stats()
+    # 已收到的消息至少处理到存储阶段，之后写入数据库或溢出文件
+    await chat_bot.pipeline.stop(drain_until="persist")
+    # 写入缓冲区中剩余的消息
+    await message_storage.close()
+    await emoji_manager.flush_usage()
+    # 保存记忆图快照，下次启动时更快
+    await hippocampus.save_snapshot(global_config.memory_snapshot_path)
+    await image_service.close()
+    LLMGateway.get_instance().print_stats()
+    await LLMGateway.get_instance().close()
+    
 @group_msg.handle()
 async def _(bot: Bot, event: GroupMessageEvent, state: T_State):
     await chat_bot.handle_message(event, bot)
@@ -84,11 +139,32 @@ async def monitor_relationships():
 '''  
 
 # 添加build_memory定时任务
-@scheduler.scheduled_job("interval", seconds=global_config.build_memory_interval, id="build_memory")
+# max_instances=1 使上一次构建未完成时跳过本次调度，避免重叠
+@scheduler.scheduled_job("interval", seconds=global_config.build_memory_interval, id="build_memory", max_instances=1, coalesce=True)
 async def build_memory_task():
     """每30秒执行一次记忆构建"""
     print("\033[1;32m[记忆构建]\033[0m 开始构建记忆...")
-    hippocampus.build_memory(chat_size=12)
+    await hippocampus.build_memory(chat_size=12)
     print("\033[1;32m[记忆构建]\033[0m 记忆构建完成")
 
-  
+@scheduler.scheduled_job("interval", seconds=global_config.memory_forget_interval, id="forget_memory", max_instances=1, coalesce=True)
+async def forget_memory_task():
+    """定期整理一批记忆，防止记忆图无限增长"""
+    await hippocampus.forget_memory()
+
+@scheduler.scheduled_job("interval", seconds=global_config.memory_snapshot_interval, id="snapshot_memory", max_instances=1, coalesce=True)
+async def snapshot_memory_task():
+    """定期保存记忆图快照"""
+    await hippocampus.save_snapshot(global_config.memory_snapshot_path)
+
+@scheduler.scheduled_job("interval", seconds=global_config.emoji_usage_flush_interval, id="flush_emoji_usage", max_instances=1, coalesce=True)
+async def flush_emoji_usage_task():
+    """批量写入表情包使用次数"""
+    await emoji_manager.flush_usage()
+
+@scheduler.scheduled_job("interval", seconds=global_config.knowledge_refresh_interval, id="refresh_knowledge_index", max_instances=1, coalesce=True)
+async def refresh_knowledge_index_task():
+    """增量加载知识库脚本新写入的知识片段"""
+    count = await AsyncDatabase.get_instance().run(knowledge_index.refresh, Database.get_instance().db.knowledges)
+    if count:
+        print(f"\033[1;32m[知识库]\033[0m 新加载{count}个知识片段")
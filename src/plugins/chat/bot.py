@@ -1,50 +1,87 @@
 from nonebot.adapters.onebot.v11 import GroupMessageEvent, Message as EventMessage, Bot
 from .message import Message,MessageSet
 from .config import BotConfig, global_config
-from .storage import MessageStorage
+from .storage import message_storage
 from .llm_generator import LLMResponseGenerator
-from .message_stream import MessageStream, MessageStreamContainer
+from .message_stream import MessageStream, MessageStreamContainer, message_stream_container
 from .topic_identifier import topic_identifier
 from random import random, choice
 from .emoji_manager import emoji_manager  # 导入表情包管理器
 import time
 import os
+import asyncio
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Dict, List, Optional
 from .cq_code import CQCode  # 导入CQCode模块
+from .image_service import image_service
 from .message_send_control import message_sender  # 导入消息发送控制器
 from .message import Message_Thinking  # 导入 Message_Thinking 类
 from .relationship_manager import relationship_manager
 from .willing_manager import willing_manager  # 导入意愿管理器
 from .utils import is_mentioned_bot_in_txt, calculate_typing_time
-from ..memory_system.memory import memory_graph
+from ..memory_system.memory import memory_graph, RecallContext
+from .message_pipeline import MessagePipeline
+
+
+@dataclass
+class MessageContext:
+    """在流水线各阶段之间传递的消息上下文"""
+    event: GroupMessageEvent
+    bot: Bot
+    receive_time: float = field(default_factory=time.time)
+    group_info: Optional[Dict] = None
+    sender_info: Optional[Dict] = None
+    message: Optional[Message] = None
+    topic: Optional[List[str]] = None
+    interested_rate: float = 0.0
+    recall: Optional[RecallContext] = None  # 话题对应的记忆，构建prompt时复用
+    think_id: Optional[str] = None
+    tinking_time_point: Optional[float] = None
+
 
 class ChatBot:
     def __init__(self, config: BotConfig):
         self.config = config
-        self.storage = MessageStorage()
+        self.storage = message_storage
         self.gpt = LLMResponseGenerator(config)
         self.bot = None  # bot 实例引用
         self._started = False
         
         self.emoji_chance = 0.2  # 发送表情包的基础概率
-        self.message_streams = MessageStreamContainer()
+        self.message_streams = message_stream_container
         self.message_sender = message_sender
         
+        # 消息处理流水线：接收 → 补全信息 → 存储 → 决策 → 生成回复
+        self.pipeline = MessagePipeline()
+        self.pipeline.add_stage("ingest", self._ingest, config.pipeline_ingest_workers, config.pipeline_queue_size)
+        self.pipeline.add_stage("enrich", self._enrich, config.pipeline_enrich_workers, config.pipeline_queue_size)
+        self.pipeline.add_stage("persist", self._persist, config.pipeline_persist_workers, config.pipeline_queue_size)
+        self.pipeline.add_stage("decide", self._decide, config.pipeline_decide_workers, config.pipeline_queue_size)
+        self.pipeline.add_stage("generate", self._generate, config.pipeline_generate_workers, config.pipeline_queue_size)
+        
     async def _ensure_started(self):
         """确保所有任务已启动"""
         if not self._started:
-            # 只保留必要的任务
+            self.pipeline.start()
+            if self.config.pipeline_stats_interval > 0:
+                asyncio.create_task(self.pipeline.start_stats_reporter(self.config.pipeline_stats_interval))
             self._started = True
-                
 
     async def handle_message(self, event: GroupMessageEvent, bot: Bot) -> None:
-        """处理收到的群消息"""
-        
+        """处理收到的群消息，只负责把消息投递进流水线"""
+        await self._ensure_started()
+        await self.pipeline.submit(MessageContext(event=event, bot=bot))
+
+    async def _ingest(self, ctx: MessageContext) -> Optional[MessageContext]:
+        """接收阶段：过滤不需要处理的消息"""
+        event = ctx.event
         if event.group_id not in self.config.talk_allowed_groups:
-            return
-        self.bot = bot  # 更新 bot 实例
+            return None
+        self.bot = ctx.bot  # 更新 bot 实例
         
         if event.user_id in self.config.ban_user_id:
-            return
+            return None
         
         # 打印原始消息内容
         '''
@@ -72,48 +109,64 @@ class ChatBot:
             print(f"- raw_message: {event.reply.raw_message}")
             # print(f"- original_message: {event.reply.original_message}")
         '''
+        return ctx
 
+    async def _enrich(self, ctx: MessageContext) -> Optional[MessageContext]:
+        """补全阶段：获取群和发送者信息，解析消息内容"""
+        event = ctx.event
+        bot = ctx.bot
         
-        group_info = await bot.get_group_info(group_id=event.group_id)
-
-        
-        
-        sender_info = await bot.get_group_member_info(group_id=event.group_id, user_id=event.user_id, no_cache=True)
-        
+        ctx.group_info, ctx.sender_info = await asyncio.gather(
+            bot.get_group_info(group_id=event.group_id),
+            bot.get_group_member_info(group_id=event.group_id, user_id=event.user_id, no_cache=True),
+        )
 
-        await relationship_manager.update_relationship(user_id = event.user_id, data = sender_info)
+        await relationship_manager.update_relationship(user_id = event.user_id, data = ctx.sender_info)
         await relationship_manager.update_relationship_value(user_id = event.user_id, relationship_value = 0.5)
         # print(f"\033[1;32m[关系管理]\033[0m 更新关系值: {relationship_manager.get_relationship(event.user_id).relationship_value}")
         
-        
-        message = Message(
+        # 消息解析时会查询数据库（昵称等），放到线程池中执行，避免阻塞事件循环
+        loop = asyncio.get_event_loop()
+        ctx.message = await loop.run_in_executor(None, partial(
+            Message,
             group_id=event.group_id,
             user_id=event.user_id,
             message_id=event.message_id,
             raw_message=str(event.original_message), 
             plain_text=event.get_plaintext(),
             reply_message=event.reply,
+            group_name=(ctx.group_info or {}).get('group_name'),
+        ))
+        # 图片先用占位文本，短时间内识图完成就直接用描述，否则识图完成后再更新消息
+        await image_service.translate_message(
+            ctx.message,
+            self.config.image_describe_wait,
+            on_late_update=partial(self.storage.update_message_text, ctx.message)
         )
-        
-        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.time))
 
-        topic = topic_identifier.identify_topic_jieba(message.processed_plain_text)
-        print(f"\033[1;32m[主题识别]\033[0m 主题: {topic}")
-        
-        all_num = 0
-        interested_num = 0
-        if topic:
-            for current_topic in topic:
-                all_num += 1
-                first_layer_items, second_layer_items = memory_graph.get_related_item(current_topic, depth=2)
-                if first_layer_items:
-                    interested_num += 1
-                    print(f"\033[1;32m[前额叶]\033[0m 对|{current_topic}|有印象")
-        interested_rate = interested_num / all_num if all_num > 0 else 0
+        ctx.topic = topic_identifier.identify_topic_jieba(ctx.message.processed_plain_text)
+        print(f"\033[1;32m[主题识别]\033[0m 主题: {ctx.topic}")
+        return ctx
+
+    async def _persist(self, ctx: MessageContext) -> Optional[MessageContext]:
+        """存储阶段：将消息写入数据库，并加入该群的内存上下文"""
+        await self.storage.store_message(ctx.message, ctx.topic[0] if ctx.topic else None)
+        self.message_streams.add_message(ctx.message)
+        return ctx
+
+    async def _decide(self, ctx: MessageContext) -> Optional[MessageContext]:
+        """决策阶段：计算兴趣度和回复意愿，决定是否回复"""
+        event = ctx.event
+        message = ctx.message
+        topic = ctx.topic
         
-     
-        await self.storage.store_message(message, topic[0] if topic else None)
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.time))
         
+        ctx.recall = memory_graph.recall(topic, k=global_config.memory_recall_top_k)
+        interested_topics = ctx.recall.interested_topics
+        for current_topic in interested_topics:
+            print(f"\033[1;32m[前额叶]\033[0m 对|{current_topic}|有印象")
+        ctx.interested_rate = len(interested_topics) / len(ctx.recall.topics) if ctx.recall.topics else 0
 
         is_mentioned = is_mentioned_bot_in_txt(message.processed_plain_text)
         reply_probability = willing_manager.change_reply_willing_received(
@@ -123,56 +176,92 @@ class ChatBot:
             self.config,
             event.user_id,
             message.is_emoji,
-            interested_rate
+            ctx.interested_rate
         )
         current_willing = willing_manager.get_willing(event.group_id)
         
         
         print(f"\033[1;32m[{current_time}][{message.group_name}]{message.user_nickname}:\033[0m {message.processed_plain_text}\033[1;36m[回复意愿:{current_willing:.2f}][概率:{reply_probability:.1f}]\033[0m")
-        response = ""
+        
+        if random() >= reply_probability:
+            # 如果收到新消息，提高回复意愿
+            willing_manager.change_reply_willing_after_sent(event.group_id)
+            return None
+        
         # 创建思考消息
-        if random() < reply_probability:
-            
-            tinking_time_point = round(time.time(), 2)
-            think_id = 'mt' + str(tinking_time_point)
-            thinking_message = Message_Thinking(message=message,message_id=think_id)
-            message_sender.send_temp_container.add_message(thinking_message)
+        ctx.tinking_time_point = round(time.time(), 2)
+        ctx.think_id = 'mt' + str(ctx.tinking_time_point)
+        thinking_message = Message_Thinking(message=message,message_id=ctx.think_id)
+        message_sender.send_temp_container.add_message(thinking_message)
 
-            willing_manager.change_reply_willing_sent(thinking_message.group_id)
-            
-            response, emotion = await self.gpt.generate_response(message)
-            
-            # 如果生成了回复，发送并记录
-            
+        willing_manager.change_reply_willing_sent(thinking_message.group_id)
+        return ctx
+
+    def _create_bot_message(self, ctx: MessageContext, msg: str, timepoint: float) -> Message:
+        """创建机器人回复的一条消息"""
+        return Message(
+            group_id=ctx.event.group_id,
+            user_id=self.config.BOT_QQ,
+            message_id=ctx.think_id,
+            message_based_id=ctx.event.message_id,
+            raw_message=msg,
+            plain_text=msg,
+            processed_plain_text=msg,
+            user_nickname=global_config.BOT_NICKNAME,
+            group_name=ctx.message.group_name,
+            time=timepoint
+        )
+
+    async def _generate_streaming(self, ctx: MessageContext):
+        """流式生成回复：每切出一句就放入发送队列，第一句替换思考消息"""
+        accu_typing_time = 0
+        sent_count = 0
+        
+        def on_sentence(msg: str) -> bool:
+            nonlocal accu_typing_time, sent_count
+            print(f"当前消息: {msg}")
+            accu_typing_time += calculate_typing_time(msg)
+            bot_message = self._create_bot_message(ctx, msg, ctx.tinking_time_point + accu_typing_time)
+            if sent_count == 0:
+                # 思考消息已经超时被移除时，不再发送后续内容
+                if not message_sender.send_temp_container.update_thinking_message(bot_message):
+                    return False
+            else:
+                message_sender.send_temp_container.add_message(bot_message)
+            sent_count += 1
+            return True
+        
+        return await self.gpt.generate_response_stream(ctx.message, on_sentence, recall=ctx.recall)
+
+    async def _generate(self, ctx: MessageContext) -> None:
+        """生成阶段：调用大模型生成回复并放入发送队列"""
+        event = ctx.event
+        message = ctx.message
+        think_id = ctx.think_id
+        tinking_time_point = ctx.tinking_time_point
+        
+        if self.config.stream_response:
+            response, emotion = await self._generate_streaming(ctx)
+        else:
+            response, emotion = await self.gpt.generate_response(message, recall=ctx.recall)
             
+            # 如果生成了回复，整体放入发送队列
+            if response:
+                message_set = MessageSet(event.group_id, self.config.BOT_QQ, think_id)
+                accu_typing_time = 0
+                for msg in response:
+                    print(f"当前消息: {msg}")
+                    typing_time = calculate_typing_time(msg)
+                    accu_typing_time += typing_time
+                    timepoint = tinking_time_point+accu_typing_time
+                    # print(f"\033[1;32m[调试]\033[0m 消息: {msg}，添加！, 累计打字时间: {accu_typing_time:.2f}秒")
+                    
+                    message_set.add_message(self._create_bot_message(ctx, msg, timepoint))
+                    
+                message_sender.send_temp_container.update_thinking_message(message_set)
+
+        # 发送表情包
         if response:
-            message_set = MessageSet(event.group_id, self.config.BOT_QQ, think_id)
-            accu_typing_time = 0
-            for msg in response:
-                print(f"当前消息: {msg}")
-                typing_time = calculate_typing_time(msg)
-                accu_typing_time += typing_time
-                timepoint = tinking_time_point+accu_typing_time
-                # print(f"\033[1;32m[调试]\033[0m 消息: {msg}，添加！, 累计打字时间: {accu_typing_time:.2f}秒")
-                
-                bot_message = Message(
-                    group_id=event.group_id,
-                    user_id=self.config.BOT_QQ,
-                    message_id=think_id,
-                    message_based_id=event.message_id,
-                    raw_message=msg,
-                    plain_text=msg,
-                    processed_plain_text=msg,
-                    user_nickname=global_config.BOT_NICKNAME,
-                    group_name=message.group_name,
-                    time=timepoint
-                )
-                message_set.add_message(bot_message)
-                
-            message_sender.send_temp_container.update_thinking_message(message_set)
-
-    
-            
             bot_response_time = tinking_time_point
             if random() < self.config.emoji_chance:
                 emoji_path = await emoji_manager.get_emoji_for_emotion(emotion)
@@ -200,4 +289,4 @@ class ChatBot:
                     message_sender.send_temp_container.add_message(bot_message)
         
         # 如果收到新消息，提高回复意愿
-        willing_manager.change_reply_willing_after_sent(event.group_id)
\ No newline at end of file
+        willing_manager.change_reply_willing_after_sent(event.group_id)
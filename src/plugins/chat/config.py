@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, Any, Optional, Set
 import os
 from nonebot.log import logger, default_format
@@ -22,22 +22,83 @@ class BotConfig:
     emoji_chance: float = 0.2  # 发送表情包的基础概率
     
     ENABLE_PIC_TRANSLATE: bool = True  # 是否启用图片翻译
+    image_max_size_kb: int = 5120  # 下载图片的大小上限（KB）
+    image_download_timeout: float = 15  # 下载一张图片的超时时间（秒）
+    image_download_concurrency: int = 4  # 同时下载的图片数
+    image_describe_wait: float = 3.0  # 处理消息时最多等待识图的时间（秒），超时先用占位文本，识图完成后再更新
+    image_cache_size: int = 2048  # 内存中缓存的图片描述条数
+    image_negative_ttl: float = 3600  # 识图失败的结果缓存多久（秒），期间同一张图片不再重试
     
     talk_allowed_groups = set()
     talk_frequency_down_groups = set()
     ban_user_id = set()
     
     build_memory_interval: int = 60  # 记忆构建间隔（秒）
+    memory_build_concurrency: int = 3  # 记忆构建时同时进行的大模型请求数
+    memory_graph_engine: str = "networkx"  # 记忆图的存储方式，networkx或compact
+    memory_recall_top_k: int = 1  # 回复时写进prompt的记忆条数
+    memory_forget_interval: int = 600  # 记忆整理间隔（秒）
+    memory_forget_batch_size: int = 2000  # 每次整理的概念数，整张图分多次轮流整理
+    memory_edge_half_life: float = 30  # 概念之间连接次数的半衰期（天）
+    memory_min_edge_weight: float = 0.5  # 连接次数衰减到低于这个值时删除连接
+    memory_max_items: int = 20  # 每个概念最多保留的记忆条数
+    memory_merge_similarity: float = 0.8  # 相似度不低于这个值的记忆只保留较新的一条
+    memory_snapshot_path: str = "data/memory_graph.snapshot"  # 记忆图快照文件，启动时优先从快照加载
+    memory_snapshot_interval: int = 3600  # 保存记忆图快照的间隔（秒）
+    memory_sample_bucket_seconds: int = 600  # 记忆构建取样时按多长时间统计一次各群的消息数（秒）
+    memory_sample_min_messages: int = 5  # 时间桶中未压缩的消息少于这个数时不取样
     EMOJI_CHECK_INTERVAL: int = 120  # 表情包检查间隔（分钟）
     EMOJI_REGISTER_INTERVAL: int = 10  # 表情包注册间隔（分钟）
+    emoji_dedup_distance: int = 6  # 感知哈希（64位）相差不超过这么多位的表情包视为重复
+    emoji_reuse_cooldown: float = 600  # 刚发过的表情包在这段时间内（秒）越近越不容易再被选中
+    emoji_usage_flush_interval: int = 60  # 表情包使用次数写入数据库的间隔（秒）
+    emoji_tag_concurrency: int = 4  # 注册表情包时同时进行的识图打标签请求数
     
     API_USING: str = "siliconflow"  # 使用的API
     MODEL_R1_PROBABILITY: float = 0.8  # R1模型概率
     MODEL_V3_PROBABILITY: float = 0.1  # V3模型概率
     MODEL_R1_DISTILL_PROBABILITY: float = 0.1  # R1蒸馏模型概率
+    stream_response: bool = False  # 是否流式生成回复，边生成边发送
     
     enable_advance_output: bool = False  # 是否启用高级输出
     
+    # 数据库相关配置
+    reasoning_log_ttl_days: int = 30  # 推理日志保留天数，0为永久保留
+    report_unused_indexes: bool = True  # 启动时是否报告未使用的索引
+    
+    # 消息存储相关配置
+    message_batch_size: int = 50  # 攒够多少条消息批量写入数据库
+    message_flush_interval: float = 2.0  # 最长多少秒写入一次数据库
+    message_spill_path: str = "data/message_spill.jsonl"  # 未写入数据库的消息的本地备份文件
+    
+    # 消息处理流水线相关配置
+    pipeline_queue_size: int = 100  # 每个阶段的队列长度上限
+    pipeline_ingest_workers: int = 1  # 接收阶段并发数
+    pipeline_enrich_workers: int = 4  # 信息补全阶段并发数
+    pipeline_persist_workers: int = 2  # 存储阶段并发数
+    pipeline_decide_workers: int = 1  # 回复决策阶段并发数
+    pipeline_generate_workers: int = 8  # 回复生成阶段并发数
+    pipeline_stats_interval: int = 300  # 流水线统计输出间隔（秒），0为不输出
+    
+    # 大模型请求相关配置
+    llm_requests_per_minute: Dict[str, int] = field(default_factory=lambda: {"siliconflow": 1000, "deepseek": 0})  # 每个服务商每分钟最多请求数，0为不限制
+    llm_model_concurrency: int = 8  # 每个模型同时进行的请求数
+    llm_max_retries: int = 3  # 请求失败后最多重试次数
+    llm_timeout: float = 120  # 单次请求超时时间（秒）
+    
+    # 文本向量相关配置
+    embedding_cache_size: int = 4096  # 内存中缓存的向量条数
+    embedding_cache_path: str = "data/embedding_cache.db"  # 本地向量缓存文件，留空则不使用
+    
+    # 知识库相关配置
+    knowledge_index_mode: str = "flat"  # 向量索引类型，flat为精确搜索，ivf为分簇近似搜索
+    knowledge_index_nprobe: int = 8  # ivf模式下每次搜索的簇数
+    knowledge_refresh_interval: int = 300  # 从数据库加载新知识片段的间隔（秒）
+    knowledge_store_path: str = "data/knowledge_store"  # 知识片段向量的本地存储目录，留空则向量保存在数据库中
+    knowledge_store_dtype: str = "float16"  # 本地存储的向量精度，float16或float32
+    knowledge_chunk_size: int = 300  # 知识片段的最大字数
+    knowledge_chunk_overlap: int = 50  # 相邻知识片段重叠的最大字数
+    
     @staticmethod
     def get_default_config_path() -> str:
         """获取默认配置文件路径"""
@@ -62,10 +123,20 @@ class BotConfig:
                 emoji_config = toml_dict["emoji"]
                 config.EMOJI_CHECK_INTERVAL = emoji_config.get("check_interval", config.EMOJI_CHECK_INTERVAL)
                 config.EMOJI_REGISTER_INTERVAL = emoji_config.get("register_interval", config.EMOJI_REGISTER_INTERVAL)
+                config.emoji_dedup_distance = emoji_config.get("dedup_distance", config.emoji_dedup_distance)
+                config.emoji_reuse_cooldown = emoji_config.get("reuse_cooldown", config.emoji_reuse_cooldown)
+                config.emoji_usage_flush_interval = emoji_config.get("usage_flush_interval", config.emoji_usage_flush_interval)
+                config.emoji_tag_concurrency = emoji_config.get("tag_concurrency", config.emoji_tag_concurrency)
             
             if "cq_code" in toml_dict:
                 cq_code_config = toml_dict["cq_code"]
                 config.ENABLE_PIC_TRANSLATE = cq_code_config.get("enable_pic_translate", config.ENABLE_PIC_TRANSLATE)
+                config.image_max_size_kb = cq_code_config.get("image_max_size_kb", config.image_max_size_kb)
+                config.image_download_timeout = cq_code_config.get("image_download_timeout", config.image_download_timeout)
+                config.image_download_concurrency = cq_code_config.get("image_download_concurrency", config.image_download_concurrency)
+                config.image_describe_wait = cq_code_config.get("image_describe_wait", config.image_describe_wait)
+                config.image_cache_size = cq_code_config.get("image_cache_size", config.image_cache_size)
+                config.image_negative_ttl = cq_code_config.get("image_negative_ttl", config.image_negative_ttl)
             
             # 机器人基础配置
             if "bot" in toml_dict:
@@ -80,6 +151,7 @@ class BotConfig:
                 config.MODEL_V3_PROBABILITY = response_config.get("model_v3_probability", config.MODEL_V3_PROBABILITY)
                 config.MODEL_R1_DISTILL_PROBABILITY = response_config.get("model_r1_distill_probability", config.MODEL_R1_DISTILL_PROBABILITY)
                 config.API_USING = response_config.get("api_using", config.API_USING)
+                config.stream_response = response_config.get("stream", config.stream_response)
                 
             # 消息配置
             if "message" in toml_dict:
@@ -91,6 +163,19 @@ class BotConfig:
             if "memory" in toml_dict:
                 memory_config = toml_dict["memory"]
                 config.build_memory_interval = memory_config.get("build_memory_interval", config.build_memory_interval)
+                config.memory_build_concurrency = memory_config.get("build_concurrency", config.memory_build_concurrency)
+                config.memory_graph_engine = memory_config.get("graph_engine", config.memory_graph_engine)
+                config.memory_recall_top_k = memory_config.get("recall_top_k", config.memory_recall_top_k)
+                config.memory_forget_interval = memory_config.get("forget_interval", config.memory_forget_interval)
+                config.memory_forget_batch_size = memory_config.get("forget_batch_size", config.memory_forget_batch_size)
+                config.memory_edge_half_life = memory_config.get("edge_half_life", config.memory_edge_half_life)
+                config.memory_min_edge_weight = memory_config.get("min_edge_weight", config.memory_min_edge_weight)
+                config.memory_max_items = memory_config.get("max_items", config.memory_max_items)
+                config.memory_merge_similarity = memory_config.get("merge_similarity", config.memory_merge_similarity)
+                config.memory_snapshot_path = memory_config.get("snapshot_path", config.memory_snapshot_path)
+                config.memory_snapshot_interval = memory_config.get("snapshot_interval", config.memory_snapshot_interval)
+                config.memory_sample_bucket_seconds = memory_config.get("sample_bucket_seconds", config.memory_sample_bucket_seconds)
+                config.memory_sample_min_messages = memory_config.get("sample_min_messages", config.memory_sample_min_messages)
             
             # 群组配置
             if "groups" in toml_dict:
@@ -99,6 +184,49 @@ class BotConfig:
                 config.talk_frequency_down_groups = set(groups_config.get("talk_frequency_down", []))
                 config.ban_user_id = set(groups_config.get("ban_user_id", []))
             
+            if "database" in toml_dict:
+                database_config = toml_dict["database"]
+                config.reasoning_log_ttl_days = database_config.get("reasoning_log_ttl_days", config.reasoning_log_ttl_days)
+                config.report_unused_indexes = database_config.get("report_unused_indexes", config.report_unused_indexes)
+            
+            if "storage" in toml_dict:
+                storage_config = toml_dict["storage"]
+                config.message_batch_size = storage_config.get("batch_size", config.message_batch_size)
+                config.message_flush_interval = storage_config.get("flush_interval", config.message_flush_interval)
+                config.message_spill_path = storage_config.get("spill_path", config.message_spill_path)
+            
+            if "pipeline" in toml_dict:
+                pipeline_config = toml_dict["pipeline"]
+                config.pipeline_queue_size = pipeline_config.get("queue_size", config.pipeline_queue_size)
+                config.pipeline_ingest_workers = pipeline_config.get("ingest_workers", config.pipeline_ingest_workers)
+                config.pipeline_enrich_workers = pipeline_config.get("enrich_workers", config.pipeline_enrich_workers)
+                config.pipeline_persist_workers = pipeline_config.get("persist_workers", config.pipeline_persist_workers)
+                config.pipeline_decide_workers = pipeline_config.get("decide_workers", config.pipeline_decide_workers)
+                config.pipeline_generate_workers = pipeline_config.get("generate_workers", config.pipeline_generate_workers)
+                config.pipeline_stats_interval = pipeline_config.get("stats_interval", config.pipeline_stats_interval)
+            
+            if "llm" in toml_dict:
+                llm_gateway_config = toml_dict["llm"]
+                config.llm_requests_per_minute.update(llm_gateway_config.get("requests_per_minute", {}))
+                config.llm_model_concurrency = llm_gateway_config.get("model_concurrency", config.llm_model_concurrency)
+                config.llm_max_retries = llm_gateway_config.get("max_retries", config.llm_max_retries)
+                config.llm_timeout = llm_gateway_config.get("timeout", config.llm_timeout)
+            
+            if "embedding" in toml_dict:
+                embedding_config = toml_dict["embedding"]
+                config.embedding_cache_size = embedding_config.get("cache_size", config.embedding_cache_size)
+                config.embedding_cache_path = embedding_config.get("cache_path", config.embedding_cache_path)
+            
+            if "knowledge" in toml_dict:
+                knowledge_config = toml_dict["knowledge"]
+                config.knowledge_index_mode = knowledge_config.get("index_mode", config.knowledge_index_mode)
+                config.knowledge_index_nprobe = knowledge_config.get("nprobe", config.knowledge_index_nprobe)
+                config.knowledge_refresh_interval = knowledge_config.get("refresh_interval", config.knowledge_refresh_interval)
+                config.knowledge_store_path = knowledge_config.get("store_path", config.knowledge_store_path)
+                config.knowledge_store_dtype = knowledge_config.get("store_dtype", config.knowledge_store_dtype)
+                config.knowledge_chunk_size = knowledge_config.get("chunk_size", config.knowledge_chunk_size)
+                config.knowledge_chunk_overlap = knowledge_config.get("chunk_overlap", config.knowledge_chunk_overlap)
+            
             if "others" in toml_dict:
                 others_config = toml_dict["others"]
                 config.enable_advance_output = others_config.get("enable_advance_output", config.enable_advance_output)
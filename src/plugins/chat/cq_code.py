@@ -1,36 +1,14 @@
 from dataclasses import dataclass
 from typing import Dict, Optional, List, Union
-import html
-import requests
-import base64
-from PIL import Image
 import os
 from random import random
 from nonebot.adapters.onebot.v11 import Bot
 from .config import global_config, llm_config
 import time
 import asyncio
-from .utils_image import storage_image,storage_emoji
 from .utils_user import get_user_nickname
 #解析各种CQ码
 #包含CQ码类
-import urllib3
-from urllib3.util import create_urllib3_context
-
-# TLS1.3特殊处理 https://github.com/psf/requests/issues/6616
-ctx = create_urllib3_context()
-ctx.load_default_certs()
-ctx.set_ciphers("AES128-GCM-SHA256")
-
-class TencentSSLAdapter(requests.adapters.HTTPAdapter):
-    def __init__(self, ssl_context=None, **kwargs):
-        self.ssl_context = ssl_context
-        super().__init__(**kwargs)
-
-    def init_poolmanager(self, connections, maxsize, block=False):
-        self.poolmanager = urllib3.poolmanager.PoolManager(
-            num_pools=connections, maxsize=maxsize,
-            block=block, ssl_context=self.ssl_context)
 
 @dataclass
 class CQCode:
@@ -52,7 +30,9 @@ class CQCode:
     user_nickname: str = ""
     translated_plain_text: Optional[str] = None
     reply_message: Dict = None  # 存储回复消息
-    image_base64: Optional[str] = None
+    image_url: Optional[str] = None  # 待下载识图的图片地址，由图片服务异步处理
+    image_kind: Optional[str] = None  # image 或 emoji
+    image_file: Optional[str] = None  # QQ图片的file id，相同图片通常相同，用来查识图缓存
 
     def translate(self):
         """根据CQ码类型进行相应的翻译处理"""
@@ -80,190 +60,25 @@ class CQCode:
         else:
             self.translated_plain_text = f"[{self.type}]"
 
-    def get_img(self):
-        '''
-        headers = {
-            'User-Agent': 'QQ/8.9.68.11565 CFNetwork/1220.1 Darwin/20.3.0',
-            'Accept': 'image/*;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Cache-Control': 'no-cache',
-            'Pragma': 'no-cache'
-        }
-        '''
-        # 腾讯专用请求头配置
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.87 Safari/537.36',
-            'Accept': 'text/html, application/xhtml xml, */*',
-            'Accept-Encoding': 'gbk, GB2312',
-            'Accept-Language': 'zh-cn',
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Cache-Control': 'no-cache'
-        }
-        url = html.unescape(self.params['url'])
-        if not url.startswith(('http://', 'https://')):
-            return None
-
-        # 创建专用会话
-        session = requests.session()
-        session.adapters.pop("https://", None)
-        session.mount("https://", TencentSSLAdapter(ctx))
-
-        max_retries = 3
-        for retry in range(max_retries):
-            try:
-                response = session.get(
-                    url,
-                    headers=headers,
-                    timeout=15,
-                    allow_redirects=True,
-                    stream=True  # 流式传输避免大内存问题
-                )
-
-                # 腾讯服务器特殊状态码处理
-                if response.status_code == 400 and 'multimedia.nt.qq.com.cn' in url:
-                    return None
-                    
-                if response.status_code != 200:
-                    raise requests.exceptions.HTTPError(f"HTTP {response.status_code}")
-
-                # 验证内容类型
-                content_type = response.headers.get('Content-Type', '')
-                if not content_type.startswith('image/'):
-                    raise ValueError(f"非图片内容类型: {content_type}")
-
-                # 转换为Base64
-                image_base64 = base64.b64encode(response.content).decode('utf-8')
-                self.image_base64 = image_base64
-                return image_base64
-
-            except (requests.exceptions.SSLError, requests.exceptions.HTTPError) as e:
-                if retry == max_retries - 1:
-                    print(f"\033[1;31m[致命错误]\033[0m 最终请求失败: {str(e)}")
-                time.sleep(1.5 ** retry)  # 指数退避
-
-            except Exception as e:
-                print(f"\033[1;33m[未知错误]\033[0m {str(e)}")
-                return None
-
-        return None
-    
     def translate_emoji(self) -> str:
-        """处理表情包类型的CQ码"""
+        """处理表情包类型的CQ码，先返回占位文本，下载和识图由图片服务异步完成"""
         if 'url' not in self.params:
             return '[表情包]'
-        base64_str = self.get_img()
-        if base64_str:
-            # 将 base64 字符串转换为字节类型
-            image_bytes = base64.b64decode(base64_str)
-            storage_emoji(image_bytes)
-            return self.get_image_description(base64_str)
-        else:
-            return '[表情包]'
+        self.image_url = self.params['url']
+        self.image_kind = 'emoji'
+        self.image_file = self.params.get('file')
+        return '[表情包]'
     
     
     def translate_image(self) -> str:
-        """处理图片类型的CQ码，区分普通图片和表情包"""
+        """处理图片类型的CQ码，先返回占位文本，下载和识图由图片服务异步完成"""
         #没有url，直接返回默认文本
         if 'url' not in self.params:
             return '[图片]'
-        base64_str = self.get_img()
-        if base64_str:
-            image_bytes = base64.b64decode(base64_str)
-            storage_image(image_bytes)
-            return self.get_image_description(base64_str)
-        else:
-            return '[图片]'
-
-    def get_emoji_description(self, image_base64: str) -> str:
-        """调用AI接口获取表情包描述"""
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {llm_config.SILICONFLOW_API_KEY}"
-        }
-        
-        payload = {
-            "model": "deepseek-ai/deepseek-vl2",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "这是一个表情包，请用简短的中文描述这个表情包传达的情感和含义。最多20个字。"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 50,
-            "temperature": 0.4
-        }
-        
-        response = requests.post(
-            f"{llm_config.SILICONFLOW_BASE_URL}chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result_json = response.json()
-            if "choices" in result_json and len(result_json["choices"]) > 0:
-                description = result_json["choices"][0]["message"]["content"]
-                return f"[表情包：{description}]"
-        
-        raise ValueError(f"AI接口调用失败: {response.text}")
-
-    def get_image_description(self, image_base64: str) -> str:
-        """调用AI接口获取普通图片描述"""
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {llm_config.SILICONFLOW_API_KEY}"
-        }
-        
-        payload = {
-            "model": "deepseek-ai/deepseek-vl2",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "请用中文描述这张图片的内容。如果有文字，请把文字都描述出来。并尝试猜测这个图片的含义。最多200个字。"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 300,
-            "temperature": 0.6
-        }
-        
-        response = requests.post(
-            f"{llm_config.SILICONFLOW_BASE_URL}chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result_json = response.json()
-            if "choices" in result_json and len(result_json["choices"]) > 0:
-                description = result_json["choices"][0]["message"]["content"]
-                return f"[图片：{description}]"
-        
-        raise ValueError(f"AI接口调用失败: {response.text}")
+        self.image_url = self.params['url']
+        self.image_kind = 'image'
+        self.image_file = self.params.get('file')
+        return '[图片]'
     
     def translate_forward(self) -> str:
         """处理转发消息"""
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ...common.llm_gateway import LLMGateway, LLMRequestError
+from .config import global_config
+
+
+def normalize_text(text: str) -> str:
+    """统一全半角、大小写和空白，让同一句话的不同写法命中同一条缓存"""
+    text = unicodedata.normalize("NFKC", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.lower()
+
+
+class EmbeddingClient:
+    """带缓存的文本向量客户端
+
+    先查内存LRU，再查本地sqlite缓存，都没有的文本合并成一次请求发给接口
+    """
+    def __init__(self, model: str = "BAAI/bge-m3", provider: str = "siliconflow",
+                 max_memory_items: int = 4096, cache_path: Optional[str] = "data/embedding_cache.db"):
+        self.model = model
+        self.provider = provider
+        self.max_memory_items = max_memory_items
+        self.cache_path = cache_path
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        # sqlite连接只在这一个线程中使用
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding_cache")
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.cache_path)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        return self._conn
+
+    def _load_from_disk(self, keys: List[str]) -> Dict[str, List[float]]:
+        conn = self._get_conn()
+        placeholders = ",".join("?" * len(keys))
+        rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys).fetchall()
+        return {key: np.frombuffer(vector, dtype=np.float32).tolist() for key, vector in rows}
+
+    def _save_to_disk(self, items: Dict[str, List[float]]) -> None:
+        conn = self._get_conn()
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()],
+        )
+        conn.commit()
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    async def get_embeddings(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """批量获取文本向量，获取失败的位置为None"""
+        keys = [self._key(text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        for key in keys:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                found[key] = self._memory[key]
+                self.hits += 1
+
+        loop = asyncio.get_running_loop()
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing and self.cache_path:
+            try:
+                from_disk = await loop.run_in_executor(self._executor, self._load_from_disk, missing)
+            except sqlite3.Error as e:
+                print(f"\033[1;31m[向量缓存]\033[0m 读取本地缓存失败: {str(e)}")
+                from_disk = {}
+            for key, vector in from_disk.items():
+                found[key] = vector
+                self._remember(key, vector)
+            self.disk_hits += len(from_disk)
+
+        # 剩下的文本合并成一次请求
+        to_request: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in to_request:
+                to_request[key] = text
+        if to_request:
+            self.misses += len(to_request)
+            try:
+                vectors = await LLMGateway.get_instance().embeddings(self.model, list(to_request.values()), self.provider)
+            except LLMRequestError as e:
+                print(f"\033[1;31m[向量]\033[0m 获取向量失败: {str(e)}")
+                vectors = []
+            new_items = dict(zip(to_request.keys(), vectors))
+            for key, vector in new_items.items():
+                found[key] = vector
+                self._remember(key, vector)
+            if new_items and self.cache_path:
+                try:
+                    await loop.run_in_executor(self._executor, self._save_to_disk, new_items)
+                except sqlite3.Error as e:
+                    print(f"\033[1;31m[向量缓存]\033[0m 写入本地缓存失败: {str(e)}")
+
+        return [found.get(key) for key in keys]
+
+    async def get_embedding(self, text: str) -> Optional[List[float]]:
+        """获取单条文本的向量"""
+        return (await self.get_embeddings([text]))[0]
+
+
+embedding_client = EmbeddingClient(
+    max_memory_items=global_config.embedding_cache_size,
+    cache_path=global_config.embedding_cache_path or None,
+)
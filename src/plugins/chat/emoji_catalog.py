@@ -0,0 +1,162 @@
+import math
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+
+class AliasTable:
+    """Vose别名表，建表O(n)，按权重抽样O(1)"""
+
+    def __init__(self, weights: List[float]):
+        n = len(weights)
+        total = sum(weights)
+        self._prob = [0.0] * n
+        self._alias = [0] * n
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def sample(self, rng: random.Random) -> int:
+        i = rng.randrange(len(self._prob))
+        return i if rng.random() < self._prob[i] else self._alias[i]
+
+
+class EmojiCatalog:
+    """内存中的表情包目录，按情感标签分桶
+
+    - 每个标签一张别名表，用得越多的表情权重越低，表情变化或使用次数写入后才重建
+    - 刚用过的表情在reuse_cooldown秒内按比例拒绝重抽，避免连续发同一个
+    - 使用次数先记在内存，由flush_usage批量写入数据库
+    """
+    MAX_ATTEMPTS = 8
+
+    def __init__(self, reuse_cooldown: float = 600, rng: Optional[random.Random] = None):
+        self.reuse_cooldown = reuse_cooldown
+        self.rng = rng or random.Random()
+        self._emojis: Dict = {}  # _id -> 数据库记录（只保留 _id/filename/path/tags/usage_count）
+        self._buckets: Dict[Optional[str], List] = defaultdict(list)  # 标签 -> _id列表，None为所有表情
+        self._tables: Dict[str, AliasTable] = {}  # 标签 -> 别名表，桶变化后删除，用到时重建
+        self._last_used: Dict = {}
+        self._pending_usage: Counter = Counter()
+        self.loaded = False
+
+    @staticmethod
+    def _weight(emoji: dict) -> float:
+        return 1.0 / math.sqrt(1 + emoji.get('usage_count', 0))
+
+    @staticmethod
+    def _bucket_keys(record: dict) -> List[Optional[str]]:
+        return [None] + list(record.get('tags') or [])
+
+    def load(self, db) -> int:
+        """从数据库加载全部表情包（同步方法，应在线程池中调用），返回数量"""
+        records = list(db.db.emoji.find({'path': {'$exists': True}},
+                                        {'filename': 1, 'path': 1, 'tags': 1, 'usage_count': 1}))
+        emojis = {record['_id']: record for record in records}
+        buckets = defaultdict(list)
+        for emoji_id, record in emojis.items():
+            for tag in self._bucket_keys(record):
+                buckets[tag].append(emoji_id)
+        # 整体替换，加载期间的查询仍使用旧数据
+        self._emojis, self._buckets, self._tables = emojis, buckets, {}
+        self.loaded = True
+        return len(emojis)
+
+    def add(self, records: Iterable[dict]) -> None:
+        """加入新注册的表情包"""
+        for record in records:
+            if record['_id'] in self._emojis:
+                continue
+            self._emojis[record['_id']] = record
+            for tag in self._bucket_keys(record):
+                self._buckets[tag].append(record['_id'])
+                self._tables.pop(tag, None)
+
+    def remove(self, emoji_ids: Iterable) -> None:
+        """移除文件已被删除的表情包"""
+        for emoji_id in emoji_ids:
+            record = self._emojis.pop(emoji_id, None)
+            if record is None:
+                continue
+            self._last_used.pop(emoji_id, None)
+            for tag in self._bucket_keys(record):
+                if emoji_id in self._buckets.get(tag, []):
+                    self._buckets[tag].remove(emoji_id)
+                    self._tables.pop(tag, None)
+
+    def _table(self, tag: Optional[str]) -> Optional[AliasTable]:
+        bucket = self._buckets.get(tag)
+        if not bucket:
+            return None
+        if tag not in self._tables:
+            self._tables[tag] = AliasTable([self._weight(self._emojis[emoji_id]) for emoji_id in bucket])
+        return self._tables[tag]
+
+    def _sample_tag(self, tag: Optional[str]) -> Optional[dict]:
+        table = self._table(tag)
+        if table is None:
+            return None
+        bucket = self._buckets[tag]
+        now = time.time()
+        emoji_id = None
+        for _ in range(self.MAX_ATTEMPTS):
+            emoji_id = bucket[table.sample(self.rng)]
+            elapsed = now - self._last_used.get(emoji_id, 0)
+            if self.reuse_cooldown <= 0 or self.rng.random() * self.reuse_cooldown < elapsed:
+                break
+        return self._emojis[emoji_id]
+
+    def pick(self, tags: List[str]) -> Optional[dict]:
+        """从这些标签的表情中按权重抽一个，没有时从所有表情中抽，并记录使用"""
+        tags = [tag for tag in tags if tag is not None and self._buckets.get(tag)]
+        if tags:
+            # 多个标签时按各标签表情数量选标签
+            tag = self.rng.choices(tags, weights=[len(self._buckets[tag]) for tag in tags])[0]
+        else:
+            tag = None
+        emoji = self._sample_tag(tag)
+        if emoji is None:
+            return None
+        self.record_usage(emoji['_id'])
+        return emoji
+
+    def record_usage(self, emoji_id) -> None:
+        self._last_used[emoji_id] = time.time()
+        self._pending_usage[emoji_id] += 1
+
+    def has_tags(self, tags: List[str]) -> bool:
+        return any(self._buckets.get(tag) for tag in tags if tag is not None)
+
+    def take_usage(self) -> Counter:
+        """取出待写入的使用次数，同时更新内存中的次数（权重在下次建表时生效）"""
+        usage, self._pending_usage = self._pending_usage, Counter()
+        for emoji_id, count in usage.items():
+            record = self._emojis.get(emoji_id)
+            if record is not None:
+                record['usage_count'] = record.get('usage_count', 0) + count
+        if usage:
+            self._tables.clear()
+        return usage
+
+    def restore_usage(self, usage: Counter) -> None:
+        """写入失败时放回去，下次再写"""
+        self._pending_usage.update(usage)
+        for emoji_id, count in usage.items():
+            record = self._emojis.get(emoji_id)
+            if record is not None:
+                record['usage_count'] -= count
+
+    @staticmethod
+    def usage_updates(usage: Counter) -> List[UpdateOne]:
+        return [UpdateOne({'_id': emoji_id}, {'$inc': {'usage_count': count}}) for emoji_id, count in usage.items()]
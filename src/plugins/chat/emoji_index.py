@@ -0,0 +1,205 @@
+import io
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from .config import global_config
+
+
+def dhash(image_data: bytes, hash_size: int = 8) -> int:
+    """差值哈希：缩成(hash_size+1)×hash_size的灰度图，比较左右相邻像素的明暗
+
+    重新编码、缩放、轻微压缩的同一张图片得到的哈希只差几位；动图只看第一帧。
+
+    Raises:
+        OSError: 不是有效的图片
+    """
+    with Image.open(io.BytesIO(image_data)) as img:
+        img.seek(0)
+        pixels = list(img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """按汉明距离组织的BK树，查找某个半径内的哈希只需要访问很少的节点"""
+
+    def __init__(self):
+        # 节点: [哈希, 值列表, {距离: 子节点}]
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, key: int, value: str) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = [key, [value], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key: int, radius: int) -> List[Tuple[int, str]]:
+        """返回距离不超过radius的(距离, 值)，按距离从小到大排列"""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= radius:
+                results.extend((distance, value) for value in node[1])
+            # 三角不等式：只有距离在[distance-radius, distance+radius]内的子树可能有结果
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        results.sort()
+        return results
+
+
+class EmojiHashIndex:
+    """表情包目录的感知哈希索引，用于发现重复和近似重复的表情包
+
+    哈希追加保存在本地文件中，启动时只需要为新文件计算哈希；线程安全。
+    """
+
+    def __init__(self, emoji_dir: str, hash_path: str, max_distance: int):
+        self.emoji_dir = emoji_dir
+        self.hash_path = hash_path
+        self.max_distance = max_distance
+        self._tree = BKTree()
+        self._hashes: Dict[str, int] = {}  # 文件名 -> 哈希
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _read_hash_file(self) -> Dict[str, int]:
+        hashes = {}
+        if not os.path.exists(self.hash_path):
+            return hashes
+        with open(self.hash_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2:
+                    # 崩溃时最后一行可能没写完整
+                    continue
+                try:
+                    hashes[parts[0]] = int(parts[1], 16)
+                except ValueError:
+                    continue
+        return hashes
+
+    def _append_hash_file(self, items: List[Tuple[str, int]]) -> None:
+        os.makedirs(os.path.dirname(self.hash_path) or '.', exist_ok=True)
+        with open(self.hash_path, 'a', encoding='utf-8') as f:
+            for filename, value in items:
+                f.write(f"{filename} {value:016x}\n")
+
+    def ensure_loaded(self) -> None:
+        """第一次使用时建立索引：读取已保存的哈希，只为新文件计算哈希"""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            os.makedirs(self.emoji_dir, exist_ok=True)
+            saved = self._read_hash_file()
+            computed = []
+            for filename in os.listdir(self.emoji_dir):
+                if not filename.endswith('.jpg'):
+                    continue
+                value = saved.get(filename)
+                if value is None:
+                    try:
+                        with open(os.path.join(self.emoji_dir, filename), 'rb') as f:
+                            value = dhash(f.read())
+                    except Exception as e:
+                        print(f"\033[1;33m[表情包]\033[0m 计算哈希失败，跳过 {filename}: {str(e)}")
+                        continue
+                    computed.append((filename, value))
+                self._hashes[filename] = value
+                self._tree.add(value, filename)
+            if computed:
+                self._append_hash_file(computed)
+            # 只保留目录中还存在的文件，防止哈希文件无限增长
+            if set(saved) - set(self._hashes):
+                self._rewrite_hash_file()
+            self._loaded = True
+            print(f"\033[1;36m[表情包]\033[0m 已建立{len(self._hashes)}个表情包的哈希索引，新计算{len(computed)}个")
+
+    def _rewrite_hash_file(self) -> None:
+        tmp_path = self.hash_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for filename, value in self._hashes.items():
+                f.write(f"{filename} {value:016x}\n")
+        os.replace(tmp_path, self.hash_path)
+
+    def find_similar(self, value: int, max_distance: Optional[int] = None) -> List[Tuple[int, str]]:
+        """查找哈希距离不超过max_distance的表情包文件，返回(距离, 文件名)，已删除的文件会被跳过"""
+        self.ensure_loaded()
+        radius = self.max_distance if max_distance is None else max_distance
+        with self._lock:
+            return self._search(value, radius)
+
+    def _search(self, value: int, radius: int) -> List[Tuple[int, str]]:
+        """调用方需持有锁"""
+        matches = self._tree.search(value, radius)
+        # BK树不支持删除，删除的文件只从_hashes中去掉，在这里过滤
+        return [
+            (distance, filename) for distance, filename in matches
+            if filename in self._hashes and hamming(self._hashes[filename], value) == distance
+        ]
+
+    def check_and_add(self, filename: str, value: int) -> bool:
+        """没有近似的表情包时登记filename并返回True，否则返回False
+
+        查找和登记在同一把锁内完成，多个线程同时保存近似的表情包时只有一个能登记成功
+        """
+        self.ensure_loaded()
+        with self._lock:
+            if filename in self._hashes or self._search(value, self.max_distance):
+                return False
+            self._hashes[filename] = value
+            self._tree.add(value, filename)
+            self._append_hash_file([(filename, value)])
+            return True
+
+    def hash_of(self, filename: str) -> Optional[int]:
+        self.ensure_loaded()
+        return self._hashes.get(filename)
+
+    def add(self, filename: str, value: int) -> None:
+        self.ensure_loaded()
+        with self._lock:
+            if filename in self._hashes:
+                return
+            self._hashes[filename] = value
+            self._tree.add(value, filename)
+            self._append_hash_file([(filename, value)])
+
+    def discard(self, filename: str) -> None:
+        """文件被删除后调用，之后的查找不再返回它"""
+        with self._lock:
+            self._hashes.pop(filename, None)
+
+
+emoji_hash_index = EmojiHashIndex(
+    emoji_dir="data/emoji",
+    hash_path="data/emoji_hashes.txt",
+    max_distance=global_config.emoji_dedup_distance,
+)
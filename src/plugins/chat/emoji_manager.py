@@ -1,23 +1,28 @@
 from typing import List, Dict, Optional
 import random
-from ...common.database import Database
+from ...common.database import Database, AsyncDatabase
+from ...common.llm_gateway import LLMGateway, LLMRequestError
 import os
 import json
 from dataclasses import dataclass
 import jieba.analyse as jieba_analyse
-import aiohttp
 import hashlib
 from datetime import datetime
 import base64
 import shutil
 from .config import global_config, llm_config
+from .emoji_index import emoji_hash_index
+from .emoji_catalog import EmojiCatalog
 import asyncio
 import time
+from pymongo.errors import BulkWriteError
 
 
 class EmojiManager:
     _instance = None
     EMOJI_DIR = "data/emoji"  # 表情包存储目录
+    MANIFEST_PATH = "data/emoji_manifest.json"  # 上次完整性检查时的目录状态
+    SCAN_BATCH_SIZE = 32  # 扫描时每批打标签并写入数据库的表情包数
     
     EMOTION_KEYWORDS = {
         'happy': ['开心', '快乐', '高兴', '欢喜', '笑', '喜悦', '兴奋', '愉快', '乐', '好'],
@@ -38,7 +43,13 @@ class EmojiManager:
     
     def __init__(self):
         self.db = Database.get_instance()
+        self.adb = AsyncDatabase.get_instance()
         self._scan_task = None
+        self.catalog = EmojiCatalog(reuse_cooldown=global_config.emoji_reuse_cooldown)
+        # 同时进行的打标签请求数
+        self._tag_semaphore = asyncio.Semaphore(global_config.emoji_tag_concurrency)
+        self._scanned_mtime: Optional[int] = None  # 上次扫描时表情目录的修改时间
+        self._skipped = set()  # 无法打标签的文件，本次运行期间不再重试
         
     def _ensure_emoji_dir(self):
         """确保表情存储目录存在"""
@@ -72,15 +83,8 @@ class EmojiManager:
             self.db.db.emoji.create_index([('filename', 1)], unique=True)
             
     def record_usage(self, emoji_id: str):
-        """记录表情使用次数"""
-        try:
-            self._ensure_db()
-            self.db.db.emoji.update_one(
-                {'_id': emoji_id},
-                {'$inc': {'usage_count': 1}}
-            )
-        except Exception as e:
-            print(f"\033[1;31m[错误]\033[0m 记录表情使用失败: {str(e)}")
+        """记录表情使用次数，由flush_usage批量写入数据库"""
+        self.catalog.record_usage(emoji_id)
             
     async def _get_emotion_from_text(self, text: str) -> List[str]:
         """从文本中识别情感关键词，使用DeepSeek API进行分析
@@ -90,46 +94,30 @@ class EmojiManager:
             List[str]: 匹配到的情感标签列表
         """
         try:
-            # 准备请求数据
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {llm_config.SILICONFLOW_API_KEY}"
-            }
-            
-            payload = {
-                "model": "deepseek-ai/DeepSeek-V3",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f'分析这段文本："{text}"，从"happy,angry,sad,surprised,disgusted,fearful,neutral"中选出最匹配的1个情感标签。只需要返回标签，不要输出其他任何内容。'
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": 50,
-                "temperature": 0.3
-            }
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f'分析这段文本："{text}"，从"happy,angry,sad,surprised,disgusted,fearful,neutral"中选出最匹配的1个情感标签。只需要返回标签，不要输出其他任何内容。'
+                        }
+                    ]
+                }
+            ]
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{llm_config.SILICONFLOW_BASE_URL}chat/completions",
-                    headers=headers,
-                    json=payload
-                ) as response:
-                    if response.status != 200:
-                        print(f"\033[1;31m[错误]\033[0m API请求失败: {await response.text()}")
-                        return ['neutral']
-                    
-                    result = json.loads(await response.text())
-                    if "choices" in result and len(result["choices"]) > 0:
-                        emotion = result["choices"][0]["message"]["content"].strip().lower()
-                        # 确保返回的标签是有效的
-                        if emotion in self.EMOTION_KEYWORDS:
-                            print(f"\033[1;32m[成功]\033[0m 识别到的情感: {emotion}")
-                            return [emotion]  # 返回单个情感标签的列表
+            content, _ = await LLMGateway.get_instance().chat_completion(
+                "deepseek-ai/DeepSeek-V3",
+                messages,
+                "siliconflow",
+                max_tokens=50,
+                temperature=0.3
+            )
+            emotion = content.strip().lower()
+            # 确保返回的标签是有效的
+            if emotion in self.EMOTION_KEYWORDS:
+                print(f"\033[1;32m[成功]\033[0m 识别到的情感: {emotion}")
+                return [emotion]  # 返回单个情感标签的列表
             
             return ['neutral']  # 如果无法识别情感，返回neutral
             
@@ -137,48 +125,43 @@ class EmojiManager:
             print(f"\033[1;31m[错误]\033[0m 情感分析失败: {str(e)}")
             return ['neutral']
 
+    async def _pick_emoji(self, tags: List[str]) -> Optional[str]:
+        """从内存表情目录中按标签挑选一个表情，找不到时从所有表情中随机选择，使用次数稍后批量写入"""
+        if not self.catalog.loaded:
+            await self.load_catalog()
+        if self.catalog.has_tags(tags):
+            print(f"\033[1;32m[成功]\033[0m 找到匹配的表情")
+        else:
+            # 如果没有匹配的表情，从所有表情中随机选择一个
+            print(f"\033[1;33m[提示]\033[0m 未找到匹配的表情，随机选择一个")
+        emoji = self.catalog.pick(tags)
+        if emoji is None:
+            print(f"\033[1;31m[错误]\033[0m 数据库中没有任何表情")
+            return None
+        return emoji['path']
+
+    async def load_catalog(self) -> None:
+        """从数据库加载表情目录"""
+        count = await self.adb.run(self.catalog.load, self.db)
+        print(f"\033[1;36m[表情包]\033[0m 已加载{count}个表情包")
+
+    async def flush_usage(self) -> None:
+        """把内存中累计的使用次数批量写入数据库"""
+        usage = self.catalog.take_usage()
+        if not usage:
+            return
+        try:
+            await self.adb.db.emoji.bulk_write(self.catalog.usage_updates(usage), ordered=False)
+        except Exception as e:
+            self.catalog.restore_usage(usage)
+            print(f"\033[1;31m[错误]\033[0m 写入表情使用次数失败: {str(e)}")
+
     async def get_emoji_for_emotion(self, emotion_tag: str) -> Optional[str]:
         try:
             self._ensure_db()
                 
-            # 构建查询条件：标签匹配任一情感
-            query = {'tags': {'$in': emotion_tag}}
-            
-            # print(f"\033[1;34m[调试]\033[0m 表情查询条件: {query}")
-            
-            try:
-                # 随机获取一个匹配的表情
-                emoji = self.db.db.emoji.aggregate([
-                    {'$match': query},
-                    {'$sample': {'size': 1}}
-                ]).next()
-                print(f"\033[1;32m[成功]\033[0m 找到匹配的表情")
-                if emoji and 'path' in emoji:
-                    # 更新使用次数
-                    self.db.db.emoji.update_one(
-                        {'_id': emoji['_id']},
-                        {'$inc': {'usage_count': 1}}
-                    )
-                    return emoji['path']
-            except StopIteration:
-                # 如果没有匹配的表情，从所有表情中随机选择一个
-                print(f"\033[1;33m[提示]\033[0m 未找到匹配的表情，随机选择一个")
-                try:
-                    emoji = self.db.db.emoji.aggregate([
-                        {'$sample': {'size': 1}}
-                    ]).next()
-                    if emoji and 'path' in emoji:
-                        # 更新使用次数
-                        self.db.db.emoji.update_one(
-                            {'_id': emoji['_id']},
-                            {'$inc': {'usage_count': 1}}
-                        )
-                        return emoji['path']
-                except StopIteration:
-                    print(f"\033[1;31m[错误]\033[0m 数据库中没有任何表情")
-                    return None
-            
-            return None
+            # 标签匹配任一情感
+            return await self._pick_emoji(list(emotion_tag))
             
         except Exception as e:
             print(f"\033[1;31m[错误]\033[0m 获取表情包失败: {str(e)}")
@@ -200,45 +183,10 @@ class EmojiManager:
             if not emotions:
                 return None
                 
-            # 构建查询条件：标签匹配任一情感
-            query = {'tags': {'$in': emotions}}
-            
-            print(f"\033[1;34m[调试]\033[0m 表情查询条件: {query}")
             print(f"\033[1;34m[调试]\033[0m 匹配到的情感: {emotions}")
             
-            try:
-                # 随机获取一个匹配的表情
-                emoji = self.db.db.emoji.aggregate([
-                    {'$match': query},
-                    {'$sample': {'size': 1}}
-                ]).next()
-                print(f"\033[1;32m[成功]\033[0m 找到匹配的表情")
-                if emoji and 'path' in emoji:
-                    # 更新使用次数
-                    self.db.db.emoji.update_one(
-                        {'_id': emoji['_id']},
-                        {'$inc': {'usage_count': 1}}
-                    )
-                    return emoji['path']
-            except StopIteration:
-                # 如果没有匹配的表情，从所有表情中随机选择一个
-                print(f"\033[1;33m[提示]\033[0m 未找到匹配的表情，随机选择一个")
-                try:
-                    emoji = self.db.db.emoji.aggregate([
-                        {'$sample': {'size': 1}}
-                    ]).next()
-                    if emoji and 'path' in emoji:
-                        # 更新使用次数
-                        self.db.db.emoji.update_one(
-                            {'_id': emoji['_id']},
-                            {'$inc': {'usage_count': 1}}
-                        )
-                        return emoji['path']
-                except StopIteration:
-                    print(f"\033[1;31m[错误]\033[0m 数据库中没有任何表情")
-                    return None
-            
-            return None
+            # 标签匹配任一情感
+            return await self._pick_emoji(emotions)
             
         except Exception as e:
             print(f"\033[1;31m[错误]\033[0m 获取表情包失败: {str(e)}")
@@ -246,99 +194,172 @@ class EmojiManager:
 
     async def _get_emoji_tag(self, image_base64: str) -> str:
         """获取表情包的标签"""
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {llm_config.SILICONFLOW_API_KEY}"
-            }
-            
-            payload = {
-                "model": "deepseek-ai/deepseek-vl2",
-                "messages": [
+        messages = [
+            {
+                "role": "user",
+                "content": [
                     {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": '这是一个表情包，请从"happy", "angry", "sad", "surprised", "disgusted", "fearful", "neutral"中选出1个情感标签。只输出标签，不要输出其他任何内容，只输出情感标签就好'
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_base64}"
-                                }
-                            }
-                        ]
+                        "type": "text",
+                        "text": '这是一个表情包，请从"happy", "angry", "sad", "surprised", "disgusted", "fearful", "neutral"中选出1个情感标签。只输出标签，不要输出其他任何内容，只输出情感标签就好'
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{image_base64}"
+                        }
                     }
-                ],
-                "max_tokens": 60,
-                "temperature": 0.3
+                ]
             }
-            
-            async with session.post(
-                f"{llm_config.SILICONFLOW_BASE_URL}chat/completions",
-                headers=headers,
-                json=payload
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if "choices" in result and len(result["choices"]) > 0:
-                        tag_result = result["choices"][0]["message"]["content"].strip().lower()
+        ]
+        
+        try:
+            content, _ = await LLMGateway.get_instance().chat_completion(
+                "deepseek-ai/deepseek-vl2",
+                messages,
+                "siliconflow",
+                max_tokens=60,
+                temperature=0.3
+            )
+            tag_result = content.strip().lower()
 
-                        valid_tags = ["happy", "angry", "sad", "surprised", "disgusted", "fearful", "neutral"]
-                        for tag_match in valid_tags:
-                            if tag_match in tag_result or tag_match == tag_result:
-                                return tag_match
-                        print(f"\033[1;33m[警告]\033[0m 无效的标签: {tag_match}, 跳过")
-                else:
-                    print(f"\033[1;31m[错误]\033[0m 获取标签失败, 状态码: {response.status}")
+            valid_tags = ["happy", "angry", "sad", "surprised", "disgusted", "fearful", "neutral"]
+            for tag_match in valid_tags:
+                if tag_match in tag_result or tag_match == tag_result:
+                    return tag_match
+            print(f"\033[1;33m[警告]\033[0m 无效的标签: {tag_result}, 跳过")
+        except LLMRequestError as e:
+            print(f"\033[1;31m[错误]\033[0m 获取标签失败: {str(e)}")
         
         print(f"\033[1;32m[调试信息]\033[0m 使用默认标签: neutral")
         return "skip"  # 默认标签
 
-    async def scan_new_emojis(self):
-        """扫描新的表情包"""
+    async def _get_duplicate_tag(self, filename: str) -> Optional[str]:
+        """查找已注册的近似表情包，返回它的标签，没有时返回None"""
+        loop = asyncio.get_running_loop()
+        # 第一次使用时要建立哈希索引，放到线程池中执行
+        perceptual_hash = await loop.run_in_executor(None, emoji_hash_index.hash_of, filename)
+        if perceptual_hash is None:
+            return None
+        similar = [name for _, name in emoji_hash_index.find_similar(perceptual_hash) if name != filename]
+        if not similar:
+            return None
+        duplicate = await self.adb.db.emoji.find_one({'filename': {'$in': similar}, 'tags.0': {'$exists': True}})
+        if duplicate is None:
+            return None
+        print(f"\033[1;36m[表情包]\033[0m {filename} 与已注册的 {duplicate['filename']} 近似，沿用标签")
+        return duplicate['tags'][0]
+
+    def _dir_mtime(self) -> int:
+        self._ensure_emoji_dir()
+        return os.stat(self.EMOJI_DIR).st_mtime_ns
+
+    def _load_manifest(self) -> Dict:
+        """读取上次检查时表情目录的修改时间和注册数量"""
         try:
-            emoji_dir = "data/emoji"
-            os.makedirs(emoji_dir, exist_ok=True)
+            with open(self.MANIFEST_PATH, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
 
-            # 获取所有jpg文件
-            files_to_process = [f for f in os.listdir(emoji_dir) if f.endswith('.jpg')]
-            
-            for filename in files_to_process:
-                # 检查是否已经注册过
-                existing_emoji = self.db.db['emoji'].find_one({'filename': filename})
-                if existing_emoji:
-                    continue
-                    
-                image_path = os.path.join(emoji_dir, filename)
-                # 读取图片数据
-                with open(image_path, 'rb') as f:
-                    image_data = f.read()
+    def _save_manifest(self, manifest: Dict) -> None:
+        os.makedirs(os.path.dirname(self.MANIFEST_PATH) or '.', exist_ok=True)
+        tmp_path = self.MANIFEST_PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.MANIFEST_PATH)
+
+    def _list_new_emojis(self) -> List[str]:
+        """对比目录中的文件和一次取出的已注册文件名，返回未注册的文件（同步方法，在线程池中调用）"""
+        dir_mtime = self._dir_mtime()
+        if dir_mtime == self._scanned_mtime:
+            # 目录没有变化（没有新增或删除文件）
+            return []
+        with os.scandir(self.EMOJI_DIR) as entries:
+            files = [entry.name for entry in entries if entry.name.endswith('.jpg') and entry.is_file()]
+        registered = set(self.db.db.emoji.distinct('filename'))
+        self._scanned_mtime = dir_mtime
+        return [filename for filename in files if filename not in registered and filename not in self._skipped]
+
+    async def _register_emoji(self, filename: str) -> Optional[Dict]:
+        """为一个表情包打标签，返回数据库记录，无法打标签时返回None"""
+        image_path = os.path.join(self.EMOJI_DIR, filename)
+        async with self._tag_semaphore:
+            # 已经有近似的表情包打过标签时直接沿用，不再请求识图
+            tag = await self._get_duplicate_tag(filename)
+            if tag is None:
+                loop = asyncio.get_running_loop()
+                try:
+                    image_data = await loop.run_in_executor(None, self._read_file, image_path)
+                except OSError as e:
+                    print(f"\033[1;33m[警告]\033[0m 读取表情包失败: {filename}: {str(e)}")
+                    return None
                 
                 # 将图片转换为base64
                 image_base64 = base64.b64encode(image_data).decode('utf-8')
                 
                 # 获取表情包的情感标签
                 tag = await self._get_emoji_tag(image_base64)
-                if not tag == "skip":
-                # 准备数据库记录
-                    emoji_record = {
-                        'filename': filename,
-                        'path': image_path,
-                        'tags': [tag],
-                        'timestamp': int(time.time())
-                    }
-                    
-                    # 保存到数据库
-                    self.db.db['emoji'].insert_one(emoji_record)
-                    print(f"\033[1;32m[成功]\033[0m 注册新表情包: {filename}")
-                    print(f"标签: {tag}")
-                else:
-                    print(f"\033[1;33m[警告]\033[0m 跳过表情包: {filename}")
+        if tag == "skip":
+            print(f"\033[1;33m[警告]\033[0m 跳过表情包: {filename}")
+            return None
+        print(f"\033[1;32m[成功]\033[0m 注册新表情包: {filename}")
+        print(f"标签: {tag}")
+        # 准备数据库记录
+        return {
+            'filename': filename,
+            'path': image_path,
+            'tags': [tag],
+            'timestamp': int(time.time())
+        }
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
 
+    async def scan_new_emojis(self):
+        """扫描新的表情包：一次对比目录和已注册的文件名，并发打标签，分批写入数据库"""
+        try:
+            new_files = await self.adb.run(self._list_new_emojis)
+            if not new_files:
+                return
+            print(f"\033[1;36m[表情包]\033[0m 发现{len(new_files)}个未注册的表情包")
+            
+            for start in range(0, len(new_files), self.SCAN_BATCH_SIZE):
+                batch = new_files[start:start + self.SCAN_BATCH_SIZE]
+                results = await asyncio.gather(
+                    *[self._register_emoji(filename) for filename in batch],
+                    return_exceptions=True
+                )
+                records = []
+                for filename, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        print(f"\033[1;31m[错误]\033[0m 注册表情包失败: {filename}: {str(result)}")
+                        # 下次扫描时重试
+                        self._scanned_mtime = None
+                    elif result is None:
+                        # 本次运行期间不再重试，避免反复请求识图
+                        self._skipped.add(filename)
+                    else:
+                        records.append(result)
+                if records:
+                    # 保存到数据库，insert_many 会把 _id 写回记录
+                    try:
+                        await self.adb.db.emoji.insert_many(records, ordered=False)
+                    except BulkWriteError as e:
+                        write_errors = e.details.get('writeErrors', [])
+                        failed = {err['index'] for err in write_errors}
+                        records = [record for i, record in enumerate(records) if i not in failed]
+                        # 重复的文件名（其他进程已注册）忽略，其他错误下次扫描时重试
+                        errors = [err for err in write_errors if err.get('code') != 11000]
+                        if errors:
+                            self._scanned_mtime = None
+                            print(f"\033[1;31m[错误]\033[0m 保存表情包记录时有 {len(errors)} 条失败，下次扫描时重试: "
+                                  f"{errors[0].get('errmsg')}")
+                    self.catalog.add(records)
                 
         except Exception as e:
+            self._scanned_mtime = None
             print(f"\033[1;31m[错误]\033[0m 扫描表情包失败: {str(e)}")
             import traceback
             print(traceback.format_exc())
@@ -350,62 +371,63 @@ class EmojiManager:
             await self.scan_new_emojis()
             await asyncio.sleep(interval_MINS * 60)  # 每600秒扫描一次
 
-    def check_emoji_file_integrity(self):
-        """检查表情包文件完整性
-        如果文件已被删除，则从数据库中移除对应记录
+    def _find_missing_emojis(self) -> Optional[List]:
+        """找出文件已被删除的表情包记录并删除（同步方法，在线程池中调用）
+
+        目录修改时间和注册数量都和上次检查时一样时直接跳过，返回None
+        """
+        dir_mtime = self._dir_mtime()
+        registered_count = self.db.db.emoji.estimated_document_count()
+        manifest = self._load_manifest()
+        if manifest.get('dir_mtime') == dir_mtime and manifest.get('registered_count') == registered_count:
+            return None
+        
+        with os.scandir(self.EMOJI_DIR) as entries:
+            existing = {os.path.normpath(entry.path) for entry in entries}
+        emoji_dir = os.path.normpath(self.EMOJI_DIR)
+        missing = []
+        for emoji in self.db.db.emoji.find({}, {'path': 1}):
+            if 'path' not in emoji:
+                print(f"\033[1;33m[提示]\033[0m 发现无效记录（缺少path字段），ID: {emoji.get('_id', 'unknown')}")
+                missing.append((emoji['_id'], None))
+                continue
+            path = os.path.normpath(emoji['path'])
+            # 不在表情目录中的文件单独检查
+            exists = path in existing if os.path.dirname(path) == emoji_dir else os.path.exists(path)
+            if not exists:
+                print(f"\033[1;33m[提示]\033[0m 表情包文件已被删除: {emoji['path']}")
+                missing.append((emoji['_id'], emoji['path']))
+        
+        if missing:
+            result = self.db.db.emoji.delete_many({'_id': {'$in': [emoji_id for emoji_id, _ in missing]}})
+            print(f"\033[1;32m[成功]\033[0m 已清理 {result.deleted_count} 个失效的表情包记录")
+            registered_count = self.db.db.emoji.estimated_document_count()
+        self._save_manifest({'dir_mtime': dir_mtime, 'registered_count': registered_count})
+        print(f"\033[1;36m[表情包]\033[0m 已检查 {registered_count + len(missing)} 个表情包记录")
+        return missing
+
+    def check_emoji_file_integrity(self) -> List:
+        """检查表情包文件完整性，如果文件已被删除，则从数据库中移除对应记录
+
+        Returns:
+            被删除的(_id, path)列表，调用方需要在事件循环中同步到内存表情目录
         """
         try:
             self._ensure_db()
-            # 获取所有表情包记录
-            all_emojis = list(self.db.db.emoji.find())
-            removed_count = 0
-            total_count = len(all_emojis)
-            
-            for emoji in all_emojis:
-                try:
-                    if 'path' not in emoji:
-                        print(f"\033[1;33m[提示]\033[0m 发现无效记录（缺少path字段），ID: {emoji.get('_id', 'unknown')}")
-                        self.db.db.emoji.delete_one({'_id': emoji['_id']})
-                        removed_count += 1
-                        continue
-                        
-                    # 检查文件是否存在
-                    if not os.path.exists(emoji['path']):
-                        print(f"\033[1;33m[提示]\033[0m 表情包文件已被删除: {emoji['path']}")
-                        # 从数据库中删除记录
-                        result = self.db.db.emoji.delete_one({'_id': emoji['_id']})
-                        if result.deleted_count > 0:
-                            print(f"\033[1;32m[成功]\033[0m 成功删除数据库记录: {emoji['_id']}")
-                            removed_count += 1
-                        else:
-                            print(f"\033[1;31m[错误]\033[0m 删除数据库记录失败: {emoji['_id']}")
-                except Exception as item_error:
-                    print(f"\033[1;31m[错误]\033[0m 处理表情包记录时出错: {str(item_error)}")
-                    continue
-            
-            # 验证清理结果
-            remaining_count = self.db.db.emoji.count_documents({})
-            if removed_count > 0:
-                print(f"\033[1;32m[成功]\033[0m 已清理 {removed_count} 个失效的表情包记录")
-                print(f"\033[1;34m[统计]\033[0m 清理前总数: {total_count} | 清理后总数: {remaining_count}")
-                # print(f"\033[1;34m[统计]\033[0m 应删除数量: {removed_count} | 实际删除数量: {total_count - remaining_count}")
-                # 执行数据库压缩
-                try:
-                    self.db.db.command({"compact": "emoji"})
-                    print(f"\033[1;32m[成功]\033[0m 数据库集合压缩完成")
-                except Exception as compact_error:
-                    print(f"\033[1;31m[错误]\033[0m 数据库压缩失败: {str(compact_error)}")
-            else:
-                print(f"\033[1;36m[表情包]\033[0m 已检查 {total_count} 个表情包记录")
-                
+            return self._find_missing_emojis() or []
         except Exception as e:
             print(f"\033[1;31m[错误]\033[0m 检查表情包完整性失败: {str(e)}")
             import traceback
             print(f"\033[1;31m[错误追踪]\033[0m\n{traceback.format_exc()}")
+            return []
 
     async def start_periodic_check(self, interval_MINS: int = 120):
         while True:
-            self.check_emoji_file_integrity()
+            missing = await self.adb.run(self.check_emoji_file_integrity)
+            self.catalog.remove([emoji_id for emoji_id, _ in missing])
+            for _, path in missing:
+                if path:
+                    emoji_hash_index.discard(os.path.basename(path))
             await asyncio.sleep(interval_MINS * 60)
 
 
@@ -0,0 +1,134 @@
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from ...common.database import AsyncDatabase
+
+# 缓存未命中和命中“失败结果”要区分开
+MISSING = object()
+
+
+def content_hash(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _to_timestamp(value: Optional[datetime]) -> Optional[float]:
+    """数据库中的过期时间（pymongo默认返回不带时区的UTC时间）转成时间戳"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class ImageDescriptionCache:
+    """图片描述缓存，按图片内容的sha256（以及QQ图片的file id）查找
+
+    先查内存LRU，再查数据库；识图失败的结果也会缓存negative_ttl秒，避免反复请求。
+    描述为None表示失败结果。
+    """
+
+    def __init__(self, max_memory_items: int = 2048, negative_ttl: float = 3600):
+        self.max_memory_items = max_memory_items
+        self.negative_ttl = negative_ttl
+        self.db = AsyncDatabase.get_instance()
+        # 键 -> (描述, 过期时间)，过期时间为None表示永久有效
+        self._memory: "OrderedDict[str, Tuple[Optional[str], Optional[float]]]" = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash_key(kind: str, image_hash: str) -> str:
+        return f"{kind}:{image_hash}"
+
+    @staticmethod
+    def _file_key(kind: str, file_id: str) -> str:
+        return f"{kind}:file:{file_id}"
+
+    def _remember(self, key: str, description: Optional[str], expire_at: Optional[float]) -> None:
+        self._memory[key] = (description, expire_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _get_memory(self, key: str):
+        entry = self._memory.get(key)
+        if entry is None:
+            return MISSING
+        description, expire_at = entry
+        if expire_at is not None and expire_at < time.time():
+            del self._memory[key]
+            return MISSING
+        self._memory.move_to_end(key)
+        return description
+
+    async def _get(self, key: str, query: Dict):
+        description = self._get_memory(key)
+        if description is not MISSING:
+            self.hits += 1
+            return description
+        try:
+            doc = await self.db.db.image_descriptions.find_one(query, {'description': 1, 'expire_at': 1})
+        except Exception as e:
+            print(f"\033[1;31m[识图缓存]\033[0m 读取缓存失败: {str(e)}")
+            doc = None
+        expire_at = _to_timestamp(doc.get('expire_at')) if doc else None
+        # TTL索引不会立即删除过期文档，这里再判断一次
+        if doc is None or (expire_at is not None and expire_at < time.time()):
+            self.misses += 1
+            return MISSING
+        self.db_hits += 1
+        self._remember(key, doc.get('description'), expire_at)
+        return doc.get('description')
+
+    async def get_by_file(self, kind: str, file_id: str):
+        """按QQ图片的file id查找，不需要下载图片；未命中返回MISSING"""
+        return await self._get(self._file_key(kind, file_id), {'kind': kind, 'file_ids': file_id})
+
+    async def get_by_hash(self, kind: str, image_hash: str):
+        """按图片内容哈希查找；未命中返回MISSING"""
+        return await self._get(self._hash_key(kind, image_hash), {'_id': self._hash_key(kind, image_hash)})
+
+    async def put(self, kind: str, image_hash: Optional[str], file_id: Optional[str],
+                  description: Optional[str]) -> None:
+        """写入识图结果，description为None时作为失败结果在negative_ttl秒后过期
+
+        image_hash为None（图片没下载下来）时只按file id缓存失败结果
+        """
+        expire_at = time.time() + self.negative_ttl if description is None else None
+        keys: List[str] = []
+        if image_hash:
+            keys.append(self._hash_key(kind, image_hash))
+        if file_id:
+            keys.append(self._file_key(kind, file_id))
+        if not keys:
+            return
+        for key in keys:
+            self._remember(key, description, expire_at)
+
+        doc_id = self._hash_key(kind, image_hash) if image_hash else self._file_key(kind, file_id)
+        update: Dict = {
+            '$set': {'kind': kind, 'description': description, 'updated_at': time.time()},
+        }
+        if expire_at is not None:
+            # 失败结果由TTL索引自动删除
+            update['$set']['expire_at'] = datetime.fromtimestamp(expire_at, timezone.utc)
+        else:
+            update['$unset'] = {'expire_at': ''}
+        if file_id:
+            update['$addToSet'] = {'file_ids': file_id}
+        try:
+            await self.db.db.image_descriptions.update_one({'_id': doc_id}, update, upsert=True)
+            if file_id and image_hash:
+                # 之前图片没下载下来时只按file id记录的失败结果作废
+                await self.db.db.image_descriptions.delete_one({'_id': self._file_key(kind, file_id)})
+        except Exception as e:
+            print(f"\033[1;31m[识图缓存]\033[0m 写入缓存失败: {str(e)}")
+
+    def print_stats(self) -> None:
+        total = self.hits + self.db_hits + self.misses
+        if total:
+            print(f"\033[1;36m[识图缓存]\033[0m 内存命中{self.hits}次，数据库命中{self.db_hits}次，未命中{self.misses}次")
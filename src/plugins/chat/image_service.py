@@ -0,0 +1,235 @@
+import asyncio
+import base64
+import html
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from urllib3.util import create_urllib3_context
+
+from ...common.llm_gateway import LLMGateway
+from .config import global_config
+from .image_cache import MISSING, ImageDescriptionCache, content_hash
+from .utils_image import storage_emoji, storage_image
+
+# TLS1.3特殊处理 https://github.com/psf/requests/issues/6616
+ctx = create_urllib3_context()
+ctx.load_default_certs()
+ctx.set_ciphers("AES128-GCM-SHA256")
+
+# 腾讯专用请求头配置
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.87 Safari/537.36',
+    'Accept': 'text/html, application/xhtml xml, */*',
+    'Accept-Encoding': 'gbk, GB2312',
+    'Accept-Language': 'zh-cn',
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'Cache-Control': 'no-cache'
+}
+
+VISION_MODEL = "deepseek-ai/deepseek-vl2"
+
+PROMPTS = {
+    'image': ("请用中文描述这张图片的内容。如果有文字，请把文字都描述出来。并尝试猜测这个图片的含义。最多200个字。", 300, 0.6),
+    'emoji': ("这是一个表情包，请用简短的中文描述这个表情包传达的情感和含义。最多20个字。", 50, 0.4),
+}
+PLACEHOLDERS = {'image': '[图片]', 'emoji': '[表情包]'}
+LABELS = {'image': '图片', 'emoji': '表情包'}
+
+
+class ImageTooLargeError(Exception):
+    """图片超过下载大小上限"""
+
+
+class ImageService:
+    """图片下载和识图服务
+
+    - 所有下载共用一个aiohttp会话（使用腾讯图床需要的TLS设置），并限制同时下载数
+    - 流式下载，超过大小上限立即放弃
+    - 识图请求通过大模型网关发送，并发和限流由网关统一控制
+    - 识图结果按图片内容和QQ图片file id缓存，重复发送的图片不再下载和识图
+    """
+
+    def __init__(self, max_bytes: int, timeout: float, concurrency: int, cache: ImageDescriptionCache,
+                 max_retries: int = 3):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache = cache
+        self.max_retries = max_retries
+        # 正在识图的图片，同一张图片同时出现多次时只请求一次
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(ssl=ctx, limit=self.concurrency * 2, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=HEADERS,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def _fetch(self, url: str) -> Optional[bytes]:
+        async with self._get_session().get(url, allow_redirects=True) as response:
+            # 腾讯服务器特殊状态码处理
+            if response.status == 400 and 'multimedia.nt.qq.com.cn' in url:
+                return None
+            if response.status != 200:
+                raise aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status, message=f"HTTP {response.status}"
+                )
+            # 验证内容类型
+            content_type = response.headers.get('Content-Type', '')
+            if not content_type.startswith('image/'):
+                raise ValueError(f"非图片内容类型: {content_type}")
+            if (response.content_length or 0) > self.max_bytes:
+                raise ImageTooLargeError(f"图片大小{response.content_length}字节超过上限")
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data.extend(chunk)
+                if len(data) > self.max_bytes:
+                    raise ImageTooLargeError(f"图片大小超过上限{self.max_bytes}字节")
+            return bytes(data)
+
+    async def download(self, url: str) -> Optional[bytes]:
+        """下载图片，失败或超过大小上限时返回None"""
+        url = html.unescape(url)
+        if not url.startswith(('http://', 'https://')):
+            return None
+        async with self._get_semaphore():
+            for retry in range(self.max_retries):
+                try:
+                    return await self._fetch(url)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if retry == self.max_retries - 1:
+                        print(f"\033[1;31m[图片下载]\033[0m 最终请求失败: {str(e) or type(e).__name__}")
+                        return None
+                    await asyncio.sleep(1.5 ** retry)  # 指数退避
+                except Exception as e:
+                    print(f"\033[1;33m[图片下载]\033[0m {str(e)}")
+                    return None
+        return None
+
+    async def describe(self, image_bytes: bytes, kind: str) -> str:
+        """调用识图模型获取图片描述
+
+        Raises:
+            LLMRequestError: 请求最终失败
+        """
+        prompt, max_tokens, temperature = PROMPTS[kind]
+        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
+                ]
+            }
+        ]
+        content, _ = await LLMGateway.get_instance().chat_completion(
+            VISION_MODEL, messages, "siliconflow", max_tokens=max_tokens, temperature=temperature
+        )
+        return content.strip()
+
+    @staticmethod
+    def _format(kind: str, description: Optional[str]) -> str:
+        if not description:
+            return PLACEHOLDERS[kind]
+        return f"[{LABELS[kind]}：{description}]"
+
+    async def translate(self, url: str, kind: str, file_id: Optional[str] = None) -> str:
+        """下载、保存并描述一张图片，返回替换CQ码的文本，失败时返回占位文本"""
+        if file_id:
+            description = await self.cache.get_by_file(kind, file_id)
+            if description is not MISSING:
+                return self._format(kind, description)
+
+        image_bytes = await self.download(url)
+        if not image_bytes:
+            await self.cache.put(kind, None, file_id, None)
+            return PLACEHOLDERS[kind]
+        image_hash = content_hash(image_bytes)
+        description = await self.cache.get_by_hash(kind, image_hash)
+        if description is not MISSING:
+            if file_id:
+                # 同一张图片换了file id，记下来下次不用下载
+                await self.cache.put(kind, image_hash, file_id, description)
+            return self._format(kind, description)
+
+        key = f"{kind}:{image_hash}"
+        if key in self._inflight:
+            return self._format(kind, await asyncio.shield(self._inflight[key]))
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        description = None
+        try:
+            loop = asyncio.get_running_loop()
+            store = storage_emoji if kind == 'emoji' else storage_image
+            await loop.run_in_executor(None, store, image_bytes)
+            try:
+                description = await self.describe(image_bytes, kind) or None
+            except Exception as e:
+                print(f"\033[1;31m[识图]\033[0m 获取{LABELS[kind]}描述失败: {str(e)}")
+            await self.cache.put(kind, image_hash, file_id, description)
+        finally:
+            future.set_result(description)
+            del self._inflight[key]
+        return self._format(kind, description)
+
+    async def translate_message(self, message, wait: float,
+                                on_late_update: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+        """翻译消息中的图片
+
+        最多等待wait秒，超时的图片先保留占位文本，识图完成后再更新消息文本并调用on_late_update
+
+        Args:
+            message: 已解析的Message，图片片段的translated_plain_text为占位文本
+            wait: 最多等待的秒数，0为完全不等待
+            on_late_update: 超时的图片完成后调用，用于更新已存储的消息
+        """
+        segments = [seg for seg in (message.message_segments or []) if seg.image_url]
+        if not segments:
+            return
+        tasks = {
+            asyncio.create_task(self.translate(seg.image_url, seg.image_kind, seg.image_file)): seg
+            for seg in segments
+        }
+        done, pending = await asyncio.wait(tasks, timeout=wait) if wait > 0 else (set(), set(tasks))
+        for task in done:
+            tasks[task].translated_plain_text = task.result()
+        if done:
+            message.refresh_text()
+        if pending:
+            asyncio.create_task(self._finish_late(message, [(task, tasks[task]) for task in pending], on_late_update))
+
+    async def _finish_late(self, message, pending: List, on_late_update) -> None:
+        for task, seg in pending:
+            seg.translated_plain_text = await task
+        message.refresh_text()
+        if on_late_update is not None:
+            await on_late_update()
+
+    async def close(self) -> None:
+        self.cache.print_stats()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+image_service = ImageService(
+    max_bytes=global_config.image_max_size_kb * 1024,
+    timeout=global_config.image_download_timeout,
+    concurrency=global_config.image_download_concurrency,
+    cache=ImageDescriptionCache(
+        max_memory_items=global_config.image_cache_size,
+        negative_ttl=global_config.image_negative_ttl,
+    ),
+)
@@ -1,43 +1,37 @@
-from typing import Dict, Any, List, Optional, Union, Tuple
-from openai import OpenAI
+from typing import Dict, Any, List, Optional, Union, Tuple, Callable
 import asyncio
-import requests
-from functools import partial
 from .message import Message
 from .config import BotConfig, global_config
-from ...common.database import Database
+from ...common.database import AsyncDatabase
+from ...common.llm_gateway import LLMGateway
 import random
 import time
+import datetime
 import os
 import numpy as np
 from .relationship_manager import relationship_manager
 from ..schedule.schedule_generator import bot_schedule
 from .prompt_builder import prompt_builder
+from ..memory_system.memory import RecallContext
 from .config import llm_config, global_config
-from .utils import process_llm_response
+from .utils import process_llm_response, StreamingSentenceSplitter
+from .message_stream import message_stream_container
 
 
 class LLMResponseGenerator:
     def __init__(self, config: BotConfig):
         self.config = config
-        if self.config.API_USING == "siliconflow":
-            self.client = OpenAI(
-                api_key=llm_config.SILICONFLOW_API_KEY,
-                base_url=llm_config.SILICONFLOW_BASE_URL
-            )
-        elif self.config.API_USING == "deepseek":
-            self.client = OpenAI(
-                api_key=llm_config.DEEP_SEEK_API_KEY,
-                base_url=llm_config.DEEP_SEEK_BASE_URL
-            )
+        # 服务商名称与API_USING一致：siliconflow 或 deepseek
+        self.provider = self.config.API_USING
+        self.gateway = LLMGateway.get_instance()
             
-        self.db = Database.get_instance()
+        self.db = AsyncDatabase.get_instance()
         
         # 当前使用的模型类型
         self.current_model_type = 'r1'  # 默认使用 R1
 
-    async def generate_response(self, message: Message) -> Optional[Union[str, List[str]]]:
-        """根据当前模型类型选择对应的生成函数"""
+    def _choose_model_type(self) -> None:
+        """根据配置的概率选择本次使用的模型类型"""
         # 从global_config中获取模型概率值
         model_r1_probability = global_config.MODEL_R1_PROBABILITY
         model_v3_probability = global_config.MODEL_V3_PROBABILITY
@@ -52,13 +46,30 @@ class LLMResponseGenerator:
         else:
             self.current_model_type = 'r1_distill'  # 默认使用 R1-Distill
 
-        print(f"+++++++++++++++++{global_config.BOT_NICKNAME}{self.current_model_type}思考中+++++++++++++++++")
+    def _get_model_config(self) -> Tuple[str, Dict[str, Any]]:
+        """返回当前模型类型对应的模型名和参数"""
         if self.current_model_type == 'r1':
-            model_response = await self._generate_r1_response(message)
+            # 使用 DeepSeek-R1 模型生成回复
+            model_name = "deepseek-reasoner" if self.config.API_USING == "deepseek" else "Pro/deepseek-ai/DeepSeek-R1"
+            return model_name, {"temperature": 0.7, "max_tokens": 1024}
         elif self.current_model_type == 'v3':
-            model_response = await self._generate_v3_response(message)
-        else:
-            model_response = await self._generate_r1_distill_response(message)
+            # 使用 DeepSeek-V3 模型生成回复
+            model_name = "deepseek-chat" if self.config.API_USING == "deepseek" else "Pro/deepseek-ai/DeepSeek-V3"
+            return model_name, {"temperature": 0.8, "max_tokens": 1024}
+        # 使用 DeepSeek-R1-Distill-Qwen-32B 模型生成回复
+        return "deepseek-ai/DeepSeek-R1-Distill-Qwen-32B", {"temperature": 0.7, "max_tokens": 1024}
+
+    async def generate_response(
+        self,
+        message: Message,
+        recall: Optional[RecallContext] = None
+    ) -> Optional[Union[str, List[str]]]:
+        """根据当前模型类型选择对应的生成函数，recall为决策阶段已经查好的记忆"""
+        self._choose_model_type()
+
+        print(f"+++++++++++++++++{global_config.BOT_NICKNAME}{self.current_model_type}思考中+++++++++++++++++")
+        model_name, model_params = self._get_model_config()
+        model_response = await self._generate_base_response(message, model_name, model_params, recall)
         
         # 打印情感标签
         print(f'{global_config.BOT_NICKNAME}的回复是：{model_response}')
@@ -69,12 +80,79 @@ class LLMResponseGenerator:
         
         return model_response, emotion
 
-    async def _generate_base_response(
-        self, 
-        message: Message, 
+    async def generate_response_stream(
+        self,
+        message: Message,
+        on_sentence: Callable[[str], bool],
+        recall: Optional[RecallContext] = None
+    ) -> Tuple[Optional[List[str]], List[str]]:
+        """流式生成回复，每切出一句就调用on_sentence，不用等整段回复生成完
+        
+        Args:
+            message: 要回复的消息
+            on_sentence: 收到完整句子时的回调，返回False表示不再需要后续句子
+            recall: 决策阶段已经查好的记忆
+            
+        Returns:
+            Tuple[Optional[List[str]], List[str]]: 已经发出的句子和情感标签
+        """
+        self._choose_model_type()
+        
+        print(f"+++++++++++++++++{global_config.BOT_NICKNAME}{self.current_model_type}思考中(流式)+++++++++++++++++")
+        model_name, model_params = self._get_model_config()
+        sender_name, prompt, default_params = await self._build_request(message, model_name, model_params, recall)
+        
+        splitter = StreamingSentenceSplitter(max_sentences=3, max_length=200)
+        content = ""
+        reasoning_content = ""
+        request_params = {k: v for k, v in default_params.items() if k not in ("model", "messages")}
+        stream = self.gateway.stream_chat_completion(
+            model_name, default_params["messages"], self.provider, **request_params
+        )
+        sent_sentences = []
+        stopped = False
+        try:
+            async for content_delta, reasoning_delta in stream:
+                content += content_delta
+                reasoning_content += reasoning_delta
+                for sentence in splitter.feed(content_delta):
+                    if not on_sentence(sentence):
+                        stopped = True
+                        break
+                    sent_sentences.append(sentence)
+                if stopped or splitter.exceeded:
+                    break
+            else:
+                for sentence in splitter.flush():
+                    if not on_sentence(sentence):
+                        break
+                    sent_sentences.append(sentence)
+        finally:
+            # 提前结束时关闭连接，不再接收剩余内容
+            await stream.aclose()
+        
+        if not sent_sentences and splitter.exceeded:
+            # 第一句就超出限制，和非流式一样给出默认回复
+            if on_sentence('懒得说'):
+                sent_sentences.append('懒得说')
+        
+        print(f'{global_config.BOT_NICKNAME}的回复是：{content}')
+        await self._save_reasoning_log(message, sender_name, model_name, prompt, default_params, content, reasoning_content)
+        
+        if not sent_sentences:
+            return None, []
+        emotion = await self._get_emotion_tags(content)
+        print(f"为 '{sent_sentences}' 获取到的情感标签为：{emotion}")
+        return sent_sentences, emotion
+
+    async def _build_request(
+        self,
+        message: Message,
         model_name: str,
-        model_params: Optional[Dict[str, Any]] = None
-    ) -> Optional[str]:
+        model_params: Optional[Dict[str, Any]] = None,
+        recall: Optional[RecallContext] = None
+    ) -> Tuple[str, str, Dict[str, Any]]:
+        """构建prompt和请求参数，返回(发送者名称, prompt, 请求参数)"""
         sender_name = message.user_nickname or f"用户{message.user_id}"
         
         # 获取关系值
@@ -85,11 +163,12 @@ class LLMResponseGenerator:
             relationship_value = 0.0
             
         # 构建prompt
-        prompt = prompt_builder._build_prompt(
+        prompt = await prompt_builder._build_prompt(
             message_txt=message.processed_plain_text,
             sender_name=sender_name,
             relationship_value=relationship_value,
-            group_id=message.group_id
+            group_id=message.group_id,
+            recall=recall
         )
         
         # 设置默认参数
@@ -104,34 +183,22 @@ class LLMResponseGenerator:
         # 更新参数
         if model_params:
             default_params.update(model_params)
-        
-        def create_completion():
-            return self.client.chat.completions.create(**default_params)
-        
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, create_completion)
-        
-        # 检查响应内容
-        if not response:
-            print("请求未返回任何内容")
-            return None
-        
-        if not response.choices or not response.choices[0].message.content:
-            print("请求返回的内容无效:", response)
-            return None
-            
-        content = response.choices[0].message.content
-        
-        # 获取推理内容
-        reasoning_content = ""
-        if hasattr(response.choices[0].message, "reasoning"):
-            reasoning_content = response.choices[0].message.reasoning or reasoning_content
-        elif hasattr(response.choices[0].message, "reasoning_content"):
-            reasoning_content = response.choices[0].message.reasoning_content or reasoning_content
-            
-        # 保存到数据库
-        self.db.db.reasoning_logs.insert_one({
+        return sender_name, prompt, default_params
+
+    async def _save_reasoning_log(
+        self,
+        message: Message,
+        sender_name: str,
+        model_name: str,
+        prompt: str,
+        default_params: Dict[str, Any],
+        content: str,
+        reasoning_content: str
+    ) -> None:
+        """保存推理过程到数据库"""
+        await self.db.db.reasoning_logs.insert_one({
             'time': time.time(),
+            'created_at': datetime.datetime.now(datetime.timezone.utc),  # 用于TTL索引
             'group_id': message.group_id,
             'user': sender_name,
             'message': message.processed_plain_text,
@@ -141,54 +208,42 @@ class LLMResponseGenerator:
             'prompt': prompt,
             'model_params': default_params
         })
-        
-        return content
-
-    async def _generate_r1_response(self, message: Message) -> Optional[str]:
-        """使用 DeepSeek-R1 模型生成回复"""
-        if self.config.API_USING == "deepseek":
-            return await self._generate_base_response(
-                message, 
-                "deepseek-reasoner",
-                {"temperature": 0.7, "max_tokens": 1024}
-            )
-        else:
-            return await self._generate_base_response(
-                message, 
-                "Pro/deepseek-ai/DeepSeek-R1",
-                {"temperature": 0.7, "max_tokens": 1024}
-            )
-
-    async def _generate_v3_response(self, message: Message) -> Optional[str]:
-        """使用 DeepSeek-V3 模型生成回复"""
-        if self.config.API_USING == "deepseek":
-            return await self._generate_base_response(
-                message, 
-                "deepseek-chat",
-                {"temperature": 0.8, "max_tokens": 1024}
-            )
-        else:
-            return await self._generate_base_response(
-                message, 
-                "Pro/deepseek-ai/DeepSeek-V3",
-                {"temperature": 0.8, "max_tokens": 1024}
-            )
 
-    async def _generate_r1_distill_response(self, message: Message) -> Optional[str]:
-        """使用 DeepSeek-R1-Distill-Qwen-32B 模型生成回复"""
-        return await self._generate_base_response(
-            message, 
-            "deepseek-ai/DeepSeek-R1-Distill-Qwen-32B",
-            {"temperature": 0.7, "max_tokens": 1024}
+    async def _generate_base_response(
+        self, 
+        message: Message, 
+        model_name: str,
+        model_params: Optional[Dict[str, Any]] = None,
+        recall: Optional[RecallContext] = None
+    ) -> Optional[str]:
+        sender_name, prompt, default_params = await self._build_request(message, model_name, model_params, recall)
+        
+        request_params = {k: v for k, v in default_params.items() if k not in ("model", "messages")}
+        content, reasoning_content = await self.gateway.chat_completion(
+            model_name, default_params["messages"], self.provider, **request_params
         )
+        
+        # 检查响应内容
+        if not content:
+            print("请求返回的内容无效")
+            return None
+            
+        # 保存到数据库
+        await self._save_reasoning_log(message, sender_name, model_name, prompt, default_params, content, reasoning_content)
+        
+        return content
 
     async def _get_group_chat_context(self, message: Message) -> str:
         """获取群聊上下文"""
-        recent_messages = self.db.db.messages.find(
+        group_chat = message_stream_container.get_context_text(message.group_id, 15)
+        if group_chat is not None:
+            return group_chat
+        
+        recent_messages = await self.db.db.messages.find(
             {"group_id": message.group_id}
-        ).sort("time", -1).limit(15)
+        ).sort("time", -1).limit(15).to_list(15)
         
-        messages_list = list(recent_messages)[::-1]
+        messages_list = recent_messages[::-1]
         group_chat = ""
         
         for msg_dict in messages_list:
@@ -211,24 +266,22 @@ class LLMResponseGenerator:
             
             messages = [{"role": "user", "content": prompt}]
             
-            loop = asyncio.get_event_loop()
             if self.config.API_USING == "deepseek":
                 model = "deepseek-chat"
             else:
                 model = "Pro/deepseek-ai/DeepSeek-V3"
-            create_completion = partial(
-                self.client.chat.completions.create,
-                model=model,
-                messages=messages,
+            content, _ = await self.gateway.chat_completion(
+                model,
+                messages,
+                self.provider,
                 stream=False,
                 max_tokens=30,
                 temperature=0.6
             )
-            response = await loop.run_in_executor(None, create_completion)
             
-            if response.choices[0].message.content:
+            if content:
                 # 确保返回的是列表格式
-                emotion_tag = response.choices[0].message.content.strip()
+                emotion_tag = content.strip()
                 return [emotion_tag]  # 将单个标签包装成列表返回
                 
             return ["neutral"]  # 如果无法获取情感标签，返回默认值
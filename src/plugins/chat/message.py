@@ -69,12 +69,25 @@ class Message:
                     seg.translated_plain_text
                     for seg in self.message_segments
                 )
+        self._update_detailed_text()
+                
+    def _update_detailed_text(self):
         #将详细翻译为详细可读文本
         time_str = time.strftime("%m-%d %H:%M:%S", time.localtime(self.time))
         name = self.user_nickname or f"用户{self.user_id}"
         content = self.processed_plain_text
         self.detailed_plain_text = f"[{time_str}] {name}: {content}\n"
-                
+        
+    def refresh_text(self):
+        """片段的翻译结果更新后（如图片描述异步完成）重新生成消息文本"""
+        if not self.message_segments:
+            return
+        self.processed_plain_text = ' '.join(
+            seg.translated_plain_text
+            for seg in self.message_segments
+        )
+        self._update_detailed_text()
+        
         
     def get_groupname(self, group_id: int) -> str:
         if not group_id:
@@ -0,0 +1,181 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# 阶段处理函数：接收上一阶段的产物，返回交给下一阶段的产物，返回None表示到此为止
+StageHandler = Callable[[Any], Awaitable[Optional[Any]]]
+
+
+class PipelineStage:
+    """流水线中的单个阶段，拥有独立的有界队列和若干工作协程"""
+    def __init__(self, name: str, handler: StageHandler, workers: int = 1, queue_size: int = 100):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.next_stage: Optional["PipelineStage"] = None
+        self._tasks: List[asyncio.Task] = []
+
+        # 统计数据
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.total_time = 0.0
+        self.max_depth = 0
+        self._last_processed = 0
+        self._last_report_time = time.time()
+
+    def start(self) -> None:
+        """启动工作协程，必须在事件循环中调用"""
+        if self._tasks:
+            return
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+
+    async def stop(self) -> None:
+        """停止所有工作协程"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def discard(self) -> int:
+        """丢弃队列中剩余的项目，返回丢弃的数量；正在等待放入的上游协程会因此继续"""
+        discarded = 0
+        while self.queue is not None and not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            discarded += 1
+        return discarded
+
+    async def put(self, item: Any) -> None:
+        """放入待处理项目，队列已满时等待（背压只作用于上游协程，不会阻塞事件循环）"""
+        await self.queue.put(item)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            item = await self.queue.get()
+            self.busy += 1
+            start_time = time.time()
+            try:
+                result = await self.handler(item)
+                self.processed += 1
+                if result is not None and self.next_stage is not None:
+                    await self.next_stage.put(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"\033[1;31m[流水线]\033[0m 阶段 {self.name} 处理失败: {str(e)}")
+                import traceback
+                print(traceback.format_exc())
+            finally:
+                self.total_time += time.time() - start_time
+                self.busy -= 1
+                self.queue.task_done()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取阶段统计信息，吞吐量按距上次调用的时间间隔计算"""
+        now = time.time()
+        elapsed = max(now - self._last_report_time, 1e-6)
+        throughput = (self.processed - self._last_processed) / elapsed
+        self._last_processed = self.processed
+        self._last_report_time = now
+        finished = self.processed + self.failed
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_queue_depth": self.max_depth,
+            "processed": self.processed,
+            "failed": self.failed,
+            "throughput": throughput,
+            "avg_latency": self.total_time / finished if finished else 0.0,
+        }
+
+
+class MessagePipeline:
+    """由多个阶段串联而成的异步消息处理流水线"""
+    def __init__(self):
+        self.stages: List[PipelineStage] = []
+        self._running = False
+        self._closing = False
+
+    def add_stage(self, name: str, handler: StageHandler, workers: int = 1, queue_size: int = 100) -> PipelineStage:
+        """按顺序追加一个阶段"""
+        stage = PipelineStage(name, handler, workers, queue_size)
+        if self.stages:
+            self.stages[-1].next_stage = stage
+        self.stages.append(stage)
+        return stage
+
+    def start(self) -> None:
+        """启动所有阶段"""
+        if self._running:
+            return
+        for stage in self.stages:
+            stage.start()
+        self._running = True
+
+    async def stop(self, drain_until: Optional[str] = None, timeout: float = 10) -> None:
+        """停止接收新项目并停止所有阶段
+
+        Args:
+            drain_until: 先按顺序等这个阶段及之前的阶段处理完队列中剩余的项目，之后的阶段直接丢弃；为None时立即停止
+            timeout: 等待处理剩余项目的最长秒数
+        """
+        self._closing = True
+        if drain_until is not None and self._running:
+            last = [stage.name for stage in self.stages].index(drain_until)
+            drained, dropped = self.stages[:last + 1], self.stages[last + 1:]
+            # 之后的阶段先停止并清空，正在往里放的工作协程不会卡住
+            drained[-1].next_stage = None
+            for stage in dropped:
+                await stage.stop()
+                stage.discard()
+            deadline = asyncio.get_running_loop().time() + timeout
+            for stage in drained:
+                try:
+                    await asyncio.wait_for(stage.queue.join(), max(0.0, deadline - asyncio.get_running_loop().time()))
+                except asyncio.TimeoutError:
+                    remaining = sum(stage.queue.qsize() + stage.busy for stage in drained)
+                    print(f"\033[1;33m[流水线]\033[0m 等待处理剩余消息超时，放弃{remaining}条")
+                    break
+        for stage in self.stages:
+            await stage.stop()
+        self._running = False
+
+    async def submit(self, item: Any) -> None:
+        """向第一个阶段提交项目，停止后提交的项目被丢弃"""
+        if self._closing:
+            return
+        if not self._running:
+            self.start()
+        await self.stages[0].put(item)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取每个阶段的统计信息"""
+        return {stage.name: stage.get_stats() for stage in self.stages}
+
+    def print_stats(self) -> None:
+        """打印每个阶段的吞吐量和队列深度"""
+        print("\033[1;36m[流水线统计]\033[0m")
+        for name, stats in self.get_stats().items():
+            print(
+                f"  {name:<8} 队列:{stats['queue_depth']}(峰值{stats['max_queue_depth']}) "
+                f"忙碌:{stats['busy']}/{stats['workers']} "
+                f"吞吐:{stats['throughput']:.2f}条/秒 "
+                f"平均耗时:{stats['avg_latency']:.3f}秒 "
+                f"完成:{stats['processed']} 失败:{stats['failed']}"
+            )
+
+    async def start_stats_reporter(self, interval: int = 60) -> None:
+        """定期打印流水线统计信息"""
+        while True:
+            await asyncio.sleep(interval)
+            self.print_stats()
@@ -7,7 +7,8 @@ from .message import Message, Message_Thinking, MessageSet
 from .cq_code import CQCode
 from collections import deque
 import time
-from .storage import MessageStorage 
+from .storage import message_storage
+from .message_stream import message_stream_container
 from .config import global_config
 from .cq_code import cq_code_tool
 
@@ -165,7 +166,7 @@ class MessageSendControl:
         self._running = True
         self._paused = False
         self._current_bot = None
-        self.storage = MessageStorage()  # 添加存储实例
+        self.storage = message_storage  # 添加存储实例
         try:
             message_visualizer.start()
         except(NameError):
@@ -214,6 +215,7 @@ class MessageSendControl:
                         await self.storage.store_message(message, None)
                     else:
                         await self.storage.store_message(message, None)
+                    message_stream_container.add_message(message)
                     
                     
                     
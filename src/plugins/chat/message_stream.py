@@ -9,7 +9,7 @@ import asyncio
 
 class MessageStream:
     """单个群组的消息流容器"""
-    def __init__(self, group_id: int, max_size: int = 1000):
+    def __init__(self, group_id: int, max_size: int = 1000, auto_save: bool = True):
         self.group_id = group_id
         self.messages = deque(maxlen=max_size)
         self.max_size = max_size
@@ -17,10 +17,11 @@ class MessageStream:
         
         # 确保日志目录存在
         self.log_dir = os.path.join("log", str(self.group_id))
-        os.makedirs(self.log_dir, exist_ok=True)
         
-        # 启动自动保存任务
-        asyncio.create_task(self._auto_save())
+        if auto_save:
+            os.makedirs(self.log_dir, exist_ok=True)
+            # 启动自动保存任务
+            asyncio.create_task(self._auto_save())
     
     async def _auto_save(self):
         """每30秒自动保存一次消息记录"""
@@ -120,26 +121,28 @@ class MessageStream:
             List[Message]: 最近的消息列表
         """
         try:
-            from ...common.database import Database
-            db = Database.get_instance()
+            from ...common.database import AsyncDatabase
+            db = AsyncDatabase.get_instance()
             
             # 从数据库中查询最近的消息
-            recent_messages = list(db.db.messages.find(
+            recent_messages = await db.db.messages.find(
                 {"group_id": self.group_id},
                 {
                     "time": 1,
                     "user_id": 1,
                     "user_nickname": 1,
+                    "group_name": 1,
                     "message_id": 1,
                     "raw_message": 1,
-                    "processed_text": 1
+                    "plain_text": 1,
+                    "processed_plain_text": 1
                 }
-            ).sort("time", -1).limit(count))
+            ).sort("time", -1).limit(count).to_list(count)
             
             if not recent_messages:
                 return []
                 
-            # 转换为 Message 对象
+            # 转换为 Message 对象，已有处理后的文本，不会再次翻译CQ码
             from .message import Message
             messages = []
             for msg_data in recent_messages:
@@ -147,9 +150,11 @@ class MessageStream:
                     time=msg_data["time"],
                     user_id=msg_data["user_id"],
                     user_nickname=msg_data.get("user_nickname", ""),
+                    group_name=msg_data.get("group_name"),
                     message_id=msg_data["message_id"],
                     raw_message=msg_data["raw_message"],
-                    processed_plain_text=msg_data.get("processed_text", ""),
+                    plain_text=msg_data.get("plain_text"),
+                    processed_plain_text=msg_data.get("processed_plain_text") or "[空消息]",
                     group_id=self.group_id
                 )
                 messages.append(msg)
@@ -165,6 +170,19 @@ class MessageStream:
         print(f"\033[1;34m[调试]\033[0m 从内存获取群 {self.group_id} 的最近{count}条消息记录")
         return list(self.messages)[-count:]
     
+    async def hydrate_from_db(self, count: int = 50) -> None:
+        """从数据库加载最近的消息，用于启动时恢复上下文"""
+        for msg in await self.get_recent_messages_from_db(count):
+            self.add_message(msg)
+    
+    def get_context_text(self, count: int = 15) -> str:
+        """获取最近n条消息的详细文本（按时间正序），用于构建prompt"""
+        start = max(len(self.messages) - count, 0)
+        return ''.join(
+            self.messages[i].detailed_plain_text or ''
+            for i in range(start, len(self.messages))
+        )
+    
     def get_messages_in_timerange(self, 
                                 start_time: Optional[float] = None,
                                 end_time: Optional[float] = None) -> List[Message]:
@@ -194,9 +212,10 @@ class MessageStream:
 
 class MessageStreamContainer:
     """管理所有群组的消息流容器"""
-    def __init__(self, max_size: int = 1000):
+    def __init__(self, max_size: int = 1000, auto_save: bool = True):
         self.streams: Dict[int, MessageStream] = {}
         self.max_size = max_size
+        self.auto_save = auto_save
     
     async def save_all_logs(self):
         """保存所有群组的消息日志"""
@@ -208,10 +227,29 @@ class MessageStreamContainer:
         if not message.group_id:
             return
             
-        if message.group_id not in self.streams:
-            self.streams[message.group_id] = MessageStream(message.group_id, self.max_size)
-        
-        self.streams[message.group_id].add_message(message)
+        self.get_or_create_stream(message.group_id).add_message(message)
+    
+    def get_or_create_stream(self, group_id: int) -> MessageStream:
+        """获取群组的消息流，不存在时创建"""
+        if group_id not in self.streams:
+            self.streams[group_id] = MessageStream(group_id, self.max_size, self.auto_save)
+        return self.streams[group_id]
+    
+    async def hydrate(self, group_ids, count: int = 50) -> None:
+        """启动时从数据库为指定群组加载最近的消息"""
+        loaded = 0
+        for group_id in group_ids:
+            stream = self.get_or_create_stream(group_id)
+            await stream.hydrate_from_db(count)
+            loaded += len(stream.messages)
+        print(f"\033[1;32m[上下文]\033[0m 已从数据库加载 {len(self.streams)} 个群的 {loaded} 条消息")
+    
+    def get_context_text(self, group_id: int, count: int = 15) -> Optional[str]:
+        """获取群组最近的聊天上下文，该群没有内存消息流时返回None"""
+        stream = self.streams.get(group_id)
+        if stream is None:
+            return None
+        return stream.get_context_text(count)
     
     def get_stream(self, group_id: int) -> Optional[MessageStream]:
         """获取特定群组的消息流"""
@@ -260,5 +298,5 @@ class MessageStreamContainer:
             "most_active_user": most_active_user
         }
 
-# 创建全局实例
-message_stream_container = MessageStreamContainer()
+# 创建全局实例，作为每个群聊天上下文的来源，不写入聊天日志
+message_stream_container = MessageStreamContainer(max_size=200, auto_save=False)
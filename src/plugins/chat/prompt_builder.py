@@ -1,26 +1,31 @@
 import time
+from typing import Optional
 import random
 from ..schedule.schedule_generator import bot_schedule
 import os
-from .utils import get_embedding, combine_messages, get_recent_group_detailed_plain_text
-from ...common.database import Database
+from .utils import combine_messages, get_recent_group_detailed_plain_text
+from .embedding import embedding_client
+from ..knowledege.vector_index import knowledge_index
+from ..knowledege.chunker import merge_adjacent_hits
+from ...common.database import AsyncDatabase
 from .config import global_config
 from .topic_identifier import topic_identifier
-from ..memory_system.memory import memory_graph
-from random import choice
+from ..memory_system.memory import memory_graph, RecallContext
+from .message_stream import message_stream_container
 
 
 class PromptBuilder:
     def __init__(self):
         self.prompt_built = ''
         self.activate_messages = ''
-        self.db = Database.get_instance()
+        self.db = AsyncDatabase.get_instance()
 
-    def _build_prompt(self, 
+    async def _build_prompt(self, 
                     message_txt: str, 
                     sender_name: str = "某人",
                     relationship_value: float = 0.0,
-                    group_id: int = None) -> str:
+                    group_id: int = None,
+                    recall: Optional[RecallContext] = None) -> str:
         """构建prompt
         
         Args:
@@ -28,6 +33,7 @@ class PromptBuilder:
             sender_name: 发送者昵称
             relationship_value: 关系值
             group_id: 群组ID
+            recall: 决策阶段的回忆结果，记忆图没有变化时直接复用
             
         Returns:
             str: 构建好的prompt
@@ -36,48 +42,16 @@ class PromptBuilder:
         
         memory_prompt = ''
         start_time = time.time()  # 记录开始时间
-        topic = topic_identifier.identify_topic_jieba(message_txt)
-        # print(f"\033[1;32m[pb主题识别]\033[0m 主题: {topic}")
-        
-        all_first_layer_items = []  # 存储所有第一层记忆
-        all_second_layer_items = {}  # 用字典存储每个topic的第二层记忆
-        overlapping_second_layer = set()  # 存储重叠的第二层记忆
+        if recall is None:
+            recall = memory_graph.recall(topic_identifier.identify_topic_jieba(message_txt), k=global_config.memory_recall_top_k)
+        else:
+            # 记忆图在此期间有更新时只重新查询记忆，话题不用重新分词
+            recall = memory_graph.recall(recall.topics, previous=recall, k=global_config.memory_recall_top_k)
         
-        if topic:
-            # 遍历所有topic
-            for current_topic in topic:
-                first_layer_items, second_layer_items = memory_graph.get_related_item(current_topic, depth=2)
-                # if first_layer_items:
-                    # print(f"\033[1;32m[前额叶]\033[0m 主题 '{current_topic}' 的第一层记忆: {first_layer_items}")
-                
-                # 记录第一层数据
-                all_first_layer_items.extend(first_layer_items)
-                
-                # 记录第二层数据
-                all_second_layer_items[current_topic] = second_layer_items
-                
-                # 检查是否有重叠的第二层数据
-                for other_topic, other_second_layer in all_second_layer_items.items():
-                    if other_topic != current_topic:
-                        # 找到重叠的记忆
-                        overlap = set(second_layer_items) & set(other_second_layer)
-                        if overlap:
-                            # print(f"\033[1;32m[前额叶]\033[0m 发现主题 '{current_topic}' 和 '{other_topic}' 有共同的第二层记忆: {overlap}")
-                            overlapping_second_layer.update(overlap)
-            
-            # 合并所有需要的记忆
-            if all_first_layer_items:   
-                print(f"\033[1;32m[前额叶]\033[0m 合并所有需要的记忆1: {all_first_layer_items}")
-            if overlapping_second_layer:
-                print(f"\033[1;32m[前额叶]\033[0m 合并所有需要的记忆2: {list(overlapping_second_layer)}")
-            
-            all_memories = all_first_layer_items + list(overlapping_second_layer)
-            
-            if all_memories:  # 只在列表非空时选择随机项
-                random_item = choice(all_memories)
-                memory_prompt = f"看到这些聊天，你想起来{random_item}\n"
-            else:
-                memory_prompt = ""  # 如果没有记忆，则返回空字符串
+        if recall.memories:
+            # 按连接次数、新近度和话题重叠排序后得分最高的记忆
+            print(f"\033[1;32m[前额叶]\033[0m 回忆起的记忆: {[(memory, round(score, 3)) for memory, score in recall.memories]}")
+            memory_prompt = f"看到这些聊天，你想起来{'；'.join(memory for memory, _ in recall.memories)}\n"
         
         end_time = time.time()  # 记录结束时间
         print(f"\033[1;32m[回忆耗时]\033[0m 耗时: {(end_time - start_time):.3f}秒")  # 输出耗时
@@ -109,7 +83,7 @@ class PromptBuilder:
         
         prompt_info = ''
         promt_info_prompt = ''
-        prompt_info = self.get_prompt_info(message_txt,threshold=0.5)
+        prompt_info = await self.get_prompt_info(message_txt,threshold=0.5)
         if prompt_info:
             prompt_info = f'''\n----------------------------------------------------\n你有以下这些[知识]：\n{prompt_info}\n请你记住上面的[知识]，之后可能会用到\n----------------------------------------------------\n'''
             promt_info_prompt = '你有一些[知识]，在上面可以参考。'
@@ -123,7 +97,10 @@ class PromptBuilder:
         
         chat_talking_prompt = ''
         if group_id:
-            chat_talking_prompt = get_recent_group_detailed_plain_text(self.db, group_id, limit=global_config.MAX_CONTEXT_SIZE,combine = True)
+            # 优先使用内存中的上下文，没有该群的消息流时才查询数据库
+            chat_talking_prompt = message_stream_container.get_context_text(group_id, global_config.MAX_CONTEXT_SIZE)
+            if chat_talking_prompt is None:
+                chat_talking_prompt = await get_recent_group_detailed_plain_text(self.db, group_id, limit=global_config.MAX_CONTEXT_SIZE,combine = True)
         
         chat_talking_prompt = f"以下是群里正在聊天的内容：\n{chat_talking_prompt}"
             # print(f"\033[1;34m[调试]\033[0m 已从数据库获取群 {group_id} 的消息记录:{chat_talking_prompt}")
@@ -183,86 +160,23 @@ class PromptBuilder:
         
         return prompt
 
-    def get_prompt_info(self,message:str,threshold:float):
-        related_info = ''
+    async def get_prompt_info(self,message:str,threshold:float):
         if len(message) > 10:
             message_segments = [message[i:i+10] for i in range(0, len(message), 10)]
-            for segment in message_segments:
-                embedding = get_embedding(segment)
-                related_info += self.get_info_from_db(embedding,threshold=threshold)
-                
         else:
-            embedding = get_embedding(message)
-            related_info += self.get_info_from_db(embedding,threshold=threshold)
-            
-        return related_info
+            message_segments = [message]
+        # 所有片段的向量一次请求取回，命中缓存的不再请求
+        embeddings = await embedding_client.get_embeddings(message_segments)
+        results = []
+        for embedding in embeddings:
+            results.extend(self.get_info_from_db(embedding, threshold=threshold))
+        # 不同片段常命中同一段知识或原文中相邻的片段，合并后只写进prompt一次
+        return '\n'.join(str(result['content']) for result in merge_adjacent_hits(results))
 
-    def get_info_from_db(self, query_embedding: list, limit: int = 1, threshold: float = 0.5) -> str:
+    def get_info_from_db(self, query_embedding: list, limit: int = 1, threshold: float = 0.5) -> list:
         if not query_embedding:
-            return ''
-        # 使用余弦相似度计算
-        pipeline = [
-            {
-                "$addFields": {
-                    "dotProduct": {
-                        "$reduce": {
-                            "input": {"$range": [0, {"$size": "$embedding"}]},
-                            "initialValue": 0,
-                            "in": {
-                                "$add": [
-                                    "$$value",
-                                    {"$multiply": [
-                                        {"$arrayElemAt": ["$embedding", "$$this"]},
-                                        {"$arrayElemAt": [query_embedding, "$$this"]}
-                                    ]}
-                                ]
-                            }
-                        }
-                    },
-                    "magnitude1": {
-                        "$sqrt": {
-                            "$reduce": {
-                                "input": "$embedding",
-                                "initialValue": 0,
-                                "in": {"$add": ["$$value", {"$multiply": ["$$this", "$$this"]}]}
-                            }
-                        }
-                    },
-                    "magnitude2": {
-                        "$sqrt": {
-                            "$reduce": {
-                                "input": query_embedding,
-                                "initialValue": 0,
-                                "in": {"$add": ["$$value", {"$multiply": ["$$this", "$$this"]}]}
-                            }
-                        }
-                    }
-                }
-            },
-            {
-                "$addFields": {
-                    "similarity": {
-                        "$divide": ["$dotProduct", {"$multiply": ["$magnitude1", "$magnitude2"]}]
-                    }
-                }
-            },
-            {
-                "$match": {
-                    "similarity": {"$gte": threshold}  # 只保留相似度大于等于阈值的结果
-                }
-            },
-            {"$sort": {"similarity": -1}},
-            {"$limit": limit},
-            {"$project": {"content": 1, "similarity": 1}}
-        ]
-        
-        results = list(self.db.db.knowledges.aggregate(pipeline))
-        # print(f"\033[1;34m[调试]\033[0m获取知识库内容结果: {results}")
-        
-        if not results:
-            return ''
-            
-        # 返回所有找到的内容，用换行分隔
-        return '\n'.join(str(result['content']) for result in results)
+            return []
+        # 在内存中的向量索引里计算余弦相似度
+        return knowledge_index.search(query_embedding, limit=limit, threshold=threshold)
     
 prompt_builder = PromptBuilder()
\ No newline at end of file
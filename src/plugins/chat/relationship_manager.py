@@ -1,5 +1,5 @@
 import time
-from ...common.database import Database
+from ...common.database import Database, AsyncDatabase
 from nonebot.adapters.onebot.v11 import Bot
 from typing import Optional, Tuple
 import asyncio
@@ -146,8 +146,8 @@ class RelationshipManager:
         age = relationship.age
         saved = relationship.saved
         
-        db = Database.get_instance()
-        db.db.relationships.update_one(
+        db = AsyncDatabase.get_instance()
+        await db.db.relationships.update_one(
             {'user_id': user_id},
             {'$set': {
                 'nickname': nickname,
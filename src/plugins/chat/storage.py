@@ -3,15 +3,185 @@ import time
 import threading
 from collections import defaultdict
 import asyncio
+import json
+import os
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from .message import Message
-from ...common.database import Database
+from .config import global_config
+from ...common.database import AsyncDatabase
+from ..memory_system.chat_sampler import bucket_updates
 
 class MessageStorage:
-    def __init__(self):
-        self.db = Database.get_instance()
+    """消息存储，采用写后缓冲：消息先进入内存缓冲区并追加到本地溢出文件，
+    再按数量或时间批量 insert_many 写入数据库
+
+    溢出文件一直保持打开追加；批量写入时先把它改名为正在写入的批次文件，之后的消息写入新文件，
+    写入成功后在线程池中删除批次文件，不需要重写整个文件"""
+    def __init__(self, batch_size: int = None, flush_interval: float = None, spill_path: str = None):
+        self.db = AsyncDatabase.get_instance()
+        self.batch_size = batch_size or global_config.message_batch_size
+        self.flush_interval = flush_interval or global_config.message_flush_interval
+        self.spill_path = spill_path or global_config.message_spill_path
+        self.flushing_path = self.spill_path + ".flushing"
+        self._spill_file = None
+        self._buffer: List[Dict] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._started = False
+        
+    async def start(self) -> None:
+        """恢复上次未写入数据库的消息，并启动定时刷新任务"""
+        if self._started:
+            return
+        self._started = True
+        self._load_spill()
+        if self._buffer:
+            print(f"\033[1;33m[消息存储]\033[0m 从溢出文件恢复了 {len(self._buffer)} 条未写入的消息")
+            await self.flush()
+        self._flush_task = asyncio.create_task(self._periodic_flush())
         
+    async def close(self) -> None:
+        """停止定时任务并写入剩余消息，在关闭时调用"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        self._close_spill()
+        
+    async def _periodic_flush(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            
+    def _load_spill(self) -> None:
+        """读取溢出文件（以及上次没写完的批次文件）中尚未写入数据库的消息"""
+        seen = set()
+        for path in (self.flushing_path, self.spill_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        doc = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时最后一行可能没写完整
+                        continue
+                    doc["_id"] = ObjectId(doc["_id"])
+                    if doc["_id"] not in seen:
+                        seen.add(doc["_id"])
+                        self._buffer.append(doc)
+        if os.path.exists(self.flushing_path):
+            # 合并成一个文件，之后的批次文件改名不会覆盖这些消息
+            self._rewrite_spill()
+            os.remove(self.flushing_path)
+
+    def _append_spill(self, message_data: Dict) -> None:
+        """将一条消息追加到溢出文件"""
+        if self._spill_file is None:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            self._spill_file = open(self.spill_path, "a", encoding="utf-8")
+        self._spill_file.write(json.dumps(message_data, ensure_ascii=False, default=str) + "\n")
+        self._spill_file.flush()
+
+    def _close_spill(self) -> None:
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def _rotate_spill(self) -> bool:
+        """把溢出文件改名为批次文件，之后的消息写入新的溢出文件；没有溢出文件时返回False"""
+        self._close_spill()
+        if not os.path.exists(self.spill_path):
+            return False
+        os.replace(self.spill_path, self.flushing_path)
+        return True
+
+    def _remove_flushing(self) -> None:
+        if os.path.exists(self.flushing_path):
+            os.remove(self.flushing_path)
+
+    def _rewrite_spill(self) -> None:
+        """用缓冲区中的消息重写溢出文件（只在启动时合并文件用）"""
+        self._close_spill()
+        tmp_path = self.spill_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for doc in self._buffer:
+                f.write(json.dumps(doc, ensure_ascii=False, default=str) + "\n")
+        os.replace(tmp_path, self.spill_path)
+        
+    async def flush(self) -> None:
+        """把缓冲区中的消息批量写入数据库"""
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch = self._buffer
+            self._buffer = []
+            rotated = self._rotate_spill()
+            inserted = batch
+            failed = []
+            try:
+                # _id 在客户端生成，重复写入只会触发重复键错误，因此重放溢出文件是幂等的
+                await self.db.db.messages.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                failed_indexes = {err["index"] for err in e.details.get("writeErrors", [])}
+                inserted = [doc for i, doc in enumerate(batch) if i not in failed_indexes]
+                errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                if errors:
+                    failed = [batch[err["index"]] for err in errors]
+                    self._buffer = failed + self._buffer
+                    print(f"\033[1;31m[错误]\033[0m 批量存储消息时有 {len(failed)} 条失败，稍后重试: {errors[0].get('errmsg')}")
+            except Exception as e:
+                inserted, failed = [], batch
+                self._buffer = batch + self._buffer
+                print(f"\033[1;31m[错误]\033[0m 批量存储消息失败，稍后重试: {e}")
+            # 没写进去的消息放回溢出文件（只在写入失败时发生），再删除批次文件
+            for doc in failed:
+                self._append_spill(doc)
+            if rotated:
+                await self.db.run(self._remove_flushing)
+            if inserted:
+                await self._update_buckets(inserted)
+
+    async def _update_buckets(self, docs: List[Dict]) -> None:
+        """更新按群、按时间桶的消息数统计，记忆构建按它挑选聊天记录"""
+        updates = bucket_updates(docs, global_config.memory_sample_bucket_seconds)
+        if not updates:
+            return
+        try:
+            await self.db.db.message_buckets.bulk_write(updates, ordered=False)
+        except Exception as e:
+            # 统计只影响记忆构建的取样，失败时不重试
+            print(f"\033[1;33m[消息存储]\033[0m 更新消息时间桶统计失败: {e}")
+        
+    async def update_message_text(self, message: Message) -> None:
+        """消息文本在存储之后才更新完整（如图片描述异步完成）时，更新已存储的文本"""
+        if message.is_emoji:
+            # 表情包消息存储的文本固定为[表情包]
+            return
+        fields = {
+            "processed_plain_text": message.processed_plain_text,
+            "detailed_plain_text": message.detailed_plain_text,
+        }
+        # 持有写入锁，消息要么还在缓冲区中，要么已经写入数据库
+        async with self._flush_lock:
+            for doc in self._buffer:
+                if doc["message_id"] == message.message_id and doc["group_id"] == message.group_id:
+                    doc.update(fields)
+                    return
+            try:
+                await self.db.db.messages.update_one(
+                    {"group_id": message.group_id, "message_id": message.message_id},
+                    {"$set": fields}
+                )
+            except Exception as e:
+                print(f"\033[1;31m[错误]\033[0m 更新消息文本失败: {e}")
+
     async def store_message(self, message: Message, topic: Optional[str] = None) -> None:
-        """存储消息到数据库"""
+        """存储消息，先写入缓冲区，由后台批量写入数据库"""
         try:
             if not message.is_emoji:
                 message_data = {
@@ -42,8 +212,15 @@ class MessageStorage:
                     "detailed_plain_text": message.detailed_plain_text,
                 }
                 
-            self.db.db.messages.insert_one(message_data)
+            message_data["_id"] = ObjectId()
+            self._append_spill(message_data)
+            self._buffer.append(message_data)
+            if len(self._buffer) >= self.batch_size and not self._flush_lock.locked():
+                asyncio.create_task(self.flush())
         except Exception as e:
             print(f"\033[1;31m[错误]\033[0m 存储消息失败: {e}") 
 
-# 如果需要其他存储相关的函数，可以在这里添加 
\ No newline at end of file
+# 如果需要其他存储相关的函数，可以在这里添加
+
+# 创建全局实例，接收和发送的消息共用同一个缓冲区
+message_storage = MessageStorage()
@@ -163,8 +163,16 @@ def get_recent_group_messages(db, group_id: int, limit: int = 12) -> list:
     message_objects.reverse()
     return message_objects
 
-def get_recent_group_detailed_plain_text(db, group_id: int, limit: int = 12,combine = False):
-    recent_messages = list(db.db.messages.find(
+async def get_recent_group_detailed_plain_text(db, group_id: int, limit: int = 12,combine = False):
+    """从数据库获取群组最近消息的详细文本，按时间正序排列
+
+    Args:
+        db: AsyncDatabase实例
+        group_id: 群组ID
+        limit: 获取消息数量，默认12条
+        combine: 是否合并为一个字符串
+    """
+    recent_messages = await db.db.messages.find(
         {"group_id": group_id},
         {
             "time": 1,  # 返回时间字段
@@ -173,11 +181,14 @@ def get_recent_group_detailed_plain_text(db, group_id: int, limit: int = 12,comb
             "message_id": 1,  # 返回消息ID字段
             "detailed_plain_text": 1  # 返回处理后的文本字段
         }
-    ).sort("time", -1).limit(limit))
+    ).sort("time", -1).limit(limit).to_list(limit)
 
     if not recent_messages:
         return []
     
+    # 按时间正序排列
+    recent_messages.reverse()
+    
     message_detailed_plain_text = ''
     message_detailed_plain_text_list = []
     
@@ -395,6 +406,66 @@ def process_llm_response(text: str) -> List[str]:
     
     return sentences
 
+class StreamingSentenceSplitter:
+    """流式输出时边接收边切分句子，规则与process_llm_response一致
+    
+    超过长度或条数上限后不再产出句子（已经发出去的收不回来，所以是截断而不是换成默认回复）
+    """
+    END_PUNCTUATION = '。！？!?…~～\n'
+    
+    def __init__(self, max_sentences: int = 3, max_length: int = 200):
+        self.max_sentences = max_sentences
+        self.max_length = max_length
+        self.buffer = ''
+        self.total_length = 0
+        self.sentences: List[str] = []
+        self.exceeded = False
+        
+    def feed(self, text: str) -> List[str]:
+        """追加新收到的文本，返回已经完整的句子"""
+        self.buffer += text
+        results = []
+        while not self.exceeded:
+            end = -1
+            for i, char in enumerate(self.buffer):
+                if char in self.END_PUNCTUATION:
+                    end = i
+                    break
+            if end == -1:
+                break
+            # 连续的标点算作同一句，标点后面还没有内容时等下一块再切
+            while end < len(self.buffer) and self.buffer[end] in self.END_PUNCTUATION:
+                end += 1
+            if end == len(self.buffer):
+                break
+            sentence, self.buffer = self.buffer[:end], self.buffer[end:]
+            results.extend(self._emit(sentence))
+        return results
+    
+    def flush(self) -> List[str]:
+        """输出结束，返回缓冲区中剩余的句子"""
+        sentence, self.buffer = self.buffer, ''
+        if self.exceeded:
+            return []
+        return self._emit(sentence)
+    
+    def _emit(self, sentence: str) -> List[str]:
+        if not sentence.strip():
+            return []
+        self.total_length += len(sentence)
+        if self.total_length > self.max_length:
+            print(f"回复过长 ({self.total_length} 字符)，截断后续内容")
+            self.exceeded = True
+            return []
+        parts = [part for part in split_into_sentences_w_remove_punctuation(add_typos(sentence)) if part.strip()]
+        remaining = self.max_sentences - len(self.sentences)
+        if len(parts) > remaining:
+            print(f"分割后消息数量过多，截断后续内容")
+            self.exceeded = True
+            parts = parts[:remaining]
+        self.sentences.extend(parts)
+        return parts
+
 def calculate_typing_time(input_string: str, chinese_time: float = 0.2, english_time: float = 0.1) -> float:
     """
     计算输入字符串所需的时间，中文和英文字符有不同的输入时间
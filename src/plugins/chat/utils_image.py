@@ -7,6 +7,7 @@ from ...common.database import Database
 import zlib  # 用于 CRC32
 import base64
 from .config import global_config
+from .emoji_index import dhash, emoji_hash_index
 
 
 def storage_image(image_data: bytes,type: str, max_size: int = 200) -> bytes:
@@ -150,20 +151,28 @@ def storage_emoji(image_data: bytes) -> bytes:
         emoji_dir = "data/emoji"
         os.makedirs(emoji_dir, exist_ok=True)
         
-        # 检查是否已存在相同哈希值的文件
-        for filename in os.listdir(emoji_dir):
-            if hash_value in filename:
-                # print(f"\033[1;33m[提示]\033[0m 发现重复表情包: {filename}")
-                return image_data
-        
+        # 用感知哈希检查是否已存在相同或近似（重新编码、缩放过）的表情包
+        try:
+            perceptual_hash = dhash(image_data)
+        except Exception as e:
+            print(f"\033[1;33m[提示]\033[0m 无法识别的表情包图片，不保存: {str(e)}")
+            return image_data
         # 生成文件名
         timestamp = int(time.time())
         filename = f"{timestamp}_{hash_value}.jpg"
         emoji_path = os.path.join(emoji_dir, filename)
+        # 查找和登记是原子的，同时收到两张近似的表情包时只保存一张
+        if not emoji_hash_index.check_and_add(filename, perceptual_hash):
+            # print(f"\033[1;33m[提示]\033[0m 发现重复表情包")
+            return image_data
         
         # 直接保存原始文件
-        with open(emoji_path, "wb") as f:
-            f.write(image_data)
+        try:
+            with open(emoji_path, "wb") as f:
+                f.write(image_data)
+        except Exception:
+            emoji_hash_index.discard(filename)
+            raise
             
         print(f"\033[1;32m[成功]\033[0m 保存表情包到: {emoji_path}")
         return image_data
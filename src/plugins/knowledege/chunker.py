@@ -0,0 +1,127 @@
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+# 句末标点，连续的标点和后面的右引号、右括号算作同一句
+SENTENCE_END = re.compile(r'[。！？!?；;…]+[”’」』）)]*|\n')
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+
+@dataclass
+class Chunk:
+    """知识片段，start/end 为在原文中的字符位置"""
+    index: int
+    start: int
+    end: int
+    text: str
+
+
+def _split_sentences(content: str, start: int, end: int) -> List[Tuple[int, int]]:
+    """把content[start:end]切成句子，返回每句的(起点, 终点)，跳过纯空白"""
+    sentences = []
+    position = start
+    for match in SENTENCE_END.finditer(content, start, end):
+        if content[position:match.end()].strip():
+            sentences.append((position, match.end()))
+        position = match.end()
+    if content[position:end].strip():
+        sentences.append((position, end))
+    return sentences
+
+
+def _split_paragraphs(content: str) -> List[List[Tuple[int, int]]]:
+    """按空行分段，每段是一组句子的位置"""
+    paragraphs = []
+    position = 0
+    for match in PARAGRAPH_BREAK.finditer(content):
+        sentences = _split_sentences(content, position, match.start())
+        if sentences:
+            paragraphs.append(sentences)
+        position = match.end()
+    sentences = _split_sentences(content, position, len(content))
+    if sentences:
+        paragraphs.append(sentences)
+    return paragraphs
+
+
+def split_chunks(content: str, max_chars: int = 300, overlap: int = 50) -> List[Chunk]:
+    """按段落和句子边界切分文本
+
+    句子依次装入片段，装不下时开始新片段；新段落开始时如果当前片段已经过半也开始新片段。
+    新片段开头会重复上一片段末尾不超过overlap字的完整句子（不跨段落），
+    单句超过max_chars时才在句子中间硬切。
+
+    Args:
+        content: 原文
+        max_chars: 每个片段的最大字数
+        overlap: 相邻片段重叠的最大字数，0为不重叠
+    """
+    units: List[Tuple[int, int, bool]] = []  # (起点, 终点, 是否为段落第一句)
+    for paragraph in _split_paragraphs(content):
+        for i, (start, end) in enumerate(paragraph):
+            # 过长的句子硬切
+            for piece_start in range(start, end, max_chars):
+                units.append((piece_start, min(end, piece_start + max_chars), i == 0 and piece_start == start))
+
+    chunks: List[Chunk] = []
+    current: List[Tuple[int, int, bool]] = []
+
+    def length(items) -> int:
+        return items[-1][1] - items[0][0] if items else 0
+
+    def flush():
+        start, end = current[0][0], current[-1][1]
+        # 去掉首尾空白，保证 text == content[start:end]，合并检索结果时按位置拼接
+        raw = content[start:end]
+        start += len(raw) - len(raw.lstrip())
+        end -= len(raw) - len(raw.rstrip())
+        chunks.append(Chunk(index=len(chunks), start=start, end=end, text=content[start:end]))
+
+    for unit in units:
+        start, end, paragraph_start = unit
+        new_length = end - current[0][0] if current else end - start
+        if current and (new_length > max_chars or (paragraph_start and length(current) >= max_chars // 2)):
+            flush()
+            carried = []
+            if overlap > 0 and not paragraph_start:
+                # 从上一片段末尾取完整句子作为重叠部分
+                for item in reversed(current):
+                    if end - item[0] > max_chars or current[-1][1] - item[0] > overlap:
+                        break
+                    carried.insert(0, item)
+            current = carried
+        current.append(unit)
+    if current:
+        flush()
+    return chunks
+
+
+def merge_adjacent_hits(hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """合并同一文件中重叠或相邻的检索结果，去掉重复的片段
+
+    hits 需要包含 _id/content/file_path/similarity，有 start/end 时才会合并
+    """
+    unique: Dict[Any, Dict[str, Any]] = {}
+    for hit in hits:
+        if hit["_id"] not in unique or hit["similarity"] > unique[hit["_id"]]["similarity"]:
+            unique[hit["_id"]] = dict(hit)
+
+    mergeable = [hit for hit in unique.values() if hit.get("file_path") and hit.get("start") is not None]
+    others = [hit for hit in unique.values() if not (hit.get("file_path") and hit.get("start") is not None)]
+    mergeable.sort(key=lambda hit: (hit["file_path"], hit["start"]))
+
+    merged: List[Dict[str, Any]] = []
+    for hit in mergeable:
+        last = merged[-1] if merged else None
+        if last and last["file_path"] == hit["file_path"] and hit["start"] <= last["end"]:
+            if hit["end"] > last["end"]:
+                # 重叠部分只保留一次
+                last["content"] += hit["content"][last["end"] - hit["start"]:]
+                last["end"] = hit["end"]
+            last["similarity"] = max(last["similarity"], hit["similarity"])
+        else:
+            merged.append(hit)
+
+    results = merged + others
+    results.sort(key=lambda hit: hit["similarity"], reverse=True)
+    return results
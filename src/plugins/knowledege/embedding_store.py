@@ -0,0 +1,148 @@
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+
+
+class EmbeddingStore:
+    """知识片段向量的本地存储
+
+    - embeddings.npy：标准的.npy矩阵（float16或float32，已归一化），可以用np.load(mmap_mode='r')零拷贝读取，
+      多个进程映射同一个文件时共享操作系统的页缓存
+    - embeddings.ids：与矩阵逐行对应的ObjectId，每个12字节
+
+    只允许一个进程写入（知识库脚本），写入顺序为 向量 -> id -> 文件头中的行数，
+    所以读取方只会看到文件头声明的完整行，写入中途崩溃后多出的部分会在下次写入时被覆盖。
+    """
+    HEADER_SIZE = 128  # 固定长度的.npy文件头，行数变化时原地改写
+    ID_SIZE = 12
+
+    def __init__(self, directory: str = "data/knowledge_store", dtype: str = "float16"):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = os.path.join(directory, "embeddings.npy")
+        self.ids_path = os.path.join(directory, "embeddings.ids")
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None
+        self._ids: List[ObjectId] = []
+
+    def _write_header(self, f, rows: int, dim: int, dtype: np.dtype) -> None:
+        header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (rows, dim)})
+        header_length = self.HEADER_SIZE - 10  # 6字节魔数 + 2字节版本 + 2字节头长度
+        header = header.ljust(header_length - 1) + "\n"
+        f.seek(0)
+        f.write(np.lib.format.magic(1, 0))
+        f.write(header_length.to_bytes(2, "little"))
+        f.write(header.encode("latin1"))
+
+    def _read_header(self) -> Tuple[int, int, np.dtype]:
+        """返回(行数, 维度, 数据类型)，文件不存在时行数为0"""
+        if not os.path.exists(self.vectors_path):
+            return 0, 0, self.dtype
+        with open(self.vectors_path, "rb") as f:
+            np.lib.format.read_magic(f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        return shape[0], shape[1], dtype
+
+    def count(self) -> int:
+        return self._read_header()[0]
+
+    def append(self, ids: List[ObjectId], vectors) -> int:
+        """追加向量，向量会先归一化再按存储类型保存
+
+        Returns:
+            int: 追加后的总行数
+        """
+        if len(ids) == 0:
+            return self.count()
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix = matrix / norms
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            rows, dim, dtype = self._read_header()
+            if rows == 0 and not os.path.exists(self.vectors_path):
+                dim, dtype = matrix.shape[1], self.dtype
+                with open(self.vectors_path, "wb") as f:
+                    self._write_header(f, 0, dim, dtype)
+            if matrix.shape[1] != dim:
+                raise ValueError(f"向量维度不一致：已有{dim}维，新增{matrix.shape[1]}维")
+
+            data = matrix.astype(dtype).tobytes()
+            with open(self.vectors_path, "r+b") as f:
+                f.seek(self.HEADER_SIZE + rows * dim * dtype.itemsize)
+                f.write(data)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self.ids_path, "ab") as f:
+                # 丢掉上次写入中途失败留下的多余id
+                f.truncate(rows * self.ID_SIZE)
+                f.write(b"".join(doc_id.binary for doc_id in ids))
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self.vectors_path, "r+b") as f:
+                self._write_header(f, rows + len(ids), dim, dtype)
+            return rows + len(ids)
+
+    def load(self) -> Tuple[Optional[np.ndarray], List[ObjectId]]:
+        """以内存映射方式打开向量矩阵，行数没有变化时复用上次的映射
+
+        Returns:
+            Tuple[Optional[np.ndarray], List[ObjectId]]: 只读矩阵（没有数据时为None）和对应的id
+        """
+        with self._lock:
+            rows, _, _ = self._read_header()
+            if rows == 0:
+                return None, []
+            if self._matrix is not None and len(self._matrix) == rows:
+                return self._matrix, self._ids
+
+            with open(self.ids_path, "rb") as f:
+                f.seek(len(self._ids) * self.ID_SIZE)
+                raw = f.read((rows - len(self._ids)) * self.ID_SIZE)
+            new_ids = [ObjectId(raw[i:i + self.ID_SIZE]) for i in range(0, len(raw), self.ID_SIZE)]
+            self._ids = self._ids + new_ids
+            # id文件比矩阵短时（不应该发生）只使用两者都完整的部分
+            rows = min(rows, len(self._ids))
+            self._matrix = np.load(self.vectors_path, mmap_mode="r")[:rows]
+            self._ids = self._ids[:rows]
+            return self._matrix, self._ids
+
+    def import_from_collection(self, collection, remove_from_db: bool = False, batch_size: int = 1000) -> int:
+        """把knowledges集合中仍保存在embedding字段里的向量导入store（只应由知识库脚本调用）
+
+        Args:
+            collection: pymongo 的 knowledges 集合
+            remove_from_db: 导入后是否从数据库中删除embedding字段，删除后无法恢复原始精度的向量
+        Returns:
+            int: 新导入的向量数量
+        """
+        _, known_ids = self.load()
+        known = set(known_ids)
+        imported = 0
+        last_id = None
+        while True:
+            query = {"embedding": {"$exists": True}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            docs = list(collection.find(query, {"embedding": 1}).sort("_id", 1).limit(batch_size))
+            if not docs:
+                break
+            last_id = docs[-1]["_id"]
+            new_docs = [doc for doc in docs if doc["_id"] not in known and doc.get("embedding")]
+            if new_docs:
+                self.append([doc["_id"] for doc in new_docs], [doc["embedding"] for doc in new_docs])
+                known.update(doc["_id"] for doc in new_docs)
+                imported += len(new_docs)
+            if remove_from_db:
+                collection.update_many({"_id": {"$in": [doc["_id"] for doc in docs]}}, {"$unset": {"embedding": ""}})
+        if imported:
+            print(f"\033[1;32m[知识库]\033[0m 已将{imported}个向量从数据库导入本地存储")
+        return imported
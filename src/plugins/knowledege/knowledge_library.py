@@ -1,15 +1,24 @@
+import argparse
 import os
 import sys
+import asyncio
+import hashlib
 import numpy as np
 import requests
 import time
+from typing import List, Optional
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 # 添加项目根目录到 Python 路径
 root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 sys.path.append(root_path)
 
-from src.common.database import Database
-from src.plugins.chat.config import llm_config
+from src.common.database import Database, AsyncDatabase
+from src.common.llm_gateway import LLMGateway, LLMRequestError
+from src.plugins.chat.config import llm_config, global_config
+from src.plugins.knowledege.chunker import Chunk, split_chunks
+from src.plugins.knowledege.vector_index import VectorIndex, knowledge_store
 
 # 直接配置数据库连接信息
 Database.initialize(
@@ -21,10 +30,50 @@ Database.initialize(
     auth_source=os.getenv("MONGODB_AUTH_SOURCE")
 )
 
-class KnowledgeLibrary:
+def content_hash(text: str) -> str:
+    """片段内容的稳定哈希，Python内置的hash()每次运行结果不同，不能用来去重"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class IngestStats:
+    """导入过程的吞吐量统计"""
     def __init__(self):
+        self.start_time = time.time()
+        self.files = 0
+        self.failed_files = 0
+        self.segments = 0
+        self.skipped_segments = 0
+        self.removed_segments = 0
+        self.embedded_segments = 0
+        self.requests = 0
+        self.characters = 0
+
+    def report(self) -> None:
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        print(
+            f"\033[1;36m[知识库导入]\033[0m 用时{elapsed:.1f}秒，完成文件{self.files}个（失败{self.failed_files}个），"
+            f"片段{self.segments}个（新向量{self.embedded_segments}个，已存在跳过{self.skipped_segments}个，"
+            f"删除过期{self.removed_segments}个），"
+            f"向量请求{self.requests}次，{self.segments / elapsed:.1f}片段/秒，{self.characters / elapsed:.0f}字/秒"
+        )
+
+
+class KnowledgeLibrary:
+    EMBEDDING_MODEL = "BAAI/bge-m3"
+
+    def __init__(self, batch_size: int = 32, request_concurrency: int = 4, file_concurrency: int = 4,
+                 chunk_size: int = 300, chunk_overlap: int = 50):
         self.db = Database.get_instance()
         self.raw_info_dir = "data/raw_info"
+        self.batch_size = batch_size  # 每次向量请求的片段数
+        self.request_concurrency = request_concurrency  # 同时进行的向量请求数
+        self.file_concurrency = file_concurrency  # 同时处理的文件数
+        self.chunk_size = chunk_size  # 每个片段的最大字数
+        self.chunk_overlap = chunk_overlap  # 相邻片段重叠的最大字数
+        self.stats: Optional[IngestStats] = None
+        # 配置了本地存储时向量写入store，数据库只保存片段内容
+        self.store = knowledge_store
+        self.index = VectorIndex(store=self.store)
         self._ensure_dirs()
         
     def _ensure_dirs(self):
@@ -53,129 +102,247 @@ class KnowledgeLibrary:
         
     def process_files(self):
         """处理raw_info目录下的所有txt文件"""
-        for filename in os.listdir(self.raw_info_dir):
-            if filename.endswith('.txt'):
-                file_path = os.path.join(self.raw_info_dir, filename)
-                self.process_single_file(file_path)
-                
-    def process_single_file(self, file_path: str):
-        """处理单个文件"""
+        asyncio.run(self.process_files_async())
+
+    async def process_files_async(self):
+        """并发处理raw_info目录下的所有txt文件，中途失败的文件下次从断点继续"""
+        LLMGateway.initialize()
+        AsyncDatabase.initialize()
+        self.stats = IngestStats()
+        # 已经写入本地存储的片段，用来发现数据库里有、向量却没写入的片段（上次在两步之间中断）
+        self._stored_ids = set(self.store.load()[1]) if self.store is not None else set()
+        self._request_semaphore = asyncio.Semaphore(self.request_concurrency)
+        file_semaphore = asyncio.Semaphore(self.file_concurrency)
+
+        async def process_with_limit(file_path: str):
+            async with file_semaphore:
+                await self.process_single_file(file_path)
+
+        file_paths = [
+            os.path.join(self.raw_info_dir, filename)
+            for filename in os.listdir(self.raw_info_dir)
+            if filename.endswith('.txt')
+        ]
+        try:
+            await asyncio.gather(*[process_with_limit(file_path) for file_path in file_paths])
+        finally:
+            self.stats.report()
+            await LLMGateway.get_instance().close()
+
+    @property
+    def chunking(self) -> str:
+        """切分参数，参数变化后已处理的文件需要重新切分"""
+        return f"{self.chunk_size}/{self.chunk_overlap}"
+
+    async def process_single_file(self, file_path: str):
+        """处理单个文件，每完成一批片段记录一次断点
+
+        文件内容或切分参数变化后重新切分，内容没变的片段按哈希跳过，不再属于该文件的旧片段会被删除
+        """
+        adb = AsyncDatabase.get_instance()
         try:
-            # 检查文件是否已处理
-            if self.db.db.processed_files.find_one({"file_path": file_path}):
-                print(f"文件已处理过，跳过: {file_path}")
-                return
-                
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
-                
-            # 按1024字符分段
-            segments = [content[i:i+300] for i in range(0, len(content), 300)]
-            
-            # 处理每个分段
-            for segment in segments:
-                if not segment.strip():  # 跳过空段
-                    continue
-                    
-                # 获取embedding
-                embedding = self.get_embedding(segment)
-                if not embedding:
-                    continue
-                    
-                # 存储到数据库
-                doc = {
-                    "content": segment,
-                    "embedding": embedding,
-                    "file_path": file_path,
-                    "segment_length": len(segment)
-                }
-                
-                # 使用文本内容的哈希值作为唯一标识
-                content_hash = hash(segment)
-                
-                # 更新或插入文档
-                self.db.db.knowledges.update_one(
-                    {"content_hash": content_hash},
-                    {"$set": doc},
-                    upsert=True
+            file_hash = content_hash(content)
+
+            checkpoint = await adb.db.processed_files.find_one({"file_path": file_path})
+            # 断点只在文件内容和切分参数都没变时有效
+            unchanged = bool(checkpoint) and checkpoint.get("file_hash") == file_hash \
+                and checkpoint.get("chunking") == self.chunking
+            # 旧版本的记录没有status和file_hash字段，视为已完成
+            if checkpoint and checkpoint.get("status", "done") == "done" and (unchanged or "file_hash" not in checkpoint):
+                print(f"文件已处理过，跳过: {file_path}")
+                return
+
+            segments = split_chunks(content, self.chunk_size, self.chunk_overlap)
+            start = checkpoint.get("done_segments", 0) if unchanged else 0
+            if start:
+                print(f"从断点继续处理文件: {file_path}（已完成{start}/{len(segments)}个片段）")
+            elif checkpoint:
+                print(f"文件有变化，重新切分: {file_path}")
+            await adb.db.processed_files.update_one(
+                {"file_path": file_path},
+                {"$set": {"status": "processing", "total_segments": len(segments), "file_hash": file_hash,
+                          "chunking": self.chunking, "done_segments": start}},
+                upsert=True
+            )
+
+            batch_starts = list(range(start, len(segments), self.batch_size))
+            finished = set()
+            next_batch = 0
+
+            async def run_batch(batch_no: int, batch_start: int):
+                nonlocal next_batch
+                await self._ingest_batch(file_path, segments[batch_start:batch_start + self.batch_size])
+                finished.add(batch_no)
+                # 断点只推进到连续完成的批次，$max保证乱序写入时也不会回退
+                while next_batch in finished:
+                    next_batch += 1
+                done = min(len(segments), start + next_batch * self.batch_size)
+                await adb.db.processed_files.update_one({"file_path": file_path}, {"$max": {"done_segments": done}})
+
+            results = await asyncio.gather(
+                *[run_batch(batch_no, batch_start) for batch_no, batch_start in enumerate(batch_starts)],
+                return_exceptions=True
+            )
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors:
+                raise errors[0]
+
+            # 删除文件修改后不再出现的旧片段，先记录删除，运行中的机器人刷新索引时据此跳过这些片段
+            stale = await adb.db.knowledges.find({
+                "file_path": file_path,
+                "content_hash": {"$nin": [content_hash(segment.text) for segment in segments]}
+            }, {"_id": 1}).to_list(None)
+            if stale:
+                stale_ids = [doc["_id"] for doc in stale]
+                await adb.db.knowledge_tombstones.insert_many(
+                    [{"doc_id": doc_id, "deleted_at": time.time()} for doc_id in stale_ids], ordered=False
                 )
-                
+                result = await adb.db.knowledges.delete_many({"_id": {"$in": stale_ids}})
+                self.stats.removed_segments += result.deleted_count
+
             # 记录文件已处理
-            self.db.db.processed_files.insert_one({
-                "file_path": file_path,
-                "processed_time": time.time()
-            })
-                
+            await adb.db.processed_files.update_one(
+                {"file_path": file_path},
+                {"$set": {"status": "done", "done_segments": len(segments), "processed_time": time.time()}}
+            )
+            self.stats.files += 1
             print(f"成功处理文件: {file_path}")
-            
+
         except Exception as e:
+            self.stats.failed_files += 1
             print(f"处理文件 {file_path} 时出错: {str(e)}")
-            
+
+    @staticmethod
+    def _chunk_doc(file_path: str, chunk: Chunk) -> dict:
+        return {
+            "content": chunk.text,
+            "file_path": file_path,
+            "chunk_index": chunk.index,
+            "start": chunk.start,
+            "end": chunk.end,
+            "segment_length": len(chunk.text),
+            "updated_at": time.time(),  # 运行中的机器人刷新索引时据此重新读取位置
+        }
+
+    async def _ingest_batch(self, file_path: str, segments: List[Chunk]):
+        """为一批片段获取向量并批量写入数据库，已存在的片段不再请求向量，只更新位置信息"""
+        adb = AsyncDatabase.get_instance()
+        batch = {}
+        for segment in segments:
+            if segment.text:
+                batch.setdefault(content_hash(segment.text), segment)
+        self.stats.segments += len(segments)
+        self.stats.characters += sum(len(segment.text) for segment in segments)
+        if not batch:
+            return
+
+        existing = await adb.db.knowledges.find(
+            {"content_hash": {"$in": list(batch.keys())}}, {"content_hash": 1}
+        ).to_list(None)
+        missing_vectors = {}
+        unchanged = {}
+        for doc in existing:
+            if self.store is not None and doc["_id"] not in self._stored_ids:
+                missing_vectors[doc["content_hash"]] = doc["_id"]
+                continue
+            unchanged[doc["content_hash"]] = batch.pop(doc["content_hash"])
+            self.stats.skipped_segments += 1
+        # 内容没变的片段在文件中的位置可能变了
+        updates = [
+            UpdateOne({"content_hash": h}, {"$set": self._chunk_doc(file_path, segment)})
+            for h, segment in unchanged.items()
+        ]
+        if not batch:
+            if updates:
+                await adb.db.knowledges.bulk_write(updates, ordered=False)
+            return
+
+        hashes = list(batch.keys())
+        async with self._request_semaphore:
+            embeddings = await LLMGateway.get_instance().embeddings(
+                self.EMBEDDING_MODEL, [batch[h].text for h in hashes]
+            )
+        self.stats.requests += 1
+
+        operations = []
+        for h, embedding in zip(hashes, embeddings):
+            doc = self._chunk_doc(file_path, batch[h])
+            if self.store is None:
+                doc["embedding"] = embedding
+            operations.append(UpdateOne({"content_hash": h}, {"$set": doc}, upsert=True))
+        # 新片段放在前面，upserted_ids的下标与hashes对应
+        operations += updates
+
+        try:
+            result = await adb.db.knowledges.bulk_write(operations, ordered=False)
+            upserted = result.upserted_ids
+        except BulkWriteError as e:
+            # 并发批次之间偶尔会同时插入相同内容，重复键错误可以忽略
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+            upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+
+        new_items = [(upserted[i], embeddings[i], batch[hashes[i]]) for i in sorted(upserted) if i < len(hashes)]
+        new_items += [
+            (missing_vectors[h], embedding, batch[h])
+            for h, embedding in zip(hashes, embeddings) if h in missing_vectors
+        ]
+        if self.store is not None:
+            # 新片段的向量写入本地存储
+            await adb.run(self.store.append, [item[0] for item in new_items], [item[1] for item in new_items])
+            self._stored_ids.update(item[0] for item in new_items)
+        else:
+            for doc_id, embedding, segment in new_items:
+                self.index.add(doc_id, embedding, segment.text, file_path, segment.start, segment.end)
+        self.stats.embedded_segments += len(new_items)
+
+    def migrate_content_hashes(self) -> int:
+        """把旧版本用hash()生成的content_hash改为稳定的sha256，内容重复的旧片段直接删除"""
+        migrated = 0
+        for doc in self.db.db.knowledges.find({"content_hash": {"$not": {"$type": "string"}}}, {"content": 1}):
+            try:
+                self.db.db.knowledges.update_one(
+                    {"_id": doc["_id"]}, {"$set": {"content_hash": content_hash(doc.get("content", ""))}}
+                )
+            except DuplicateKeyError:
+                self.db.db.knowledge_tombstones.insert_one({"doc_id": doc["_id"], "deleted_at": time.time()})
+                self.db.db.knowledges.delete_one({"_id": doc["_id"]})
+            migrated += 1
+        if migrated:
+            print(f"\033[1;32m[知识库]\033[0m 已更新{migrated}个片段的内容哈希")
+        return migrated
+
     def search_similar_segments(self, query: str, limit: int = 5) -> list:
         """搜索与查询文本相似的片段"""
         query_embedding = self.get_embedding(query)
         if not query_embedding:
             return []
             
-        # 使用余弦相似度计算
-        pipeline = [
-            {
-                "$addFields": {
-                    "dotProduct": {
-                        "$reduce": {
-                            "input": {"$range": [0, {"$size": "$embedding"}]},
-                            "initialValue": 0,
-                            "in": {
-                                "$add": [
-                                    "$$value",
-                                    {"$multiply": [
-                                        {"$arrayElemAt": ["$embedding", "$$this"]},
-                                        {"$arrayElemAt": [query_embedding, "$$this"]}
-                                    ]}
-                                ]
-                            }
-                        }
-                    },
-                    "magnitude1": {
-                        "$sqrt": {
-                            "$reduce": {
-                                "input": "$embedding",
-                                "initialValue": 0,
-                                "in": {"$add": ["$$value", {"$multiply": ["$$this", "$$this"]}]}
-                            }
-                        }
-                    },
-                    "magnitude2": {
-                        "$sqrt": {
-                            "$reduce": {
-                                "input": query_embedding,
-                                "initialValue": 0,
-                                "in": {"$add": ["$$value", {"$multiply": ["$$this", "$$this"]}]}
-                            }
-                        }
-                    }
-                }
-            },
-            {
-                "$addFields": {
-                    "similarity": {
-                        "$divide": ["$dotProduct", {"$multiply": ["$magnitude1", "$magnitude2"]}]
-                    }
-                }
-            },
-            {"$sort": {"similarity": -1}},
-            {"$limit": limit},
-            {"$project": {"content": 1, "similarity": 1, "file_path": 1}}
-        ]
-        
-        results = list(self.db.db.knowledges.aggregate(pipeline))
-        return results
+        # 增量加载其他进程写入的片段，然后在内存中搜索
+        self.index.refresh(self.db.db.knowledges)
+        return self.index.search(query_embedding, limit=limit)
 
 # 创建单例实例
-knowledge_library = KnowledgeLibrary()
+knowledge_library = KnowledgeLibrary(
+    chunk_size=global_config.knowledge_chunk_size,
+    chunk_overlap=global_config.knowledge_chunk_overlap,
+)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="处理data/raw_info中的知识库文件")
+    parser.add_argument("--remove-db-embeddings", action="store_true",
+                        help="把数据库中的向量导入本地存储后删除数据库中的embedding字段（不可恢复）")
+    args = parser.parse_args()
+
     # 测试知识库功能
+    knowledge_library.migrate_content_hashes()
+    if knowledge_library.store is not None:
+        # 把数据库中旧格式的向量导入本地存储，默认保留数据库中的原始向量
+        knowledge_library.store.import_from_collection(
+            knowledge_library.db.db.knowledges, remove_from_db=args.remove_db_embeddings
+        )
     print("开始处理知识库文件...")
     knowledge_library.process_files()
     
@@ -0,0 +1,320 @@
+import datetime
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from bson import ObjectId
+from ..chat.config import global_config
+from .embedding_store import EmbeddingStore
+
+
+class VectorIndex:
+    """知识片段的进程内向量索引
+
+    向量归一化后存成float32矩阵，余弦相似度就是一次矩阵乘法。
+    - flat 模式：对全部向量做矩阵乘法再取top-k，结果精确
+    - ivf 模式：先用球面k-means把向量分成若干簇，查询时只计算最接近的nprobe个簇，适合大规模知识库
+
+    指定store时向量直接来自内存映射的EmbeddingStore（不复制），数据库中只读取片段内容；
+    否则从knowledges集合的embedding字段加载到内存。
+    知识库脚本重新导入文件后，刷新时按updated_at重新读取位置变化的片段，按knowledge_tombstones标记删除的片段
+    """
+    # 增量刷新时往前多查一段时间，避免漏掉其他进程同一秒内写入、_id反而更小的文档
+    REFRESH_OVERLAP_SECONDS = 10
+
+    BLOCK_SIZE = 16384  # 非float32的向量分块转换后再计算，避免一次性复制整个矩阵
+
+    DOC_FIELDS = {"content": 1, "file_path": 1, "start": 1, "end": 1}
+    DEAD_DOC = {"content": None, "file_path": None, "start": None, "end": None}  # 已删除的片段，搜索时跳过
+
+    def __init__(self, mode: str = "flat", nprobe: int = 8, ivf_min_size: int = 10000,
+                 store: Optional[EmbeddingStore] = None):
+        self.mode = mode
+        self.store = store
+        self.nprobe = nprobe
+        self.ivf_min_size = ivf_min_size
+
+        self._vectors: Optional[np.ndarray] = None  # 预留了容量的矩阵，前_size行有效
+        self._size = 0
+        self._ids: List[ObjectId] = []
+        self._rows: Dict[ObjectId, int] = {}  # _id -> 行号
+        self._docs: List[Dict[str, Any]] = []
+        self.last_id: Optional[ObjectId] = None
+        self._synced_at: Optional[float] = None  # 上次同步片段更新和删除的时间
+        self._from_store: Optional[bool] = None  # 第一次刷新时决定向量来自store还是数据库
+        self._lock = threading.Lock()
+
+        # ivf 相关
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[List[int]] = []
+        self._ivf_built_size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _append(self, ids: List[ObjectId], vectors: np.ndarray, docs: List[Dict[str, Any]]) -> None:
+        """追加已归一化的向量，容量不够时按两倍扩容，调用方需持有锁"""
+        count = len(ids)
+        if count == 0:
+            return
+        if self._vectors is None:
+            self._vectors = np.empty((max(count, 1024), vectors.shape[1]), dtype=np.float32)
+        elif self._size + count > len(self._vectors):
+            new_capacity = max(self._size + count, len(self._vectors) * 2)
+            new_vectors = np.empty((new_capacity, self._vectors.shape[1]), dtype=np.float32)
+            new_vectors[:self._size] = self._vectors[:self._size]
+            self._vectors = new_vectors
+        start = self._size
+        self._vectors[start:start + count] = vectors
+        self._size += count
+        self._ids.extend(ids)
+        self._rows.update((doc_id, start + offset) for offset, doc_id in enumerate(ids))
+        self._docs.extend(docs)
+        for doc_id in ids:
+            if self.last_id is None or doc_id > self.last_id:
+                self.last_id = doc_id
+
+        if self._centroids is not None:
+            # 新向量直接归入最近的簇，簇的数量明显不够时再重建
+            assignments = np.argmax(vectors @ self._centroids.T, axis=1)
+            for offset, cluster in enumerate(assignments):
+                self._lists[cluster].append(start + offset)
+
+    @staticmethod
+    def _to_float32(vectors: np.ndarray) -> np.ndarray:
+        return vectors if vectors.dtype == np.float32 else vectors.astype(np.float32)
+
+    def _similarities(self, vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """计算每一行与查询向量的点积"""
+        if vectors.dtype == np.float32:
+            return vectors @ query
+        # float16等类型没有BLAS加速，分块转换成float32
+        return np.concatenate([
+            self._to_float32(vectors[start:start + self.BLOCK_SIZE]) @ query
+            for start in range(0, len(vectors), self.BLOCK_SIZE)
+        ])
+
+    @staticmethod
+    def _doc_info(doc: Dict[str, Any]) -> Dict[str, Any]:
+        """索引中保存的片段信息，start/end 为片段在原文件中的位置，用于合并相邻的检索结果"""
+        return {"content": doc.get("content", ""), "file_path": doc.get("file_path"),
+                "start": doc.get("start"), "end": doc.get("end")}
+
+    def add(self, doc_id: ObjectId, embedding: List[float], content: str, file_path: Optional[str] = None,
+            start: Optional[int] = None, end: Optional[int] = None) -> None:
+        """添加单个片段，已存在的片段会被忽略；使用store时写入store，下次refresh时生效"""
+        if doc_id in self._rows or embedding is None or len(embedding) == 0:
+            return
+        if self.store is not None:
+            self.store.append([doc_id], [embedding])
+            return
+        vector = self._normalize(np.asarray([embedding], dtype=np.float32))
+        with self._lock:
+            self._append([doc_id], vector, [{"content": content, "file_path": file_path, "start": start, "end": end}])
+
+    def refresh(self, collection, batch_size: int = 5000) -> int:
+        """从knowledges集合增量加载新片段（同步方法，应在线程池中调用）
+
+        Args:
+            collection: pymongo 的 knowledges 集合
+        Returns:
+            int: 新加载的片段数量
+        """
+        synced_at = time.time()
+        if self._from_store is None:
+            self._from_store = self.store is not None and not self._has_unimported_vectors(collection)
+        if self._synced_at is not None:
+            self._sync_changes(collection, self._synced_at - self.REFRESH_OVERLAP_SECONDS)
+        if self._from_store:
+            added = self._refresh_from_store(collection)
+        else:
+            added = self._refresh_from_collection(collection, batch_size)
+        self._synced_at = synced_at
+
+        if self.mode == "ivf" and self._size >= self.ivf_min_size and self._size >= self._ivf_built_size * 2:
+            self.build_ivf()
+        return added
+
+    def _has_unimported_vectors(self, collection) -> bool:
+        """store为空而数据库中还有旧格式的向量时，先从数据库加载，避免知识库检索不到任何内容"""
+        if self.store.count() > 0 or collection.find_one({"embedding": {"$exists": True}}, {"_id": 1}) is None:
+            return False
+        print("\033[1;33m[知识库]\033[0m 本地向量存储为空，暂时从数据库加载向量；"
+              "运行知识库脚本（knowledge_library.py）导入后重启即可使用本地存储")
+        return True
+
+    def _sync_changes(self, collection, since: float) -> None:
+        """其他进程重新导入文件后，更新已加载片段的内容和位置，删除的片段标记为失效"""
+        updated = [
+            (self._rows[doc["_id"]], self._doc_info(doc))
+            for doc in collection.find({"updated_at": {"$gt": since}}, self.DOC_FIELDS)
+            if doc["_id"] in self._rows
+        ]
+        deleted = [
+            self._rows[tombstone["doc_id"]]
+            for tombstone in collection.database.knowledge_tombstones.find({"deleted_at": {"$gt": since}}, {"doc_id": 1})
+            if tombstone.get("doc_id") in self._rows
+        ]
+        with self._lock:
+            for row, doc in updated:
+                self._docs[row] = doc
+            for row in deleted:
+                self._docs[row] = dict(self.DEAD_DOC)
+
+    def _refresh_from_store(self, collection) -> int:
+        matrix, store_ids = self.store.load()
+        if matrix is None or len(store_ids) <= self._size:
+            return 0
+        start = self._size
+        new_ids = store_ids[start:]
+
+        # 向量在store里，数据库中只取片段内容
+        docs_by_id: Dict[ObjectId, Dict[str, Any]] = {}
+        for i in range(0, len(new_ids), 1000):
+            for doc in collection.find({"_id": {"$in": new_ids[i:i + 1000]}}, self.DOC_FIELDS):
+                docs_by_id[doc["_id"]] = self._doc_info(doc)
+        # 数据库中已删除的片段保留占位，搜索时跳过
+        new_docs = [docs_by_id.get(doc_id, dict(self.DEAD_DOC)) for doc_id in new_ids]
+
+        with self._lock:
+            self._vectors = matrix
+            self._size = len(store_ids)
+            self._ids.extend(new_ids)
+            self._rows.update((doc_id, start + offset) for offset, doc_id in enumerate(new_ids))
+            self._docs.extend(new_docs)
+            self.last_id = max(self.last_id, max(new_ids)) if self.last_id is not None else max(new_ids)
+            if self._centroids is not None:
+                for block_start in range(start, self._size, self.BLOCK_SIZE):
+                    block = self._to_float32(matrix[block_start:min(self._size, block_start + self.BLOCK_SIZE)])
+                    assignments = np.argmax(block @ self._centroids.T, axis=1)
+                    for offset, cluster in enumerate(assignments):
+                        self._lists[cluster].append(block_start + offset)
+        return len(new_ids)
+
+    def _refresh_from_collection(self, collection, batch_size: int) -> int:
+        query: Dict[str, Any] = {"embedding": {"$exists": True}}
+        if self.last_id is not None:
+            since = self.last_id.generation_time - datetime.timedelta(seconds=self.REFRESH_OVERLAP_SECONDS)
+            query["_id"] = {"$gt": ObjectId.from_datetime(since)}
+
+        added = 0
+        ids, vectors, docs = [], [], []
+        cursor = collection.find(query, {**self.DOC_FIELDS, "embedding": 1}).sort("_id", 1)
+        for doc in cursor:
+            if doc["_id"] in self._rows or len(doc.get("embedding") or []) == 0:
+                continue
+            ids.append(doc["_id"])
+            vectors.append(doc["embedding"])
+            docs.append(self._doc_info(doc))
+            if len(ids) >= batch_size:
+                added += self._add_batch(ids, vectors, docs)
+                ids, vectors, docs = [], [], []
+        added += self._add_batch(ids, vectors, docs)
+        return added
+
+    def _add_batch(self, ids: List[ObjectId], vectors: List[List[float]], docs: List[Dict[str, Any]]) -> int:
+        if not ids:
+            return 0
+        matrix = self._normalize(np.asarray(vectors, dtype=np.float32))
+        with self._lock:
+            self._append(ids, matrix, docs)
+        return len(ids)
+
+    def build_ivf(self, nlist: Optional[int] = None, iterations: int = 10, sample_size: int = 50000) -> None:
+        """用球面k-means构建倒排簇，簇数默认为sqrt(n)"""
+        with self._lock:
+            size = self._size
+            vectors = self._vectors[:size]
+        if size == 0:
+            return
+        nlist = nlist or max(1, int(np.sqrt(size)))
+        rng = np.random.default_rng(0)
+        sample = self._to_float32(vectors[np.sort(rng.choice(size, size=min(size, sample_size), replace=False))])
+        centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(len(centroids)):
+                members = sample[assignments == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids = self._normalize(centroids)
+
+        lists: List[List[int]] = [[] for _ in range(len(centroids))]
+        for start in range(0, size, 10000):
+            assignments = np.argmax(self._to_float32(vectors[start:start + 10000]) @ centroids.T, axis=1)
+            for offset, cluster in enumerate(assignments):
+                lists[cluster].append(start + offset)
+
+        with self._lock:
+            # 构建期间新增的向量补充分配
+            for index in range(size, self._size):
+                lists[int(np.argmax(centroids @ self._to_float32(self._vectors[index])))].append(index)
+            self._centroids = centroids
+            self._lists = lists
+            self._ivf_built_size = self._size
+        print(f"\033[1;32m[知识库]\033[0m 向量索引已分为{len(centroids)}个簇，共{size}个片段")
+
+    def search(self, query_embedding: List[float], limit: int = 5, threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+        """搜索最相似的片段
+
+        Returns:
+            List[Dict]: 按相似度从高到低排列，包含 _id/content/file_path/start/end/similarity
+        """
+        if query_embedding is None or len(query_embedding) == 0 or self._size == 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+
+        with self._lock:
+            vectors = self._vectors[:self._size]
+            centroids = self._centroids
+            if centroids is not None:
+                probe = np.argsort(centroids @ query)[::-1][:self.nprobe]
+                candidates = np.fromiter(
+                    (index for cluster in probe for index in self._lists[cluster]), dtype=np.int64
+                )
+            else:
+                candidates = None
+
+        if candidates is not None:
+            if len(candidates) == 0:
+                return []
+            # 按行号顺序读取，内存映射时访问更连续
+            candidates = np.sort(candidates)
+            similarities = self._to_float32(vectors[candidates]) @ query
+        else:
+            similarities = self._similarities(vectors, query)
+
+        k = min(limit, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+
+        results = []
+        for position in top:
+            similarity = float(similarities[position])
+            if threshold is not None and similarity < threshold:
+                break
+            index = int(candidates[position]) if candidates is not None else int(position)
+            if self._docs[index]["content"] is None:
+                continue
+            results.append({"_id": self._ids[index], **self._docs[index], "similarity": similarity})
+        return results
+
+
+knowledge_store = EmbeddingStore(global_config.knowledge_store_path, global_config.knowledge_store_dtype) if global_config.knowledge_store_path else None
+knowledge_index = VectorIndex(
+    mode=global_config.knowledge_index_mode,
+    nprobe=global_config.knowledge_index_nprobe,
+    store=knowledge_store,
+)
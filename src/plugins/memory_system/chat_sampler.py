@@ -0,0 +1,190 @@
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+# 记忆构建的取样时间段：(名称, 距今最近, 距今最远)，单位秒
+SAMPLE_PERIODS = [
+    ('near', 0, 3600),
+    ('mid', 3600, 3600 * 4),
+    ('far', 3600 * 4, 3600 * 24),
+]
+
+
+def bucket_start(timestamp: float, bucket_seconds: int) -> int:
+    """消息所在时间桶的起始时间"""
+    return int(timestamp // bucket_seconds) * bucket_seconds
+
+
+def bucket_updates(docs: Iterable[dict], bucket_seconds: int) -> List[UpdateOne]:
+    """把一批新写入的消息汇总成按群、按时间桶累加消息数和字数的数据库操作"""
+    counts: Dict[Tuple[int, int], List[int]] = defaultdict(lambda: [0, 0])
+    for doc in docs:
+        if doc.get('group_id') is None or doc.get('time') is None:
+            continue
+        count = counts[(doc['group_id'], bucket_start(doc['time'], bucket_seconds))]
+        count[0] += 1
+        count[1] += len(doc.get('processed_plain_text') or '')
+    return [
+        UpdateOne(
+            {'group_id': group_id, 'bucket': bucket},
+            {'$inc': {'count': count, 'chars': chars}},
+            upsert=True
+        )
+        for (group_id, bucket), (count, chars) in counts.items()
+    ]
+
+
+@dataclass
+class ChatWindow:
+    """一段取样的聊天记录，压缩成记忆后标记对应的时间桶"""
+    group_id: int
+    bucket: int
+    text: str
+    message_count: int
+    last_time: float
+    last_id: Any  # 最后一条消息的_id，消息时间只精确到秒，同一秒内按_id继续
+
+
+class ChatSampler:
+    """按群、按时间桶统计的消息数挑选聊天记录用于构建记忆
+
+    一次聚合查询取出最近一天内还有足够多未压缩消息的时间桶，按字数加权抽取，
+    同一个群相邻的时间桶不会同时被抽中，压缩过的消息不会再被取到。
+    """
+
+    def __init__(self, db, bucket_seconds: int = 600, min_messages: int = 5):
+        self.db = db
+        self.bucket_seconds = bucket_seconds
+        self.min_messages = min_messages
+
+    def _candidate_buckets(self, now: float) -> List[dict]:
+        """取出一天内未压缩消息数不少于min_messages的时间桶"""
+        return list(self.db.db.message_buckets.aggregate([
+            {'$match': {'bucket': {'$gte': bucket_start(now - SAMPLE_PERIODS[-1][2], self.bucket_seconds)}}},
+            {'$project': {
+                'group_id': 1, 'bucket': 1, 'count': 1, 'chars': 1, 'compressed_until': 1, 'compressed_id': 1,
+                'remaining': {'$subtract': ['$count', {'$ifNull': ['$compressed_count', 0]}]},
+            }},
+            {'$match': {'remaining': {'$gte': self.min_messages}}},
+        ]))
+
+    def _pick(self, buckets: List[dict], counts: Dict[str, int], now: float) -> List[dict]:
+        """按时间段抽取时间桶，字数越多越容易被抽中，同一个群相邻的时间桶只取一个"""
+        by_period: Dict[str, List[dict]] = defaultdict(list)
+        for bucket in buckets:
+            age = now - bucket['bucket']
+            for name, nearest, farthest in SAMPLE_PERIODS:
+                if nearest <= age < farthest:
+                    by_period[name].append(bucket)
+                    break
+
+        picked: List[dict] = []
+        taken = set()
+        for name, _, _ in SAMPLE_PERIODS:
+            candidates = by_period[name]
+            for _ in range(counts.get(name, 0)):
+                candidates = [
+                    bucket for bucket in candidates
+                    if (bucket['group_id'], bucket['bucket']) not in taken
+                ]
+                if not candidates:
+                    break
+                # 估算未压缩部分的字数
+                weights = [max(bucket.get('chars', 0) * bucket['remaining'] / max(bucket['count'], 1), 1)
+                           for bucket in candidates]
+                bucket = random.choices(candidates, weights=weights)[0]
+                picked.append(bucket)
+                for offset in (-self.bucket_seconds, 0, self.bucket_seconds):
+                    taken.add((bucket['group_id'], bucket['bucket'] + offset))
+        return picked
+
+    def _fetch_window(self, bucket: dict, chat_size: int) -> Optional[ChatWindow]:
+        """取出时间桶里还没压缩过的前chat_size条消息，从上次压缩到的(时间, _id)之后继续"""
+        start, start_id = bucket.get('compressed_until'), bucket.get('compressed_id')
+        query = {'group_id': bucket['group_id'], 'time': {'$lt': bucket['bucket'] + self.bucket_seconds}}
+        if start is None:
+            query['time']['$gte'] = bucket['bucket']
+        elif start_id is None:
+            # 旧版本只记录了时间
+            query['time']['$gt'] = start
+        else:
+            query['time']['$gte'] = start
+            query['$or'] = [{'time': {'$gt': start}}, {'_id': {'$gt': start_id}}]
+        records = list(self.db.db.messages.find(
+            query, {'time': 1, 'user_id': 1, 'user_nickname': 1, 'processed_plain_text': 1}
+        ).sort([('time', 1), ('_id', 1)]).limit(chat_size))
+        if not records:
+            return None
+        chat_text = ''
+        for record in records:
+            time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(record['time'])))
+            chat_text += f'[{time_str}] {record["user_nickname"] or "用户" + str(record["user_id"])}: {record["processed_plain_text"]}\n'
+        return ChatWindow(
+            group_id=bucket['group_id'],
+            bucket=bucket['bucket'],
+            text=chat_text,
+            message_count=len(records),
+            last_time=records[-1]['time'],
+            last_id=records[-1]['_id'],
+        )
+
+    def sample(self, chat_size: int, counts: Dict[str, int]) -> List[ChatWindow]:
+        """抽取聊天记录（同步方法，应在线程池中调用）
+
+        Args:
+            chat_size: 每段聊天记录的最大消息数
+            counts: 每个时间段抽取的段数，如 {'near': 1, 'mid': 2, 'far': 2}
+        """
+        now = time.time()
+        picked = self._pick(self._candidate_buckets(now), counts, now)
+        windows = [self._fetch_window(bucket, chat_size) for bucket in picked]
+        return [window for window in windows if window]
+
+    def mark_compressed(self, windows: List[ChatWindow]) -> None:
+        """记录已经压缩成记忆的消息，下次只取之后的消息"""
+        if not windows:
+            return
+        self.db.db.message_buckets.bulk_write([
+            UpdateOne(
+                {'group_id': window.group_id, 'bucket': window.bucket},
+                {'$inc': {'compressed_count': window.message_count},
+                 '$set': {'compressed_until': window.last_time, 'compressed_id': window.last_id}}
+            )
+            for window in windows
+        ], ordered=False)
+
+    def backfill(self, since: Optional[float] = None) -> int:
+        """时间桶统计为空时（第一次启动），从已有的消息中补建统计，返回补建的时间桶数
+
+        Args:
+            since: 从这个时间之后的消息补建，默认为取样范围（最近一天）
+        """
+        if self.db.db.message_buckets.find_one({}, {'_id': 1}) is not None:
+            return 0
+        if since is None:
+            since = time.time() - SAMPLE_PERIODS[-1][2]
+        buckets = list(self.db.db.messages.aggregate([
+            {'$match': {'time': {'$gte': since}, 'group_id': {'$ne': None}}},
+            {'$group': {
+                '_id': {
+                    'group_id': '$group_id',
+                    'bucket': {'$subtract': [{'$toLong': '$time'}, {'$mod': [{'$toLong': '$time'}, self.bucket_seconds]}]},
+                },
+                'count': {'$sum': 1},
+                'chars': {'$sum': {'$strLenCP': {'$ifNull': ['$processed_plain_text', '']}}},
+            }},
+        ]))
+        if buckets:
+            self.db.db.message_buckets.bulk_write([
+                UpdateOne(
+                    {'group_id': bucket['_id']['group_id'], 'bucket': bucket['_id']['bucket']},
+                    {'$inc': {'count': bucket['count'], 'chars': bucket['chars']}},
+                    upsert=True
+                )
+                for bucket in buckets
+            ], ordered=False)
+        return len(buckets)
@@ -0,0 +1,376 @@
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+
+class CompactGraph:
+    """紧凑的记忆图存储
+
+    - 概念映射为从0开始的整数id，记忆文本放在共享的字符串表中，重复的记忆只存一份
+    - 邻接关系和每个概念的记忆都以CSR数组保存：indptr[i]:indptr[i+1] 是第i个概念的那一段
+    - 新增的边和记忆先写入追加日志（普通dict），日志变大后合并进CSR数组（compact）
+    - 删除边时写入负的连接次数，合并时去掉连接次数不大于0的边；删除的概念只从名字映射中移除，
+      留下的空位在下次整体加载时回收
+
+    节点上十万时比networkx的dict套dict省好几倍内存，两层查询只是几次连续的数组切片
+    """
+
+    def __init__(self, compact_threshold: int = 4096):
+        self.compact_threshold = compact_threshold  # 日志中的条目数超过这个值时自动合并
+
+        self._concepts: List[str] = []
+        self._concept_ids: Dict[str, int] = {}
+        self._last_modified: List[Optional[float]] = []  # 每个概念最后一次加入记忆的时间
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+
+        # 已合并部分：邻接表（列号有序，无向边两个方向各存一次）和记忆表
+        self._adj_indptr = np.zeros(1, dtype=np.int64)
+        self._adj_indices = np.zeros(0, dtype=np.int32)
+        self._adj_weights = np.zeros(0, dtype=np.float32)
+        self._item_indptr = np.zeros(1, dtype=np.int64)
+        self._item_indices = np.zeros(0, dtype=np.int32)
+
+        # 追加日志：边的key为(小id, 大id)，值为连接次数的变化量
+        self._log_edges: Dict[Tuple[int, int], float] = {}
+        self._log_neighbors: Dict[int, Set[int]] = {}
+        self._log_items: Dict[int, List[int]] = {}
+        self._replaced_items: Set[int] = set()  # 记忆被整体替换的概念，已合并部分中的旧记忆作废
+        self._log_size = 0
+
+    # ---------- 基础 ----------
+
+    def __contains__(self, concept: str) -> bool:
+        return concept in self._concept_ids
+
+    def __len__(self) -> int:
+        return len(self._concept_ids)
+
+    def nodes(self) -> List[str]:
+        return list(self._concept_ids)
+
+    def number_of_nodes(self) -> int:
+        return len(self._concept_ids)
+
+    def number_of_edges(self) -> int:
+        return sum(1 for _ in self.edges())
+
+    def clear(self) -> None:
+        self.__init__(self.compact_threshold)
+
+    def _node_id(self, concept: str) -> int:
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            node_id = len(self._concepts)
+            self._concept_ids[concept] = node_id
+            self._concepts.append(concept)
+            self._last_modified.append(None)
+        return node_id
+
+    def _string_id(self, text: str) -> int:
+        string_id = self._string_ids.get(text)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._string_ids[text] = string_id
+            self._strings.append(text)
+        return string_id
+
+    def _base_slice(self, indptr: np.ndarray, node_id: int) -> Tuple[int, int]:
+        """已合并部分中某个概念的范围，合并后新增的概念没有数据"""
+        if node_id + 1 >= len(indptr):
+            return 0, 0
+        return int(indptr[node_id]), int(indptr[node_id + 1])
+
+    def _base_items(self, node_id: int) -> Tuple[int, int]:
+        """已合并部分中某个概念的记忆范围，记忆被整体替换过的概念为空"""
+        if node_id in self._replaced_items:
+            return 0, 0
+        return self._base_slice(self._item_indptr, node_id)
+
+    # ---------- 写入 ----------
+
+    def add_node(self, concept: str, memory_items: Iterable[str] = ()) -> None:
+        node_id = self._node_id(concept)
+        for memory in memory_items:
+            self._log_items.setdefault(node_id, []).append(self._string_id(memory))
+            self._log_size += 1
+            self._last_modified[node_id] = time.time()
+        self._maybe_compact()
+
+    def add_memory(self, concept: str, memory: str) -> None:
+        self.add_node(concept, (memory,))
+
+    def _add_edge_delta(self, u: int, v: int, delta: float) -> None:
+        key = (u, v) if u < v else (v, u)
+        self._log_edges[key] = self._log_edges.get(key, 0) + delta
+        self._log_neighbors.setdefault(u, set()).add(v)
+        self._log_neighbors.setdefault(v, set()).add(u)
+        self._log_size += 1
+
+    def add_edge(self, concept1: str, concept2: str, num: float = 1) -> None:
+        """增加两个概念之间的连接次数（与networkx不同，已有的边会累加而不是覆盖）"""
+        u, v = self._node_id(concept1), self._node_id(concept2)
+        if u == v:
+            return
+        self._add_edge_delta(u, v, num)
+        self._maybe_compact()
+
+    def set_edge_num(self, concept1: str, concept2: str, num: float) -> None:
+        """把两个概念之间的连接次数设为num，num不大于0时删除这条边"""
+        u, v = self._concept_ids.get(concept1), self._concept_ids.get(concept2)
+        if u is None or v is None or u == v:
+            return
+        self._add_edge_delta(u, v, max(num, 0) - self._edge_num(u, v))
+        self._maybe_compact()
+
+    def remove_edge(self, concept1: str, concept2: str) -> None:
+        self.set_edge_num(concept1, concept2, 0)
+
+    def set_memory_items(self, concept: str, memory_items: List[str]) -> None:
+        """整体替换概念的记忆（不更新最后修改时间）"""
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return
+        self._replaced_items.add(node_id)
+        self._log_items[node_id] = [self._string_id(memory) for memory in memory_items]
+        self._log_size += 1
+        self._maybe_compact()
+
+    def remove_node(self, concept: str) -> None:
+        """删除概念及其所有边"""
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return
+        neighbors, _ = self._neighbor_weights(node_id)
+        for neighbor in neighbors.tolist():
+            self._add_edge_delta(node_id, neighbor, -self._edge_num(node_id, neighbor))
+        self._replaced_items.add(node_id)
+        self._log_items.pop(node_id, None)
+        self._log_size += 1
+        del self._concept_ids[self._concepts[node_id]]
+        self._maybe_compact()
+
+    def _maybe_compact(self) -> None:
+        if self._log_size >= max(self.compact_threshold, len(self._adj_indices) // 10):
+            self.compact()
+
+    def compact(self) -> None:
+        """把追加日志合并进CSR数组"""
+        if not self._log_size:
+            return
+        n = len(self._concepts)
+
+        # 邻接表：旧的COO + 日志中的边（两个方向），按(行, 列)排序后把重复的边权重相加，去掉已删除的边
+        old_rows = np.repeat(np.arange(len(self._adj_indptr) - 1, dtype=np.int64), np.diff(self._adj_indptr))
+        if self._log_edges:
+            log_keys = np.array(list(self._log_edges.keys()), dtype=np.int64)
+            log_weights = np.fromiter(self._log_edges.values(), dtype=np.float64, count=len(self._log_edges))
+            rows = np.concatenate([old_rows, log_keys[:, 0], log_keys[:, 1]])
+            cols = np.concatenate([self._adj_indices.astype(np.int64), log_keys[:, 1], log_keys[:, 0]])
+            weights = np.concatenate([self._adj_weights.astype(np.float64), log_weights, log_weights])
+            keys = rows * n + cols
+            order = np.argsort(keys, kind="stable")
+            keys, weights = keys[order], weights[order]
+            unique_keys, first = np.unique(keys, return_index=True)
+            weights = np.add.reduceat(weights, first) if len(first) else weights
+            # 浮点误差留下的极小权重也当作已删除
+            alive = weights > 1e-6
+            unique_keys, weights = unique_keys[alive], weights[alive]
+            rows, cols = unique_keys // n, unique_keys % n
+        else:
+            rows, cols, weights = old_rows, self._adj_indices, self._adj_weights
+        self._adj_indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))]).astype(np.int64)
+        self._adj_indices = cols.astype(np.int32)
+        self._adj_weights = weights.astype(np.float32)
+
+        # 记忆表：旧记忆在前，新记忆在后，按概念稳定排序；被整体替换的概念丢掉旧记忆
+        old_item_rows = np.repeat(np.arange(len(self._item_indptr) - 1, dtype=np.int64), np.diff(self._item_indptr))
+        old_items = self._item_indices.astype(np.int64)
+        if self._replaced_items:
+            keep = ~np.isin(old_item_rows, np.fromiter(self._replaced_items, dtype=np.int64))
+            old_item_rows, old_items = old_item_rows[keep], old_items[keep]
+        if self._log_items:
+            log_rows = np.fromiter(
+                (node_id for node_id, items in self._log_items.items() for _ in items), dtype=np.int64
+            )
+            log_items = np.fromiter(
+                (item for items in self._log_items.values() for item in items), dtype=np.int64
+            )
+            item_rows = np.concatenate([old_item_rows, log_rows])
+            items = np.concatenate([old_items, log_items])
+            order = np.argsort(item_rows, kind="stable")
+            item_rows, items = item_rows[order], items[order]
+        else:
+            item_rows, items = old_item_rows, old_items
+        self._item_indptr = np.concatenate([[0], np.cumsum(np.bincount(item_rows, minlength=n))]).astype(np.int64)
+        self._item_indices = items.astype(np.int32)
+
+        self._log_edges = {}
+        self._log_neighbors = {}
+        self._log_items = {}
+        self._replaced_items = set()
+        self._log_size = 0
+
+    def load(self, nodes: Iterable[Tuple[str, List[str], Optional[float]]],
+             edges: Iterable[Tuple[str, str, float]]) -> None:
+        """批量加载整张图（清空已有数据），nodes为(概念, 记忆列表, 最后修改时间)"""
+        self.clear()
+        for concept, memory_items, last_modified in nodes:
+            node_id = self._node_id(concept)
+            self._last_modified[node_id] = last_modified
+            if memory_items:
+                self._log_items.setdefault(node_id, []).extend(self._string_id(memory) for memory in memory_items)
+                self._log_size += len(memory_items)
+        for source, target, num in edges:
+            u, v = self._node_id(source), self._node_id(target)
+            if u != v:
+                key = (u, v) if u < v else (v, u)
+                self._log_edges[key] = self._log_edges.get(key, 0) + num
+                self._log_size += 1
+        self.compact()
+
+    # ---------- 读取 ----------
+
+    def _edge_num(self, u: int, v: int) -> float:
+        num = self._log_edges.get((u, v) if u < v else (v, u), 0)
+        start, end = self._base_slice(self._adj_indptr, u)
+        if start < end:
+            position = start + int(np.searchsorted(self._adj_indices[start:end], v))
+            if position < end and self._adj_indices[position] == v:
+                num += float(self._adj_weights[position])
+        return num if num > 1e-6 else 0
+
+    def _neighbor_weights(self, node_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """相邻概念的id和连接次数，合并了日志中的变化，不含已删除的边"""
+        start, end = self._base_slice(self._adj_indptr, node_id)
+        neighbors = self._adj_indices[start:end].astype(np.int64)
+        weights = self._adj_weights[start:end].astype(np.float64)
+        extra = self._log_neighbors.get(node_id)
+        if extra:
+            weight_map = dict(zip(neighbors.tolist(), weights.tolist()))
+            for neighbor in extra:
+                key = (node_id, neighbor) if node_id < neighbor else (neighbor, node_id)
+                weight_map[neighbor] = weight_map.get(neighbor, 0) + self._log_edges[key]
+            weight_map = {neighbor: weight for neighbor, weight in weight_map.items() if weight > 1e-6}
+            neighbors = np.fromiter(weight_map.keys(), dtype=np.int64, count=len(weight_map))
+            weights = np.fromiter(weight_map.values(), dtype=np.float64, count=len(weight_map))
+        return neighbors, weights
+
+    def _item_ids(self, node_ids: np.ndarray) -> List[int]:
+        items: List[int] = []
+        indptr = self._item_indptr
+        base_nodes = node_ids[node_ids + 1 < len(indptr)]
+        if self._replaced_items and len(base_nodes):
+            base_nodes = base_nodes[~np.isin(base_nodes, np.fromiter(self._replaced_items, dtype=np.int64))]
+        if len(base_nodes):
+            starts, ends = indptr[base_nodes], indptr[base_nodes + 1]
+            if len(base_nodes) == 1:
+                items.extend(self._item_indices[starts[0]:ends[0]].tolist())
+            else:
+                # 多个概念的记忆一次性取出
+                lengths = ends - starts
+                positions = np.repeat(starts - np.cumsum(np.concatenate([[0], lengths[:-1]])), lengths) \
+                    + np.arange(int(lengths.sum()))
+                items.extend(self._item_indices[positions].tolist())
+        if self._log_items:
+            for node_id in node_ids.tolist():
+                items.extend(self._log_items.get(node_id, ()))
+        return items
+
+    def neighbors(self, concept: str) -> List[str]:
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return []
+        return [self._concepts[neighbor] for neighbor in self._neighbor_weights(node_id)[0].tolist()]
+
+    def weighted_neighbors(self, concept: str) -> List[Tuple[str, float]]:
+        """所有相邻概念及连接次数"""
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return []
+        neighbors, weights = self._neighbor_weights(node_id)
+        return [(self._concepts[neighbor], weight) for neighbor, weight in zip(neighbors.tolist(), weights.tolist())]
+
+    def memory_items(self, concept: str) -> List[str]:
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return []
+        return [self._strings[item] for item in self._item_ids(np.asarray([node_id], dtype=np.int64))]
+
+    def edge_num(self, concept1: str, concept2: str) -> float:
+        """两个概念之间的连接次数，没有连接时为0"""
+        u, v = self._concept_ids.get(concept1), self._concept_ids.get(concept2)
+        if u is None or v is None:
+            return 0
+        return self._edge_num(u, v)
+
+    def last_modified(self, concept: str) -> Optional[float]:
+        node_id = self._concept_ids.get(concept)
+        return self._last_modified[node_id] if node_id is not None else None
+
+    def top_neighbors(self, concept: str, limit: int) -> List[Tuple[str, float]]:
+        """连接次数最多的limit个相邻概念，返回[(概念, 连接次数)]，按连接次数从高到低"""
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return []
+        neighbors, weights = self._neighbor_weights(node_id)
+        if len(neighbors) > limit:
+            # 只对前limit个排序，热门概念有上千个邻居时也很快
+            top = np.argpartition(-weights, limit - 1)[:limit]
+            neighbors, weights = neighbors[top], weights[top]
+        order = np.argsort(-weights, kind="stable")
+        return [(self._concepts[neighbor], weight) for neighbor, weight in zip(neighbors[order].tolist(), weights[order].tolist())]
+
+    def item_count(self, concept: str) -> int:
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return 0
+        start, end = self._base_items(node_id)
+        return end - start + len(self._log_items.get(node_id, ()))
+
+    def recent_items(self, concept: str, limit: int) -> List[str]:
+        """概念最新加入的limit条记忆，按加入顺序排列"""
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return []
+        log_items = self._log_items.get(node_id, [])[-limit:] if limit > 0 else []
+        base_limit = limit - len(log_items)
+        start, end = self._base_items(node_id)
+        base_items = self._item_indices[max(start, end - base_limit):end].tolist() if base_limit > 0 else []
+        return [self._strings[item] for item in base_items + log_items]
+
+    def has_edge(self, concept1: str, concept2: str) -> bool:
+        return self.edge_num(concept1, concept2) > 0
+
+    def related_items(self, concept: str, depth: int = 1) -> Tuple[List[str], List[str]]:
+        """概念自身的记忆，以及depth>=2时所有相邻概念的记忆"""
+        node_id = self._concept_ids.get(concept)
+        if node_id is None:
+            return [], []
+        first = [self._strings[item] for item in self._item_ids(np.asarray([node_id], dtype=np.int64))]
+        second: List[str] = []
+        if depth >= 2:
+            neighbors = self._neighbor_weights(node_id)[0]
+            second = [self._strings[item] for item in self._item_ids(neighbors)]
+        return first, second
+
+    def edges(self) -> Iterator[Tuple[str, str, float]]:
+        """遍历所有边，返回(概念1, 概念2, 连接次数)"""
+        merged: Dict[Tuple[int, int], float] = {}
+        for u in range(len(self._adj_indptr) - 1):
+            start, end = int(self._adj_indptr[u]), int(self._adj_indptr[u + 1])
+            for v, num in zip(self._adj_indices[start:end].tolist(), self._adj_weights[start:end].tolist()):
+                if u < v:
+                    merged[(u, v)] = num
+        for key, num in self._log_edges.items():
+            merged[key] = merged.get(key, 0) + num
+        for (u, v), num in merged.items():
+            if num > 1e-6:
+                yield self._concepts[u], self._concepts[v], num
+
+    def memory_size(self) -> int:
+        """CSR数组占用的字节数（不含字符串本身）"""
+        return sum(array.nbytes for array in (
+            self._adj_indptr, self._adj_indices, self._adj_weights, self._item_indptr, self._item_indices
+        ))
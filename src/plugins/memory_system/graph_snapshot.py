@@ -0,0 +1,99 @@
+import os
+import pickle
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# 快照格式版本，格式变化时加一，旧快照会被忽略并从数据库完整加载
+SNAPSHOT_FORMAT = 1
+
+
+def build_snapshot(nodes: Iterable[Tuple[str, List[str], Optional[float]]],
+                   edges: Iterable[Tuple[str, str, float]], saved_at: float) -> Dict:
+    """把记忆图整理成快照：概念表 + 共享字符串表 + CSR记忆表 + COO边表
+
+    Args:
+        nodes: (概念, 记忆列表, 最后修改时间)
+        edges: (概念1, 概念2, 连接次数)
+        saved_at: 快照对应的时间，加载时重放数据库中这之后的变化
+    """
+    concepts: List[str] = []
+    concept_ids: Dict[str, int] = {}
+    last_modified: List[Optional[float]] = []
+    strings: List[str] = []
+    string_ids: Dict[str, int] = {}
+    item_indptr = [0]
+    item_indices: List[int] = []
+    for concept, memory_items, modified in nodes:
+        concept_ids[concept] = len(concepts)
+        concepts.append(concept)
+        last_modified.append(modified)
+        for memory in memory_items:
+            string_id = string_ids.get(memory)
+            if string_id is None:
+                string_id = string_ids[memory] = len(strings)
+                strings.append(memory)
+            item_indices.append(string_id)
+        item_indptr.append(len(item_indices))
+
+    sources, targets, nums = [], [], []
+    for source, target, num in edges:
+        if source in concept_ids and target in concept_ids:
+            sources.append(concept_ids[source])
+            targets.append(concept_ids[target])
+            nums.append(num)
+
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "saved_at": saved_at,
+        "concepts": concepts,
+        "last_modified": last_modified,
+        "strings": strings,
+        "item_indptr": np.asarray(item_indptr, dtype=np.int64),
+        "item_indices": np.asarray(item_indices, dtype=np.int32),
+        "edge_sources": np.asarray(sources, dtype=np.int32),
+        "edge_targets": np.asarray(targets, dtype=np.int32),
+        "edge_nums": np.asarray(nums, dtype=np.float32),
+    }
+
+
+def snapshot_nodes(snapshot: Dict) -> Iterator[Tuple[str, List[str], Optional[float]]]:
+    strings = snapshot["strings"]
+    indptr = snapshot["item_indptr"].tolist()
+    indices = snapshot["item_indices"].tolist()
+    for i, concept in enumerate(snapshot["concepts"]):
+        yield concept, [strings[item] for item in indices[indptr[i]:indptr[i + 1]]], snapshot["last_modified"][i]
+
+
+def snapshot_edges(snapshot: Dict) -> Iterator[Tuple[str, str, float]]:
+    concepts = snapshot["concepts"]
+    for source, target, num in zip(snapshot["edge_sources"].tolist(), snapshot["edge_targets"].tolist(),
+                                   snapshot["edge_nums"].tolist()):
+        yield concepts[source], concepts[target], num
+
+
+def write_snapshot(path: str, snapshot: Dict) -> None:
+    """先写临时文件再替换，写入中途退出不会损坏旧快照"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path: str) -> Optional[Dict]:
+    """读取快照，文件不存在、损坏或格式版本不一致时返回None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        print(f"\033[1;31m[记忆快照]\033[0m 读取快照失败，将从数据库加载: {str(e)}")
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT:
+        print(f"\033[1;33m[记忆快照]\033[0m 快照格式版本不一致，将从数据库加载")
+        return None
+    return snapshot
@@ -6,23 +6,77 @@ import networkx as nx
 import matplotlib.pyplot as plt
 import math
 from collections import Counter
+from difflib import SequenceMatcher
 import datetime
 import random
 import time
+import asyncio
+import heapq
+from dataclasses import dataclass
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+from pymongo import UpdateOne, DeleteOne, DeleteMany
+from pymongo.errors import BulkWriteError
 from ..chat.config import global_config
 import sys
-from ...common.database import Database # 使用正确的导入语法
-from ..chat.utils import calculate_information_content, get_cloest_chat_from_db
+from ...common.database import Database, AsyncDatabase # 使用正确的导入语法
+from .compact_graph import CompactGraph
+from .graph_snapshot import build_snapshot, read_snapshot, snapshot_edges, snapshot_nodes, write_snapshot
+from .chat_sampler import ChatSampler, ChatWindow
+from ..chat.utils import calculate_information_content
+
+
+@dataclass
+class RecallContext:
+    """一条消息的回忆结果，兴趣度计算和prompt构建共用，避免重复分词和查询记忆图"""
+    topics: List[str]
+    graph_version: int  # 计算时记忆图的版本，记忆图变化后结果失效
+    interested_topics: List[str]  # 有第一层记忆（有印象）的话题
+    memories: List[Tuple[str, float]]  # 按得分从高到低排列的(记忆, 得分)
+
    
 class Memory_graph:
-    def __init__(self):
-        self.G = nx.Graph()  # 使用 networkx 的图结构
+    # 检索记忆时每个话题最多看的相邻概念数和每个概念最多看的最新记忆数，热门概念也只做有限的工作
+    RECALL_MAX_NEIGHBORS = 32
+    RECALL_ITEMS_PER_NODE = 8
+    RECALL_HALF_LIFE = 3 * 24 * 3600  # 概念的新近度按这个半衰期（秒）衰减
+    SECOND_LAYER_WEIGHT = 0.5  # 相邻概念的记忆相对话题本身记忆的权重
+    SNAPSHOT_REPLAY_OVERLAP = 60  # 加载快照时多重放的时间（秒），覆盖写快照时正在进行的写入
+
+    def __init__(self, engine: str = "networkx"):
+        # networkx 使用灵活，compact 为CSR数组存储，节点很多时更省内存、查询更快
+        self.engine = engine
+        self.G = CompactGraph() if engine == "compact" else nx.Graph()
         self.db = Database.get_instance()
+        # 上次保存以来新增的记忆和连接次数，保存时只写入这些变化
+        self._dirty_nodes: Dict[str, List[str]] = {}
+        self._dirty_edges: Dict[Tuple[str, str], int] = {}
+        # 每次修改图时加一，用来判断缓存的回忆结果是否过期
+        self.version = 0
+        self.loaded = False  # 启动时在后台加载，加载完成前记忆图为空
+        self.load_error: Optional[str] = None  # 加载失败的原因，记忆构建时会重新加载
+        # 遗忘整理：每个概念上次整理的时间（只在内存中），以及下一批要整理的位置
+        self._forgotten_at: Dict[str, float] = {}
+        self._loaded_at = time.time()
+        self._forget_cursor = 0
         
     def connect_dot(self, concept1, concept2):
-        self.G.add_edge(concept1, concept2)
+        self.version += 1
+        if self.engine == "compact":
+            self.G.add_edge(concept1, concept2, num=1)
+        elif self.G.has_edge(concept1, concept2):
+            self.G[concept1][concept2]['num'] = self.G[concept1][concept2].get('num', 1) + 1
+        else:
+            self.G.add_edge(concept1, concept2, num=1)
+        edge_key = (concept1, concept2) if concept1 <= concept2 else (concept2, concept1)
+        self._dirty_edges[edge_key] = self._dirty_edges.get(edge_key, 0) + 1
     
     def add_dot(self, concept, memory):
+        self.version += 1
+        self._dirty_nodes.setdefault(concept, []).append(memory)
+        if self.engine == "compact":
+            self.G.add_memory(concept, memory)
+            return
         if concept in self.G:
             # 如果节点已存在，将新记忆添加到现有列表中
             if 'memory_items' in self.G.nodes[concept]:
@@ -35,9 +89,12 @@ class Memory_graph:
         else:
             # 如果是新节点，创建新的记忆列表
             self.G.add_node(concept, memory_items=[memory])
+        self.G.nodes[concept]['last_modified'] = time.time()
         
     def get_dot(self, concept):
         # 检查节点是否存在于图中
+        if self.engine == "compact":
+            return (concept, {'memory_items': self.G.memory_items(concept)}) if concept in self.G else None
         if concept in self.G:
             # 从图中获取节点数据
             node_data = self.G.nodes[concept]
@@ -47,6 +104,8 @@ class Memory_graph:
         return None
 
     def get_related_item(self, topic, depth=1):
+        if self.engine == "compact":
+            return self.G.related_items(topic, depth)
         if topic not in self.G:
             return [], []
             
@@ -84,83 +143,440 @@ class Memory_graph:
                             second_layer_items.append(memory_items)
         
         return first_layer_items, second_layer_items
+
+    def item_count(self, concept) -> int:
+        if self.engine == "compact":
+            return self.G.item_count(concept)
+        if concept not in self.G:
+            return 0
+        memory_items = self.G.nodes[concept].get('memory_items', [])
+        return len(memory_items) if isinstance(memory_items, list) else 1
+
+    def recent_items(self, concept, limit: int) -> List[str]:
+        """概念最新的limit条记忆，不复制整个记忆列表"""
+        if self.engine == "compact":
+            return self.G.recent_items(concept, limit)
+        if concept not in self.G:
+            return []
+        memory_items = self.G.nodes[concept].get('memory_items', [])
+        if not isinstance(memory_items, list):
+            return [memory_items]
+        return memory_items[-limit:]
+
+    def top_neighbors(self, concept, limit: int) -> List[Tuple[str, int]]:
+        """连接次数最多的limit个相邻概念，返回[(概念, 连接次数)]"""
+        if self.engine == "compact":
+            return self.G.top_neighbors(concept, limit)
+        if concept not in self.G:
+            return []
+        return heapq.nlargest(
+            limit, ((neighbor, data.get('num', 1)) for neighbor, data in self.G[concept].items()),
+            key=lambda item: item[1]
+        )
+
+    def last_modified(self, concept) -> Optional[float]:
+        if self.engine == "compact":
+            return self.G.last_modified(concept)
+        return self.G.nodes[concept].get('last_modified') if concept in self.G else None
+
+    def _recency(self, concept, now: float) -> float:
+        """概念的新近度，刚更新为1，每过一个半衰期减半；没有时间记录的旧节点按一个半衰期计算"""
+        last_modified = self.last_modified(concept)
+        if last_modified is None:
+            return 0.5
+        return 0.5 ** (max(0.0, now - last_modified) / self.RECALL_HALF_LIFE)
+
+    def _score_items(self, scores: Dict[str, float], concept, weight: float) -> None:
+        """给概念的最新记忆加分，越新的记忆分数越高，同一条记忆被多个话题找到时分数累加"""
+        memory_items = self.recent_items(concept, self.RECALL_ITEMS_PER_NODE)
+        for position, memory in enumerate(memory_items):
+            scores[memory] = scores.get(memory, 0.0) + weight * (0.5 + 0.5 * (position + 1) / len(memory_items))
+
+    def retrieve(self, topics: Optional[List[str]], k: int = 1) -> List[Tuple[str, float]]:
+        """按连接次数、新近度和话题重叠给记忆打分，返回得分最高的k条(记忆, 得分)
+
+        - 话题本身的记忆权重为1，相邻概念的记忆按连接次数取对数加权
+        - 每个话题只看连接最多的RECALL_MAX_NEIGHBORS个邻居，每个概念只看最新的RECALL_ITEMS_PER_NODE条记忆
+        - 被多个话题同时找到的记忆分数累加
+        """
+        now = time.time()
+        scores: Dict[str, float] = {}
+        for topic in dict.fromkeys(topics or []):
+            if topic not in self.G:
+                continue
+            self._score_items(scores, topic, self._recency(topic, now))
+            neighbors = self.top_neighbors(topic, self.RECALL_MAX_NEIGHBORS)
+            if not neighbors:
+                continue
+            max_num = math.log1p(neighbors[0][1]) or 1.0
+            for neighbor, num in neighbors:
+                weight = self.SECOND_LAYER_WEIGHT * math.log1p(num) / max_num * self._recency(neighbor, now)
+                self._score_items(scores, neighbor, weight)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def recall(self, topics: Optional[List[str]], previous: Optional[RecallContext] = None,
+               k: int = 1) -> RecallContext:
+        """计算消息话题的兴趣和得分最高的k条记忆；previous仍然有效时直接复用"""
+        if previous is not None and previous.graph_version == self.version:
+            return previous
+        topics = list(topics or [])
+        return RecallContext(
+            topics=topics,
+            graph_version=self.version,
+            interested_topics=[topic for topic in topics if self.item_count(topic)],
+            memories=self.retrieve(topics, k),
+        )
     
+    def memory_items(self, concept) -> List[str]:
+        if self.engine == "compact":
+            return self.G.memory_items(concept)
+        if concept not in self.G:
+            return []
+        memory_items = self.G.nodes[concept].get('memory_items', [])
+        return memory_items if isinstance(memory_items, list) else [memory_items]
+
+    def weighted_neighbors(self, concept) -> List[Tuple[str, float]]:
+        if self.engine == "compact":
+            return self.G.weighted_neighbors(concept)
+        if concept not in self.G:
+            return []
+        return [(neighbor, data.get('num', 1)) for neighbor, data in self.G[concept].items()]
+
+    def _set_edge_num(self, concept1, concept2, num: float):
+        """设置连接次数，不大于0时删除边（不记入待保存的变化）"""
+        if self.engine == "compact":
+            self.G.set_edge_num(concept1, concept2, num)
+        elif num <= 0:
+            self.G.remove_edge(concept1, concept2)
+        else:
+            self.G[concept1][concept2]['num'] = num
+
+    def _set_memory_items(self, concept, memory_items: List[str]):
+        if self.engine == "compact":
+            self.G.set_memory_items(concept, memory_items)
+        else:
+            self.G.nodes[concept]['memory_items'] = memory_items
+
+    def _remove_node(self, concept):
+        self.G.remove_node(concept)
+        self._forgotten_at.pop(concept, None)
+
+    @staticmethod
+    def _edge_filter(source, target) -> dict:
+        """无向边在数据库中可能以任一方向存储"""
+        return {'$or': [
+            {'source': source, 'target': target},
+            {'source': target, 'target': source}
+        ]}
+
+    @property
+    def has_unsaved_changes(self) -> bool:
+        return bool(self._dirty_nodes or self._dirty_edges)
+
+    def next_forget_batch(self, batch_size: int) -> List[str]:
+        """按顺序轮流取下一批要整理的概念，整张图分多次整理完"""
+        nodes = list(self.G.nodes())
+        if self._forget_cursor >= len(nodes):
+            self._forget_cursor = 0
+        batch = nodes[self._forget_cursor:self._forget_cursor + batch_size]
+        self._forget_cursor += batch_size
+        return batch
+
+    def forget(self, concepts: List[str], half_life: float, min_edge_weight: float,
+               max_items: int, merge_similarity: float,
+               changes: Optional[dict] = None) -> Tuple[list, list, list, dict, Counter]:
+        """规划一批概念的整理：边的连接次数随时间衰减，过弱的边删除，记忆去重并限制条数，删除孤立的空概念
+
+        只计算不修改图，数据库写入成功后再用apply_forget应用到图上，写入失败时图和数据库保持一致
+
+        Args:
+            half_life: 连接次数的半衰期（秒）
+            min_edge_weight: 衰减后低于这个值的边被删除
+            max_items: 每个概念最多保留的记忆条数
+            merge_similarity: 相似度不低于这个值的两条记忆只保留较新的一条
+            changes: 同一次整理分多批规划时，传入之前几批返回的changes
+        Returns:
+            Tuple[list, list, list, dict, Counter]: 节点和边的数据库批量操作、删除记录、要应用到图上的变化，以及统计
+        """
+        now = time.time()
+        node_ops, edge_ops, tombstones = [], [], []
+        if changes is None:
+            changes = {'edges': {}, 'items': {}, 'removed': [], 'forgotten_at': {}}
+        stats = Counter()
+        for concept in concepts:
+            if concept not in self.G:
+                continue
+            forgotten_at = self._forgotten_at.get(concept)
+            changes['forgotten_at'][concept] = now
+            factor = 0.5 ** (max(0.0, now - (forgotten_at or self._loaded_at)) / half_life)
+
+            # 每条边只由名字较小的一端处理，避免一次整理衰减两遍
+            remaining_edges = 0
+            for neighbor, num in self.weighted_neighbors(concept):
+                edge_key = (concept, neighbor) if concept <= neighbor else (neighbor, concept)
+                if edge_key in changes['edges']:
+                    # 另一端在之前已经规划过
+                    remaining_edges += changes['edges'][edge_key] > 0
+                    continue
+                if concept > neighbor:
+                    remaining_edges += 1
+                    continue
+                new_num = num * factor
+                if new_num < min_edge_weight:
+                    changes['edges'][edge_key] = 0
+                    edge_ops.append(DeleteMany(self._edge_filter(concept, neighbor)))
+                    tombstones.append({'source': concept, 'target': neighbor, 'deleted_at': now})
+                    stats['pruned_edges'] += 1
+                    continue
+                remaining_edges += 1
+                if new_num != num:
+                    changes['edges'][edge_key] = new_num
+                    edge_ops.append(UpdateOne(
+                        self._edge_filter(concept, neighbor), {'$set': {'num': new_num, 'updated_at': now}}
+                    ))
+
+            # 上次整理之后没有新记忆的概念不用再去重
+            item_count = self.item_count(concept)
+            last_modified = self.last_modified(concept)
+            if forgotten_at is None or last_modified is None or last_modified >= forgotten_at:
+                memory_items = self.memory_items(concept)
+                kept = condense_memory_items(memory_items, max_items, merge_similarity)
+                if len(kept) != len(memory_items):
+                    changes['items'][concept] = kept
+                    item_count = len(kept)
+                    node_ops.append(UpdateOne({'concept': concept}, {'$set': {'memory_items': kept, 'updated_at': now}}))
+                    stats['forgotten_items'] += len(memory_items) - len(kept)
+
+            if not remaining_edges and not item_count:
+                changes['removed'].append(concept)
+                node_ops.append(DeleteOne({'concept': concept}))
+                tombstones.append({'concept': concept, 'deleted_at': now})
+                stats['removed_nodes'] += 1
+
+        return node_ops, edge_ops, tombstones, changes, stats
+
+    def apply_forget(self, changes: dict) -> None:
+        """整理结果写入数据库后，把forget规划的变化应用到图上"""
+        for (concept1, concept2), num in changes['edges'].items():
+            self._set_edge_num(concept1, concept2, num)
+        for concept, memory_items in changes['items'].items():
+            self._set_memory_items(concept, memory_items)
+        self._forgotten_at.update(changes['forgotten_at'])
+        for concept in changes['removed']:
+            self._remove_node(concept)
+        if changes['edges'] or changes['items'] or changes['removed']:
+            self.version += 1
+
+    def read_concepts(self, concepts: List[str]) -> Tuple[dict, dict]:
+        """从数据库读取这些概念的记忆和相关的连接（同步方法，应在线程池中调用）
+
+        Returns:
+            Tuple[dict, dict]: 概念 -> 记忆列表，(较小的概念, 较大的概念) -> 连接次数
+        """
+        nodes = {concept: memory_items for concept, memory_items, _ in self._iter_db_nodes({'concept': {'$in': concepts}})}
+        edges = {}
+        query = {'$or': [{'source': {'$in': concepts}}, {'target': {'$in': concepts}}]}
+        for source, target, num in self._iter_db_edges(query):
+            edges[(source, target) if source <= target else (target, source)] = num
+        return nodes, edges
+
+    def restore_concepts(self, concepts: List[str], nodes: dict, edges: dict) -> None:
+        """整理结果只写入了一部分时，用read_concepts读到的数据库数据覆盖图中这些概念，使两边重新一致"""
+        for concept in concepts:
+            if concept not in self.G:
+                continue
+            if concept not in nodes:
+                self._remove_node(concept)
+                continue
+            self._set_memory_items(concept, nodes[concept])
+            for neighbor, num in self.weighted_neighbors(concept):
+                edge_key = (concept, neighbor) if concept <= neighbor else (neighbor, concept)
+                db_num = edges.get(edge_key, 0)
+                if db_num != num:
+                    self._set_edge_num(concept, neighbor, db_num)
+        self.version += 1
+
+    def write_bulk(self, node_ops: list, edge_ops: list, tombstones: list):
+        """批量写入整理结果，删除操作另外记录下来，供加载快照时重放"""
+        if tombstones:
+            self.db.db.graph_data.tombstones.insert_many(tombstones, ordered=False)
+        if node_ops:
+            self.db.db.graph_data.nodes.bulk_write(node_ops, ordered=False)
+        if edge_ops:
+            self.db.db.graph_data.edges.bulk_write(edge_ops, ordered=False)
+
+    def compact(self):
+        """把compact引擎追加日志中的变化合并进CSR数组，networkx引擎不需要"""
+        if self.engine == "compact":
+            self.G.compact()
+
     @property
     def dots(self):
         # 返回所有节点对应的 Memory_dot 对象
         return [self.get_dot(node) for node in self.G.nodes()]
 
     def save_graph_to_db(self):
-        # 保存节点
-        for node in self.G.nodes(data=True):
-            concept = node[0]
-            memory_items = node[1].get('memory_items', [])
-            
-            # 查找是否存在同名节点
-            existing_node = self.db.db.graph_data.nodes.find_one({'concept': concept})
-            if existing_node:
-                # 如果存在,合并memory_items并去重
-                existing_items = existing_node.get('memory_items', [])
-                if not isinstance(existing_items, list):
-                    existing_items = [existing_items] if existing_items else []
-                
-                # 合并并去重
-                all_items = list(set(existing_items + memory_items))
-                
-                # 更新节点
-                self.db.db.graph_data.nodes.update_one(
-                    {'concept': concept},
-                    {'$set': {'memory_items': all_items}}
-                )
-            else:
-                # 如果不存在,创建新节点
-                node_data = {
-                    'concept': concept,
-                    'memory_items': memory_items
-                }
-                self.db.db.graph_data.nodes.insert_one(node_data)
+        """把上次保存以来变化的节点和边写入数据库，每个集合一次 bulk_write"""
+        dirty_nodes, self._dirty_nodes = self._dirty_nodes, {}
+        dirty_edges, self._dirty_edges = self._dirty_edges, {}
         
-        # 保存边
-        for edge in self.G.edges():
-            source, target = edge
-            
-            # 查找是否存在同样的边
-            existing_edge = self.db.db.graph_data.edges.find_one({
-                'source': source,
-                'target': target
-            })
-            
-            if existing_edge:
-                # 如果存在,增加num属性
-                num = existing_edge.get('num', 1) + 1
-                self.db.db.graph_data.edges.update_one(
-                    {'source': source, 'target': target},
-                    {'$set': {'num': num}}
-                )
-            else:
-                # 如果不存在,创建新边
-                edge_data = {
-                    'source': source,
-                    'target': target,
-                    'num': 1
-                }
-                self.db.db.graph_data.edges.insert_one(edge_data)
+        # 节点：把新记忆合并进已有的记忆列表，$addToSet 自动去重
+        now = time.time()
+        node_ops = [
+            UpdateOne(
+                {'concept': concept},
+                {'$addToSet': {'memory_items': {'$each': memory_items}}, '$max': {'last_modified': now},
+                 '$set': {'updated_at': now}},
+                upsert=True
+            )
+            for concept, memory_items in dirty_nodes.items()
+        ]
+        # 边：无向边在数据库中可能以任一方向存储，累加本次新增的连接次数
+        edge_ops = [
+            UpdateOne(
+                self._edge_filter(source, target),
+                {'$inc': {'num': num}, '$set': {'updated_at': now},
+                 '$setOnInsert': {'source': source, 'target': target}},
+                upsert=True
+            )
+            for (source, target), num in dirty_edges.items()
+        ]
+        
+        # 节点和边分开写入，一边失败不影响另一边；没写进去的变化放回去，下次保存时重试
+        failed_nodes = self._write_changes(self.db.db.graph_data.nodes, node_ops, list(dirty_nodes), "记忆")
+        failed_edges = self._write_changes(self.db.db.graph_data.edges, edge_ops, list(dirty_edges), "连接")
+        for concept in failed_nodes:
+            self._dirty_nodes.setdefault(concept, [])[:0] = dirty_nodes[concept]
+        for edge_key in failed_edges:
+            self._dirty_edges[edge_key] = self._dirty_edges.get(edge_key, 0) + dirty_edges[edge_key]
+        
+        print(f"\033[1;32m[记忆存储]\033[0m 已保存 {len(node_ops) - len(failed_nodes)} 个节点和 "
+              f"{len(edge_ops) - len(failed_edges)} 条边的变化")
 
-    def load_graph_from_db(self):
-        # 清空当前图
-        self.G.clear()
-        # 加载节点
-        nodes = self.db.db.graph_data.nodes.find()
-        for node in nodes:
+    @staticmethod
+    def _write_changes(collection, ops: list, keys: list, label: str) -> list:
+        """批量写入一个集合，返回没写进去的操作对应的键（keys与ops一一对应）"""
+        if not ops:
+            return []
+        try:
+            collection.bulk_write(ops, ordered=False)
+            return []
+        except BulkWriteError as e:
+            # 无序写入时其余操作已经完成，只有writeErrors中的操作没有生效
+            failed = [keys[error['index']] for error in e.details.get('writeErrors', [])]
+            print(f"\033[1;31m[记忆存储]\033[0m 部分{label}写入失败，下次重试: {len(failed)} 条")
+            return failed
+        except Exception as e:
+            print(f"\033[1;31m[记忆存储]\033[0m 保存{label}失败，下次重试: {str(e)}")
+            return keys
+
+    def _iter_db_nodes(self, query: Optional[dict] = None):
+        for node in self.db.db.graph_data.nodes.find(query or {}, {'concept': 1, 'memory_items': 1, 'last_modified': 1}):
             memory_items = node.get('memory_items', [])
             if not isinstance(memory_items, list):
                 memory_items = [memory_items] if memory_items else []
-            self.G.add_node(node['concept'], memory_items=memory_items)
-        # 加载边
-        edges = self.db.db.graph_data.edges.find()
-        for edge in edges:
-            self.G.add_edge(edge['source'], edge['target'], num=edge.get('num', 1))
+            yield node['concept'], memory_items, node.get('last_modified')
 
+    def _iter_db_edges(self, query: Optional[dict] = None):
+        for edge in self.db.db.graph_data.edges.find(query or {}, {'source': 1, 'target': 1, 'num': 1}):
+            yield edge['source'], edge['target'], edge.get('num', 1)
+
+    def _replace_graph(self, nodes, edges):
+        """构建一张新图再整体替换，构建期间读取的仍是旧图，可以在线程中调用"""
+        if self.engine == "compact":
+            graph = CompactGraph()
+            graph.load(nodes, edges)
+        else:
+            graph = nx.Graph()
+            graph.add_nodes_from(
+                (concept, {'memory_items': memory_items, 'last_modified': last_modified})
+                for concept, memory_items, last_modified in nodes
+            )
+            graph.add_edges_from((source, target, {'num': num}) for source, target, num in edges)
+        self.G = graph
+        self.version += 1
+        self._loaded_at = time.time()
+        self._forgotten_at.clear()
+
+    def load_graph_from_db(self):
+        """从数据库完整加载记忆图"""
+        self._replace_graph(self._iter_db_nodes(), self._iter_db_edges())
+
+    def load_from_snapshot(self, path: str) -> bool:
+        """读取快照，再重放数据库中快照之后的变化；没有可用快照时返回False"""
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            return False
+        nodes = {concept: (memory_items, last_modified)
+                 for concept, memory_items, last_modified in snapshot_nodes(snapshot)}
+        edges = {}
+        for source, target, num in snapshot_edges(snapshot):
+            edges[(source, target) if source <= target else (target, source)] = num
+
+        # 往前多重放一段时间，重放是覆盖式的，重复执行没有副作用
+        since = snapshot['saved_at'] - self.SNAPSHOT_REPLAY_OVERLAP
+        removed = 0
+        for tombstone in self.db.db.graph_data.tombstones.find({'deleted_at': {'$gte': since}}).sort('deleted_at', 1):
+            if tombstone.get('concept') is not None:
+                removed += nodes.pop(tombstone['concept'], None) is not None
+            else:
+                source, target = tombstone['source'], tombstone['target']
+                removed += edges.pop((source, target) if source <= target else (target, source), None) is not None
+        # 删除之后又重新写入的节点和边以数据库为准，所以墓碑先处理
+        updated = 0
+        for concept, memory_items, last_modified in self._iter_db_nodes({'updated_at': {'$gte': since}}):
+            nodes[concept] = (memory_items, last_modified)
+            updated += 1
+        for source, target, num in self._iter_db_edges({'updated_at': {'$gte': since}}):
+            edges[(source, target) if source <= target else (target, source)] = num
+            for concept in (source, target):
+                nodes.setdefault(concept, ([], None))
+            updated += 1
+
+        self._replace_graph(
+            ((concept, memory_items, last_modified) for concept, (memory_items, last_modified) in nodes.items()),
+            ((source, target, num) for (source, target), num in edges.items())
+        )
+        saved_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['saved_at']))
+        print(f"\033[1;32m[记忆快照]\033[0m 已加载{saved_time}的快照，重放{updated}处更新、{removed}处删除")
+        return True
+
+    def initialize(self, snapshot_path: Optional[str] = None):
+        """加载记忆图：优先使用快照，没有可用快照时从数据库完整加载（同步方法，应在线程池中调用）
+
+        在后台任务中调用，出错时只打印并记录到load_error，不抛出异常
+        """
+        start_time = time.time()
+        loaded_snapshot = False
+        if snapshot_path:
+            try:
+                loaded_snapshot = self.load_from_snapshot(snapshot_path)
+            except Exception as e:
+                print(f"\033[1;31m[记忆快照]\033[0m 加载快照失败，改为从数据库完整加载: {str(e)}")
+        if not loaded_snapshot:
+            try:
+                self.load_graph_from_db()
+            except Exception as e:
+                self.load_error = str(e)
+                print(f"\033[1;31m[记忆系统]\033[0m 从数据库加载记忆图失败，下次记忆构建时重试: {str(e)}")
+                return
+        self.load_error = None
+        self.loaded = True
+        print(f"\033[32m[加载海马体耗时: {time.time() - start_time:.2f} 秒]\033[0m")
+
+    def export_snapshot(self) -> dict:
+        """把当前记忆图整理成快照数据，在修改图的线程（事件循环）中调用"""
+        saved_at = time.time()
+        nodes = ((concept, self.memory_items(concept), self.last_modified(concept)) for concept in self.G.nodes())
+        if self.engine == "compact":
+            edges = self.G.edges()
+        else:
+            edges = self.G.edges(data='num', default=1)
+        return build_snapshot(nodes, edges, saved_at)
+
+    def prune_tombstones(self, before: float):
+        """快照已经包含的删除记录不再需要"""
+        self.db.db.graph_data.tombstones.delete_many({'deleted_at': {'$lt': before}})
 
 
 
@@ -171,82 +587,210 @@ class Hippocampus:
         self.memory_graph = memory_graph
         self.llm_model = LLMModel()
         self.llm_model_small = LLMModel(model_name="deepseek-ai/DeepSeek-V2.5")
+        # 同时进行的大模型请求数量上限
+        self._llm_semaphore = asyncio.Semaphore(global_config.memory_build_concurrency)
+        self._building = False
+        self.sampler = ChatSampler(
+            memory_graph.db,
+            bucket_seconds=global_config.memory_sample_bucket_seconds,
+            min_messages=global_config.memory_sample_min_messages
+        )
         
-    def get_memory_sample(self,chat_size=20,time_frequency:dict={'near':2,'mid':4,'far':3}):
-        current_timestamp = datetime.datetime.now().timestamp()
-        chat_text = []
-        #短期：1h   中期：4h   长期：24h
-        for _ in range(time_frequency.get('near')):  # 循环10次
-            random_time = current_timestamp - random.randint(1, 3600)  # 随机时间
-            # print(f"获得 最近 随机时间戳对应的时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(random_time))}")
-            chat_ = get_cloest_chat_from_db(db=self.memory_graph.db, length=chat_size, timestamp=random_time)
-            chat_text.append(chat_)  
-        for _ in range(time_frequency.get('mid')):  # 循环10次
-            random_time = current_timestamp - random.randint(3600, 3600*4)  # 随机时间
-            # print(f"获得 最近 随机时间戳对应的时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(random_time))}")
-            chat_ = get_cloest_chat_from_db(db=self.memory_graph.db, length=chat_size, timestamp=random_time)
-            chat_text.append(chat_)  
-        for _ in range(time_frequency.get('far')):  # 循环10次
-            random_time = current_timestamp - random.randint(3600*4, 3600*24)  # 随机时间
-            # print(f"获得 最近 随机时间戳对应的时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(random_time))}")
-            chat_ = get_cloest_chat_from_db(db=self.memory_graph.db, length=chat_size, timestamp=random_time)
-            chat_text.append(chat_)
-        return chat_text
+    async def get_memory_sample(self, chat_size=20, time_frequency: dict = {'near': 2, 'mid': 4, 'far': 3}) -> List[ChatWindow]:
+        """从近、中、远期（1h/4h/24h内）消息较多的时间段各取几段聊天记录"""
+        return await AsyncDatabase.get_instance().run(self.sampler.sample, chat_size, time_frequency)
+    
+    async def build_memory(self,chat_size=12):
+        """构建记忆，上一次构建还没完成时直接跳过"""
+        if not self.memory_graph.loaded:
+            if self.memory_graph.load_error is not None:
+                # 启动时加载失败，重新加载，成功后下次再构建
+                print(f"\033[1;33m[记忆构建]\033[0m 记忆图加载失败过，重新加载")
+                await AsyncDatabase.get_instance().run(self.memory_graph.initialize, global_config.memory_snapshot_path)
+            else:
+                print(f"\033[1;33m[记忆构建]\033[0m 记忆图尚未加载完成，跳过本次")
+            return
+        if self._building:
+            print(f"\033[1;33m[记忆构建]\033[0m 上一次记忆构建尚未完成，跳过本次")
+            return
+        self._building = True
+        try:
+            await self._build_memory(chat_size)
+        finally:
+            self._building = False
     
-    def build_memory(self,chat_size=12):
+    async def _build_memory(self,chat_size=12):
         #最近消息获取频率
         time_frequency = {'near':1,'mid':2,'far':2}
-        memory_sample = self.get_memory_sample(chat_size,time_frequency)
+        memory_sample = await self.get_memory_sample(chat_size,time_frequency)
         # print(f"\033[1;32m[记忆构建]\033[0m 获取记忆样本: {memory_sample}")   
+        if not memory_sample:
+            print(f"\033[1;33m[记忆构建]\033[0m 没有获取到聊天记录")
+            return
 
-
-        for i, input_text in enumerate(memory_sample, 1):
+        # 并发压缩所有样本，大模型请求数量由信号量限制
+        finished = 0
+        async def compress_with_progress(window: ChatWindow):
+            nonlocal finished
+            first_memory = await self.memory_compress(window.text, 2.5)
+            finished += 1
             #加载进度可视化
-            progress = (i / len(memory_sample)) * 100
+            progress = (finished / len(memory_sample)) * 100
             bar_length = 30
-            filled_length = int(bar_length * i // len(memory_sample))
+            filled_length = int(bar_length * finished // len(memory_sample))
             bar = '█' * filled_length + '-' * (bar_length - filled_length)
-            print(f"\n进度: [{bar}] {progress:.1f}% ({i}/{len(memory_sample)})")
-            
-            # 生成压缩后记忆
-            first_memory = set()
-            first_memory = self.memory_compress(input_text, 2.5)
-            # 延时防止访问超频
-            # time.sleep(5)
-            #将记忆加入到图谱中
+            print(f"\n进度: [{bar}] {progress:.1f}% ({finished}/{len(memory_sample)})")
+            return first_memory
+        
+        compressed_samples = await asyncio.gather(
+            *[compress_with_progress(window) for window in memory_sample],
+            return_exceptions=True
+        )
+        
+        #将记忆加入到图谱中
+        compressed_windows = []
+        for window, first_memory in zip(memory_sample, compressed_samples):
+            if isinstance(first_memory, Exception):
+                print(f"\033[1;31m[记忆构建]\033[0m 压缩记忆失败: {str(first_memory)}")
+                continue
+            compressed_windows.append(window)
             for topic, memory in first_memory:
                 topics = segment_text(topic)
                 print(f"\033[1;34m话题\033[0m: {topic},节点: {topics}, 记忆: {memory}")
                 for split_topic in topics:
                     self.memory_graph.add_dot(split_topic,memory)
-                for split_topic in topics:
-                    for other_split_topic in topics:
-                        if split_topic != other_split_topic:
-                            self.memory_graph.connect_dot(split_topic, other_split_topic)
-            
-            self.memory_graph.save_graph_to_db()
+                # 每对话题只连接一次，避免无向边被重复计数
+                for split_topic, other_split_topic in combinations(set(topics), 2):
+                    self.memory_graph.connect_dot(split_topic, other_split_topic)
+        
+        self.memory_graph.compact()
+        await AsyncDatabase.get_instance().run(self.memory_graph.save_graph_to_db)
+        # 压缩过的消息下次不再取样
+        await AsyncDatabase.get_instance().run(self.sampler.mark_compressed, compressed_windows)
     
-    def memory_compress(self, input_text, rate=1):
+    async def forget_memory(self, chunk_size: int = 200):
+        """整理一批记忆概念（衰减、修剪、去重），和记忆构建互斥"""
+        if not self.memory_graph.loaded:
+            return
+        if self._building:
+            print(f"\033[1;33m[记忆整理]\033[0m 记忆构建尚未完成，跳过本次整理")
+            return
+        self._building = True
+        try:
+            db = AsyncDatabase.get_instance()
+            if self.memory_graph.has_unsaved_changes:
+                # 先保存构建时的增量，避免整理结果被之后的$inc/$addToSet覆盖
+                await db.run(self.memory_graph.save_graph_to_db)
+                if self.memory_graph.has_unsaved_changes:
+                    return
+            concepts = self.memory_graph.next_forget_batch(global_config.memory_forget_batch_size)
+            node_ops, edge_ops, tombstones = [], [], []
+            changes = None
+            stats = Counter()
+            for start in range(0, len(concepts), chunk_size):
+                chunk_node_ops, chunk_edge_ops, chunk_tombstones, changes, chunk_stats = self.memory_graph.forget(
+                    concepts[start:start + chunk_size],
+                    half_life=global_config.memory_edge_half_life * 24 * 3600,
+                    min_edge_weight=global_config.memory_min_edge_weight,
+                    max_items=global_config.memory_max_items,
+                    merge_similarity=global_config.memory_merge_similarity,
+                    changes=changes,
+                )
+                node_ops.extend(chunk_node_ops)
+                edge_ops.extend(chunk_edge_ops)
+                tombstones.extend(chunk_tombstones)
+                stats.update(chunk_stats)
+                # 分段处理，让出事件循环
+                await asyncio.sleep(0)
+            try:
+                await db.run(self.memory_graph.write_bulk, node_ops, edge_ops, tombstones)
+            except Exception as e:
+                print(f"\033[1;31m[记忆整理]\033[0m 写入数据库失败，本次整理不生效: {str(e)}")
+                # 图还没有修改，但数据库可能已经写入了一部分，按数据库重新读取这批概念
+                try:
+                    nodes, edges = await db.run(self.memory_graph.read_concepts, concepts)
+                    self.memory_graph.restore_concepts(concepts, nodes, edges)
+                    self.memory_graph.compact()
+                except Exception as e:
+                    print(f"\033[1;31m[记忆整理]\033[0m 重新读取记忆失败: {str(e)}")
+                return
+            if changes is not None:
+                self.memory_graph.apply_forget(changes)
+            self.memory_graph.compact()
+            print(
+                f"\033[1;32m[记忆整理]\033[0m 整理{len(concepts)}个概念，删除{stats['pruned_edges']}条弱连接、"
+                f"{stats['removed_nodes']}个孤立概念，遗忘{stats['forgotten_items']}条重复或过旧的记忆"
+            )
+        finally:
+            self._building = False
+
+    async def save_snapshot(self, path: str):
+        """保存记忆图快照，下次启动时不用从数据库逐条加载"""
+        if not self.memory_graph.loaded or self._building or self.memory_graph.has_unsaved_changes:
+            # 快照里不能有还没写入数据库的变化
+            return
+        snapshot = self.memory_graph.export_snapshot()
+        db = AsyncDatabase.get_instance()
+        try:
+            await db.run(write_snapshot, path, snapshot)
+            await db.run(self.memory_graph.prune_tombstones, snapshot['saved_at'] - Memory_graph.SNAPSHOT_REPLAY_OVERLAP)
+        except Exception as e:
+            print(f"\033[1;31m[记忆快照]\033[0m 保存快照失败: {str(e)}")
+            return
+        print(f"\033[1;32m[记忆快照]\033[0m 已保存{len(snapshot['concepts'])}个概念、{len(snapshot['edge_nums'])}条连接")
+
+    async def _generate(self, llm_model: LLMModel, prompt: str):
+        async with self._llm_semaphore:
+            return await llm_model.generate_response_async(prompt)
+    
+    async def memory_compress(self, input_text, rate=1):
         information_content = calculate_information_content(input_text)
         print(f"文本的信息量（熵）: {information_content:.4f} bits")
         topic_num = max(1, min(5, int(information_content * rate / 4)))
         # print(topic_num)
         topic_prompt = find_topic(input_text, topic_num)
-        topic_response = self.llm_model.generate_response(topic_prompt)
+        topic_response = await self._generate(self.llm_model, topic_prompt)
         # 检查 topic_response 是否为元组
         if isinstance(topic_response, tuple):
             topics = topic_response[0].split(",")  # 假设第一个元素是我们需要的字符串
         else:
             topics = topic_response.split(",")
         # print(topics)
+        # 并发获取每个话题的记忆
+        topic_what_responses = await asyncio.gather(*[
+            self._generate(self.llm_model_small, topic_what(input_text,topic))
+            for topic in topics
+        ])
         compressed_memory = set()
-        for topic in topics:
-            topic_what_prompt = topic_what(input_text,topic)
-            topic_what_response = self.llm_model_small.generate_response(topic_what_prompt)
+        for topic, topic_what_response in zip(topics, topic_what_responses):
             compressed_memory.add((topic.strip(), topic_what_response[0]))  # 将话题和记忆作为元组存储
         return compressed_memory
 
 
+def condense_memory_items(memory_items: List[str], max_items: int, similarity: float) -> List[str]:
+    """去掉重复和相近的记忆（保留较新的一条），最多保留最新的max_items条"""
+    kept: List[str] = []
+    # 只看最新的一部分，过旧的记忆反正会被丢掉
+    candidates = memory_items[-max_items * 2:] if max_items > 0 else memory_items
+    for memory in reversed(candidates):
+        if memory in kept:
+            continue
+        similar = False
+        for other in kept:
+            matcher = SequenceMatcher(None, memory, other)
+            # 先用代价低的上界过滤
+            if matcher.real_quick_ratio() >= similarity and matcher.quick_ratio() >= similarity \
+                    and matcher.ratio() >= similarity:
+                similar = True
+                break
+        if similar:
+            continue
+        kept.append(memory)
+        if max_items > 0 and len(kept) >= max_items:
+            break
+    kept.reverse()
+    return kept
+
 def segment_text(text):
     seg_text = list(jieba.cut(text))
     return seg_text    
@@ -261,8 +805,6 @@ def topic_what(text, topic):
 
 
     
-start_time = time.time()
-
 Database.initialize(
     host= os.getenv("MONGODB_HOST"),
     port= int(os.getenv("MONGODB_PORT")),
@@ -271,12 +813,7 @@ Database.initialize(
     password= os.getenv("MONGODB_PASSWORD"),
     auth_source=os.getenv("MONGODB_AUTH_SOURCE")
 )
-#创建记忆图
-memory_graph = Memory_graph()
-#加载数据库中存储的记忆图
-memory_graph.load_graph_from_db()
+#创建记忆图，启动后在后台调用 memory_graph.initialize 加载
+memory_graph = Memory_graph(engine=global_config.memory_graph_engine)
 #创建海马体
 hippocampus = Hippocampus(memory_graph)
-
-end_time = time.time()
-print(f"\033[32m[加载海马体耗时: {end_time - start_time:.2f} 秒]\033[0m")
\ No newline at end of file
@@ -13,6 +13,7 @@ import os
 sys.path.append("C:/GitHub/MaiMBot")  # 添加项目根目录到 Python 路径
 from src.common.database import Database  # 使用正确的导入语法
 from src.plugins.memory_system.llm_module import LLMModel
+from src.common.llm_gateway import LLMGateway
    
 class Memory_graph:
     def __init__(self):
@@ -227,6 +228,7 @@ def main():
           password= os.getenv("MONGODB_PASSWORD"),
           auth_source=os.getenv("MONGODB_AUTH_SOURCE")
     )
+    LLMGateway.initialize()
     
     memory_graph = Memory_graph()
     # 创建LLM模型实例